@@ -1,17 +1,28 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Body, Depends
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional
+from contextlib import asynccontextmanager, contextmanager
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from qdrant_client import QdrantClient
 import uvicorn
-from infrang_core import Infrang
+from infrang_core import Infrang, AnswerCache, EmbeddingService, SpellCorrector, StageTimer, metrics, resident_mb, shared_memory_mb
 import dotenv
+import asyncio
+import threading
+import json
+import time
+import uuid
+import gc
 import os
 import logging
 
-version = '1.2.4'
+version = '1.3.0'
 
 # Setup
 dotenv.load_dotenv()
-app = FastAPI(title="Infrang API", version=version)
 logger = logging.getLogger(__name__)
 
 
@@ -23,21 +34,400 @@ class InfrangConfig(BaseModel):
     generate_model_name: Optional[str] = "llama-3.3-70b-versatile"
     parallel: Optional[int] = 4
     groq_api_key: Optional[str] = None
+    extract_workers: Optional[int] = None
+    fetch_workers: Optional[int] = 8
+    batch_size: Optional[int] = 256
+    paraphrase_backend: Optional[str] = "torch"
+    paraphrase_threads: Optional[int] = None
+    paraphrase_skip: Optional[str] = "auto"
+    chunk_tokens: Optional[int] = 256
+    chunk_overlap: Optional[int] = 32
+    fetch_per_host: Optional[int] = 4
+    fetch_max_mb: Optional[int] = 50
+    embed_threads: Optional[int] = None
+    embed_batch_size: Optional[int] = 256
+    hnsw_m: Optional[int] = 16
+    hnsw_ef_construct: Optional[int] = 100
+    quantization: Optional[str] = None
+    on_disk: Optional[bool] = False
+    shards: Optional[int] = 1
+    replicas: Optional[int] = 1
+    context_tokens: Optional[int] = 2048
+    context_tokenizer: Optional[str] = None
+    include: Optional[list[str]] = None
+    exclude: Optional[list[str]] = None
+    max_file_mb: Optional[int] = None
+    follow_symlinks: Optional[bool] = False
+    scan_workers: Optional[int] = 8
 
 
-# Helper function
-def get_infrang_instance(collection: str, config: InfrangConfig) -> Infrang:
+# Instance pool
+class InfrangPool:
+    '''
+        Process-wide registry of Infrang instances keyed by collection and InfrangConfig.
+        The models are shared by all instances of the process and all instances share a single database client,
+        since the embedded Qdrant storage can only be opened once per process.
+        The least recently used instances are evicted when the pool exceeds `max_instances`
+        or the resident memory of the process, without the weights of the shared models, exceeds `max_memory_mb`.
+        The spell correctors of the collections count towards the memory and are evicted with the instances.
+    '''
 
-    groq_api_key = config.groq_api_key or os.getenv("GROQ_API_KEY")
-    return Infrang(
-        collection=collection,
-        dense_model_name=config.dense_model_name,
-        sparse_model_name=config.sparse_model_name,
-        paraphrase_model_name=config.paraphrase_model_name,
-        generate_model_name=config.generate_model_name,
-        parallel=config.parallel,
-        groq_api_key=groq_api_key
-    )
+    def __init__(self, max_instances=8, max_memory_mb=None, answer_cache=None):
+        self.max_instances = max_instances
+        self.max_memory_mb = max_memory_mb
+        self.answer_cache = answer_cache
+        self.instances = OrderedDict()
+        self.database_client = None
+        self.lock = threading.Lock()
+
+    def __key(self, collection: str, config: InfrangConfig):
+        return (collection, tuple(sorted(
+            (name, tuple(value) if isinstance(value, list) else value) for name, value in config.model_dump().items()
+        )))
+
+    def __open_database_client(self):
+        if self.database_client is None:
+            if os.getenv("QDRANT_URL"):
+                self.database_client = QdrantClient(url=os.getenv("QDRANT_URL"), api_key=os.getenv("QDRANT_API_KEY"))
+            else:
+                os.makedirs('data', exist_ok=True)
+                self.database_client = QdrantClient(path='data')
+        return self.database_client
+
+    def __evict(self):
+        key, infrang = self.instances.popitem(last=False)
+        logger.info(f"Evicting Infrang instance of '{key[0]}'")
+        infrang.uninit()
+        del infrang
+        # the correctors are rebuilt on use, at most one per instance is kept
+        SpellCorrector.trim(max(len(self.instances), 1))
+        gc.collect()
+
+    def get(self, collection: str, config: InfrangConfig) -> Infrang:
+        key = self.__key(collection, config)
+        with self.lock:
+            if key in self.instances:
+                self.instances.move_to_end(key)
+                return self.instances[key]
+            infrang = Infrang(
+                collection=collection,
+                dense_model_name=config.dense_model_name,
+                sparse_model_name=config.sparse_model_name,
+                paraphrase_model_name=config.paraphrase_model_name,
+                generate_model_name=config.generate_model_name,
+                parallel=config.parallel,
+                groq_api_key=config.groq_api_key or os.getenv("GROQ_API_KEY"),
+                database_client=self.__open_database_client(),
+                extract_workers=config.extract_workers,
+                fetch_workers=config.fetch_workers,
+                batch_size=config.batch_size,
+                answer_cache=self.answer_cache,
+                paraphrase_backend=config.paraphrase_backend,
+                paraphrase_threads=config.paraphrase_threads,
+                paraphrase_skip=config.paraphrase_skip,
+                chunk_tokens=config.chunk_tokens,
+                chunk_overlap=config.chunk_overlap,
+                fetch_per_host=config.fetch_per_host,
+                fetch_max_mb=config.fetch_max_mb,
+                embed_threads=config.embed_threads,
+                embed_batch_size=config.embed_batch_size,
+                hnsw_m=config.hnsw_m,
+                hnsw_ef_construct=config.hnsw_ef_construct,
+                quantization=config.quantization,
+                on_disk=config.on_disk,
+                shards=config.shards,
+                replicas=config.replicas,
+                context_tokens=config.context_tokens,
+                context_tokenizer=config.context_tokenizer,
+                include=config.include,
+                exclude=config.exclude,
+                max_file_mb=config.max_file_mb,
+                follow_symlinks=config.follow_symlinks,
+                scan_workers=config.scan_workers,
+            )
+            self.instances[key] = infrang
+            while len(self.instances) > max(self.max_instances, 1):
+                self.__evict()
+            if self.max_memory_mb:
+                # evicting instances does not unload the shared models; without `/proc` only `max_instances` applies
+                while len(self.instances) > 1 and (resident_mb() or 0) - shared_memory_mb() > self.max_memory_mb:
+                    self.__evict()
+            return infrang
+
+    def close(self):
+        with self.lock:
+            while self.instances:
+                self.__evict()
+            if self.database_client is not None:
+                self.database_client.close()
+                self.database_client = None
+
+
+answer_cache = AnswerCache(
+    max_entries=int(os.getenv("INFRANG_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("INFRANG_CACHE_TTL", 3600)),
+    similarity=float(os.getenv("INFRANG_CACHE_SIMILARITY", 0)), # the semantic tier is opt-in
+) if int(os.getenv("INFRANG_CACHE_SIZE", 1024)) else None
+
+pool = InfrangPool(
+    max_instances=int(os.getenv("INFRANG_POOL_SIZE", 8)),
+    max_memory_mb=int(os.getenv("INFRANG_POOL_MEMORY_MB", 0)) or None,
+    answer_cache=answer_cache,
+)
+
+
+# Executors and backpressure
+class StageLimiter:
+    '''
+        Limits the concurrency of a stage. Requests wait in a bounded queue for a free slot:
+        they are rejected with 429 when the queue is full and with 503 when they wait longer than `timeout` seconds.
+    '''
+
+    def __init__(self, name, concurrency, queue_size, timeout):
+        self.name = name
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.waiting = 0
+
+    def check(self):
+        if self.semaphore.locked() and self.waiting >= self.queue_size:
+            raise HTTPException(status_code=429, detail=f"Too many pending requests for '{self.name}'")
+
+    @asynccontextmanager
+    async def slot(self):
+        self.check()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail=f"Timed out waiting for '{self.name}'")
+        finally:
+            self.waiting -= 1
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+
+
+cpu_workers = int(os.getenv("INFRANG_CPU_WORKERS", os.cpu_count()))
+cpu_executor = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix="infrang-cpu")
+io_executor = ThreadPoolExecutor(max_workers=int(os.getenv("INFRANG_IO_WORKERS", 8)), thread_name_prefix="infrang-io")
+queue_size = int(os.getenv("INFRANG_QUEUE_SIZE", 64))
+queue_timeout = float(os.getenv("INFRANG_QUEUE_TIMEOUT", 30))
+limits = {
+    "retrieval": StageLimiter("retrieval", int(os.getenv("INFRANG_MAX_RETRIEVALS", cpu_workers)), queue_size, queue_timeout),
+    "generation": StageLimiter("generation", int(os.getenv("INFRANG_MAX_GENERATIONS", 32)), queue_size, queue_timeout),
+    "ingestion": StageLimiter("ingestion", int(os.getenv("INFRANG_MAX_INGESTIONS", 2)), queue_size, queue_timeout),
+}
+
+
+# Background ingestion jobs
+class JobManager:
+    '''
+        Runs create / update operations in the background and keeps their progress in `data/jobs`.
+        Jobs that were queued or running when the server stopped are resumed as updates on startup:
+        the manifest of the collection records every stored source, so only the remaining sources are ingested.
+        A collection has at most one pending or running ingestion: a job or a synchronous operation that changes
+        it (see `exclusive`) is rejected with 409 while another one is pending or running.
+    '''
+
+    FINISHED = ("completed", "failed", "cancelled")
+
+    def __init__(self, max_workers=2, max_queued=64, path=os.path.join('data', 'jobs')):
+        self.path = path
+        self.max_queued = max_queued
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="infrang-job")
+        self.jobs = {}
+        self.cancel_events = {}
+        self.owners = {} # collection -> the job or operation that changes it
+        self.lock = threading.RLock()
+        self.closing = False
+
+    def __claim(self, collection, owner):
+        with self.lock:
+            if collection in self.owners:
+                raise HTTPException(status_code=409,
+                                    detail=f"An ingestion of '{collection}' is already pending or running")
+            self.owners[collection] = owner
+
+    def __release(self, collection, owner):
+        with self.lock:
+            if self.owners.get(collection) == owner:
+                del self.owners[collection]
+
+    @contextmanager
+    def exclusive(self, collection):
+        '''
+            Claims the collection for a synchronous operation that changes it.
+        '''
+
+        owner = uuid.uuid4().hex
+        self.__claim(collection, owner)
+        try:
+            yield
+        finally:
+            self.__release(collection, owner)
+
+    def __save(self, job):
+        os.makedirs(self.path, exist_ok=True)
+        path = os.path.join(self.path, job["id"] + ".json")
+        with open(path + ".tmp", "w") as fw:
+            json.dump(job, fw)
+        os.replace(path + ".tmp", path)
+
+    def __run(self, job):
+        try:
+            self.__ingest(job)
+        finally:
+            self.__release(job["collection"], job["id"])
+
+    def __ingest(self, job):
+        if self.cancel_events[job["id"]].is_set():
+            return
+        job.update(status="running", started=time.time())
+        self.__save(job)
+        last_saved = 0
+
+        def progress(stats):
+            nonlocal last_saved
+            job["progress"].update(stats)
+            if time.time() - last_saved > 1:
+                last_saved = time.time()
+                self.__save(job)
+
+        try:
+            infrang = pool.get(job["collection"], InfrangConfig(**job["config"]))
+            if job["kind"] == "create":
+                infrang.create(kb_path=job["path"], overwrite=job["overwrite"],
+                               progress=progress, cancel=self.cancel_events[job["id"]])
+            else:
+                infrang.update(kb_path=job["path"], progress=progress, cancel=self.cancel_events[job["id"]])
+            if not self.cancel_events[job["id"]].is_set():
+                job["status"] = "completed"
+            else:
+                # stopped by a shutdown: left unfinished so that it resumes on the next startup
+                job["status"] = "interrupted" if self.closing else "cancelled"
+        except Exception as e:
+            logger.error(f"Error on job '{job['id']}': {str(e)}")
+            job.update(status="failed", error=str(e))
+        job["finished"] = time.time()
+        self.__save(job)
+
+    def __enqueue(self, job):
+        self.__claim(job["collection"], job["id"])
+        self.jobs[job["id"]] = job
+        self.cancel_events[job["id"]] = threading.Event()
+        self.__save(job)
+        self.executor.submit(self.__run, job)
+
+    def submit(self, kind, collection, path, config: InfrangConfig, overwrite=False):
+        with self.lock:
+            if sum(job["status"] == "queued" for job in self.jobs.values()) >= self.max_queued:
+                raise HTTPException(status_code=429, detail="Too many queued ingestion jobs")
+            job = {
+                "id": uuid.uuid4().hex,
+                "kind": kind,
+                "collection": collection,
+                "path": path,
+                "overwrite": overwrite,
+                "config": config.model_dump(exclude={"groq_api_key"}), # never store keys on disk
+                "status": "queued",
+                "created": time.time(),
+                "started": None,
+                "finished": None,
+                "progress": {"documents_total": None, "documents_done": 0, "chunks_embedded": 0,
+                             "chunks_deduplicated": 0, "bytes_deduplicated": 0},
+                "error": None,
+            }
+            self.__enqueue(job)
+            return job["id"]
+
+    def status(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        job = dict(job)
+        progress = job["progress"]
+        elapsed = (job["finished"] or time.time()) - job["started"] if job["started"] else 0
+        job["elapsed"] = elapsed
+        job["throughput"] = {
+            "documents_per_second": progress["documents_done"] / elapsed if elapsed else None,
+            "chunks_per_second": progress["chunks_embedded"] / elapsed if elapsed else None,
+        }
+        job["eta"] = None
+        if job["status"] == "running" and progress["documents_total"] and progress["documents_done"]:
+            job["eta"] = (progress["documents_total"] - progress["documents_done"]) \
+                * elapsed / progress["documents_done"]
+        return job
+
+    def list(self):
+        return [self.status(job_id) for job_id in self.jobs]
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        if job["status"] not in self.FINISHED:
+            self.cancel_events[job_id].set()
+            if job["status"] == "queued":
+                job.update(status="cancelled", finished=time.time())
+                self.__save(job)
+                self.__release(job["collection"], job_id)
+        return job
+
+    def resume(self):
+        if not os.path.exists(self.path):
+            return
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith(".json"):
+                continue
+            with open(os.path.join(self.path, name)) as fr:
+                job = json.load(fr)
+            if job["status"] in self.FINISHED:
+                self.jobs[job["id"]] = job
+                continue
+            logger.info(f"Resuming job '{job['id']}' of '{job['collection']}'")
+            job.update(kind="update", status="queued", started=None)
+            try:
+                self.__enqueue(job)
+            except HTTPException: # stored before the ingestions of a collection were serialized
+                logger.warning(f"Not resuming job '{job['id']}': another job of '{job['collection']}' is resumed")
+                job.update(status="cancelled", finished=time.time(), error="Another job of the collection was resumed")
+                self.jobs[job["id"]] = job
+                self.__save(job)
+
+    def close(self):
+        self.closing = True
+        for event in self.cancel_events.values():
+            event.set()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+jobs = JobManager(
+    max_workers=int(os.getenv("INFRANG_MAX_INGESTIONS", 2)),
+    max_queued=queue_size,
+)
+
+
+async def run_in(executor, func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(func, *args, **kwargs))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    for collection in filter(None, os.getenv("INFRANG_PRELOAD", "").split(",")):
+        infrang = await run_in(io_executor, pool.get, collection.strip(), InfrangConfig())
+        await run_in(io_executor, infrang.warmup)
+    jobs.resume()
+    yield
+    jobs.close()
+    cpu_executor.shutdown(wait=False, cancel_futures=True)
+    io_executor.shutdown(wait=True, cancel_futures=True)
+    pool.close()
+
+
+app = FastAPI(title="Infrang API", version=version, lifespan=lifespan)
 
 
 @app.get("/")
@@ -69,8 +459,8 @@ async def get_sources(
     if config is None:
         config = InfrangConfig()
     try:
-        infrang = get_infrang_instance(collection, config)
-        sources = infrang.get_sources()
+        infrang = await run_in(io_executor, pool.get, collection, config)
+        sources = await run_in(io_executor, infrang.get_sources)
         return {
             "message": "Sources of {}".format(collection),
             "collection" : collection,
@@ -87,19 +477,32 @@ async def create_collection(
     collection: str,
     path: str,
     config: InfrangConfig = None,
-    overwrite: bool = False
+    overwrite: bool = False,
+    wait: bool = False
 ):
     
     if config is None:
         config = InfrangConfig()
     try:
-        infrang = get_infrang_instance(collection, config)
-        infrang.create(kb_path=path, overwrite=overwrite)
+        if not wait:
+            job_id = jobs.submit("create", collection, path, config, overwrite=overwrite)
+            return JSONResponse(status_code=202, content={
+                "message": "Database creation started",
+                "collection": collection,
+                "path": path,
+                "job_id": job_id
+            })
+        infrang = await run_in(io_executor, pool.get, collection, config)
+        with jobs.exclusive(collection):
+            async with limits["ingestion"].slot():
+                await run_in(io_executor, infrang.create, kb_path=path, overwrite=overwrite)
         return {
             "message": "Database created successfully",
             "collection": collection,
             "path": path
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error on 'create': {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -110,24 +513,126 @@ async def create_collection(
 async def update_collection(
     collection: str, 
     path: str, 
-    config: InfrangConfig = None
+    config: InfrangConfig = None,
+    wait: bool = False
 ):
     
     if config is None:
         config = InfrangConfig()
     try:
-        infrang = get_infrang_instance(collection, config)
-        infrang.update(kb_path=path)
+        if not wait:
+            job_id = jobs.submit("update", collection, path, config)
+            return JSONResponse(status_code=202, content={
+                "message": "Database update started",
+                "collection": collection,
+                "path": path,
+                "job_id": job_id
+            })
+        infrang = await run_in(io_executor, pool.get, collection, config)
+        with jobs.exclusive(collection):
+            async with limits["ingestion"].slot():
+                await run_in(io_executor, infrang.update, kb_path=path)
         return {
             "message": "Database updated successfully",
             "collection": collection,
             "path": path
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error on 'update': {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Export a database/collection to a snapshot archive
+@app.post("/snapshots/{collection}/export/{path:path}")
+async def export_snapshot(
+    collection: str,
+    path: str,
+    config: InfrangConfig = None
+):
+    if config is None:
+        config = InfrangConfig()
+    try:
+        infrang = await run_in(io_executor, pool.get, collection, config)
+        async with limits["ingestion"].slot():
+            result = await run_in(io_executor, infrang.export_snapshot, path=path, timings=True)
+        return {
+            "message": "Snapshot exported successfully",
+            "collection": collection,
+            "path": path,
+            "result": result
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error on 'export': {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Create a database/collection from a snapshot archive
+@app.post("/snapshots/{collection}/import/{path:path}")
+async def import_snapshot(
+    collection: str,
+    path: str,
+    config: InfrangConfig = None,
+    overwrite: bool = False
+):
+    if config is None:
+        config = InfrangConfig()
+    try:
+        infrang = await run_in(io_executor, pool.get, collection, config)
+        with jobs.exclusive(collection):
+            async with limits["ingestion"].slot():
+                result = await run_in(io_executor, infrang.import_snapshot, path=path, overwrite=overwrite, timings=True)
+        if result is None:
+            raise HTTPException(status_code=409, detail=f"Collection '{collection}' exists already")
+        return {
+            "message": "Snapshot imported successfully",
+            "collection": collection,
+            "path": path,
+            "result": result
+        }
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error on 'import': {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# List the ingestion jobs
+@app.get("/jobs")
+async def get_jobs():
+    return {
+        "message": "List of jobs",
+        "jobs": jobs.list()
+    }
+
+
+# Get the progress of an ingestion job
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+# Cancel an ingestion job
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return {
+        "message": "Job cancellation requested",
+        "job_id": job_id,
+        "status": job["status"]
+    }
+
+
 # Delete a collection
 @app.delete("/collections/{collection}")
 async def delete_collection(
@@ -137,39 +642,281 @@ async def delete_collection(
     if config is None:
         config = InfrangConfig()
     try:
-        infrang = get_infrang_instance(collection, config)
-        infrang.delete()
+        infrang = await run_in(io_executor, pool.get, collection, config)
+        with jobs.exclusive(collection):
+            await run_in(io_executor, infrang.delete)
         return {
             "message": "Collection deleted successfully",
             "collection": collection
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error on 'delete': {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Retrieval options of the search and answer endpoints
+def search_options(
+    limit: int = Query(4, description="Number of retrieved chunks"),
+    dense_limit: Optional[int] = Query(None, description="Number of candidates of the dense search"),
+    sparse_limit: Optional[int] = Query(None, description="Number of candidates of the sparse search"),
+    score_threshold: Optional[float] = Query(None, description="Minimum fused score of a retrieved chunk"),
+    sources: Optional[list[str]] = Query(None, description="Only the chunks of these sources are searched"),
+    hnsw_ef: Optional[int] = Query(None, description="Size of the candidate list of the HNSW search"),
+    spell_check: bool = Query(True, description="Whether the spelling of the query is corrected"),
+    rewrite: bool = Query(True, description="Whether the query is paraphrased"),
+):
+    return {
+        "limit": limit,
+        "dense_limit": dense_limit,
+        "sparse_limit": sparse_limit,
+        "score_threshold": score_threshold,
+        "sources": sources,
+        "hnsw_ef": hnsw_ef,
+        "spell_check": spell_check,
+        "rewrite": rewrite,
+    }
+
+
+# Retrieve the most relevant chunks without generating an answer
+@app.post("/search/{collection}")
+async def search_collection(
+    collection: str,
+    query: str = Query(..., description="The query for searching"),
+    timings: bool = Query(False, description="Whether to return the duration of each stage"),
+    options: dict = Depends(search_options),
+    config: InfrangConfig = None
+):
+    if config is None:
+        config = InfrangConfig()
+
+    try:
+        infrang = await run_in(io_executor, pool.get, collection, config)
+        async with limits["retrieval"].slot():
+            result = await run_in(cpu_executor, infrang.search, query, timings=timings, **options)
+        return {
+            "collection": collection,
+            "query": query,
+            "result": result
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Search error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 # Perform semantic search and generate answer
 @app.post("/answer/{collection}")
 async def answer_query(
     collection: str,
     query: str = Query(..., description="The query for searching and answering"),
+    timings: bool = Query(False, description="Whether to return the duration of each stage"),
+    options: dict = Depends(search_options),
     config: InfrangConfig = None
 ):
     if config is None:
         config = InfrangConfig()
     
     try:
-        infrang = get_infrang_instance(collection, config)
-        result = infrang.answer(query=query)
+        infrang = await run_in(io_executor, pool.get, collection, config)
+        result = None
+        if query:
+            timer = StageTimer("answer")
+            async with limits["retrieval"].slot():
+                hit = await run_in(cpu_executor, infrang.lookup_answer, query, timer=timer, options=options)
+                if hit is None:
+                    rewritten, results = await run_in(cpu_executor, infrang.retrieve, query, timer=timer, **options)
+            if hit is not None:
+                result = dict(hit["result"], cache=hit["cache"])
+            else:
+                async with limits["generation"].slot():
+                    result = await infrang.agenerate(rewritten, results, original_query=query, timer=timer,
+                                                     options=options)
+            if timings: # a copy, the result is held by the answer cache
+                result = dict(result, timings=timer.timings)
         return {
             "collection": collection,
             "query": query,
             "result": result
         }
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Answer error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+
+# Search many collections with one query and generate one answer
+@app.post("/answer")
+async def answer_query_federated(
+    query: str = Query(..., description="The query for searching and answering"),
+    collections: list[str] = Body(..., description="The collections to search"),
+    timings: bool = Query(False, description="Whether to return the duration of each stage"),
+    options: dict = Depends(search_options),
+    config: InfrangConfig = None
+):
+    if config is None:
+        config = InfrangConfig()
+    if not collections:
+        raise HTTPException(status_code=400, detail="No collections given")
+
+    try:
+        # the instance of the first collection rewrites, embeds and searches for all of them
+        infrang = await run_in(io_executor, pool.get, collections[0], config)
+        timer = StageTimer("answer_federated")
+        async with limits["retrieval"].slot():
+            rewritten, results = await run_in(cpu_executor, infrang.retrieve_federated, query, collections,
+                                              timer=timer, **options)
+        async with limits["generation"].slot():
+            result = await infrang.agenerate(rewritten, results, timer=timer)
+        result["sources"] = [
+            {"collection": item["collection"], "source": item["metadata"]["source"], "score": item["score"]}
+            for item in results
+        ]
+        if timings:
+            result["timings"] = timer.timings
+        return {
+            "collections": collections,
+            "query": query,
+            "result": result
+        }
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"Answer error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Answer many queries with batched retrieval
+@app.post("/answer/{collection}/batch")
+async def answer_queries(
+    collection: str,
+    queries: list[str] = Body(..., description="The queries for searching and answering"),
+    concurrency: int = Query(8, description="Maximum number of parallel generations"),
+    timings: bool = Query(False, description="Whether to return the duration of each stage"),
+    options: dict = Depends(search_options),
+    config: InfrangConfig = None
+):
+    if config is None:
+        config = InfrangConfig()
+
+    try:
+        infrang = await run_in(io_executor, pool.get, collection, config)
+        timer = StageTimer("answer_batch")
+        results = [None] * len(queries)
+        # the cache lookups and the batched retrieval run locally, the answers are generated like single answers
+        async with limits["retrieval"].slot():
+            indexes = [index for index, query in enumerate(queries) if query]
+            hits = dict(zip(indexes, await run_in(cpu_executor, infrang.lookup_answers,
+                                                  [queries[index] for index in indexes], timer=timer, options=options)))
+            pending = [index for index in indexes if hits[index] is None]
+            retrieved = await run_in(cpu_executor, infrang.retrieve_batch, [queries[index] for index in pending],
+                                     timer=timer, **options) if pending else []
+        for index, hit in hits.items():
+            if hit is not None:
+                results[index] = dict(hit["result"], cache=hit["cache"])
+        parallel = asyncio.Semaphore(max(concurrency, 1))
+
+        async def generate(index, rewritten, context):
+            async with parallel:
+                try:
+                    async with limits["generation"].slot():
+                        return await infrang.agenerate(rewritten, context, original_query=queries[index],
+                                                       timer=timer, options=options)
+                except Exception as e:
+                    return {"error": str(e)}
+
+        for index, result in zip(pending, await asyncio.gather(
+                *(generate(index, rewritten, context) for index, (rewritten, context) in zip(pending, retrieved)))):
+            results[index] = result
+        if timings:
+            results = [dict(result, timings=timer.timings) if result is not None else None for result in results]
+        return {
+            "collection": collection,
+            "results": [{"query": query, "result": result} for query, result in zip(queries, results)]
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Answer error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Perform semantic search and stream the generated answer as Server-Sent Events
+@app.post("/answer/{collection}/stream")
+async def answer_query_stream(
+    collection: str,
+    query: str = Query(..., description="The query for searching and answering"),
+    options: dict = Depends(search_options),
+    config: InfrangConfig = None
+):
+    if config is None:
+        config = InfrangConfig()
+
+    try:
+        infrang = await run_in(io_executor, pool.get, collection, config)
+        async with limits["retrieval"].slot():
+            hit = await run_in(cpu_executor, infrang.lookup_answer, query, options=options)
+            if hit is None:
+                limits["generation"].check()
+                rewritten, results = await run_in(cpu_executor, infrang.retrieve, query, **options)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Answer error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+    async def events():
+        if hit is not None:
+            for event in Infrang.cached_events(hit):
+                yield "event: {}\ndata: {}\n\n".format(event['event'], json.dumps(event['data']))
+            return
+        try:
+            async with limits["generation"].slot():
+                async for event in infrang.agenerate_stream(rewritten, results, original_query=query,
+                                                                options=options):
+                    yield "event: {}\ndata: {}\n\n".format(event['event'], json.dumps(event['data']))
+        except Exception as e:
+            logger.error(f"Answer error: {str(e)}")
+            yield "event: error\ndata: {}\n\n".format(json.dumps(str(e)))
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+# Latency histograms of every stage in the Prometheus text format
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# Statistics of the answer cache
+@app.get("/cache")
+async def get_cache():
+    return {
+        "message": "Answer cache statistics",
+        "enabled": answer_cache is not None,
+        "stats": answer_cache.stats() if answer_cache is not None else None,
+        "embeddings": {
+            "{} + {}".format(key[0], key[1]): service.stats()
+            for key, service in list(EmbeddingService.instances.items())
+        },
+    }
+
+
+# Clear the answer cache
+@app.delete("/cache")
+async def clear_cache():
+    if answer_cache is not None:
+        answer_cache.clear()
+    return {
+        "message": "Answer cache cleared"
+    }
+
+
 if __name__ == '__main__':
     uvicorn.run(app, host="127.0.0.1", port=7456)
\ No newline at end of file
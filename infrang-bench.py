@@ -0,0 +1,441 @@
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+FILETYPES = ('txt', 'md', 'csv', 'json', 'xml', 'pdf', 'docx', 'xlsx')
+WORDS = '''
+    abstraction algorithm array binary boolean buffer cache class closure compiler concurrency constructor
+    database decorator dictionary exception expression function generator hash heap index inheritance integer
+    interface iterator kernel lambda library list loop memory method module network object operator package
+    parameter pointer process protocol queue recursion reference register scheduler scope socket stack string
+    syntax thread tuple type variable vector
+'''.split()
+
+
+# Synthetic knowledge base
+def sentence(rng, words=12):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def paragraphs(rng, count):
+    return [' '.join(sentence(rng) for _ in range(5)) for _ in range(count)]
+
+
+def write_pdf(path, lines):
+    # a minimal single-font PDF with one page per 40 lines
+    pages = [lines[i:i+40] for i in range(0, len(lines), 40)] or [[]]
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>', None, '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for page in pages:
+        text = ' '.join('({}) Tj T*'.format(line.replace('\\', '').replace('(', '').replace(')', '')) for line in page)
+        stream = 'BT /F1 10 Tf 12 TL 40 800 Td {} ET'.format(text)
+        objects.append('<< /Length {} >>\nstream\n{}\nendstream'.format(len(stream), stream))
+        objects.append('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+                       '/Resources << /Font << /F1 3 0 R >> >> /Contents {} 0 R >>'.format(len(objects)))
+        kids.append('{} 0 R'.format(len(objects)))
+    objects[1] = '<< /Type /Pages /Kids [{}] /Count {} >>'.format(' '.join(kids), len(kids))
+    body, offsets = '%PDF-1.4\n', []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(body))
+        body += '{} 0 obj\n{}\nendobj\n'.format(number, obj)
+    xref = len(body)
+    body += 'xref\n0 {}\n0000000000 65535 f \n'.format(len(objects) + 1)
+    body += ''.join('{:010d} 00000 n \n'.format(offset) for offset in offsets)
+    body += 'trailer\n<< /Size {} /Root 1 0 R >>\nstartxref\n{}\n%%EOF\n'.format(len(objects) + 1, xref)
+    with open(path, 'w', encoding='latin-1') as fw:
+        fw.write(body)
+
+
+def write_docx(path, lines):
+    document = ''.join('<w:p><w:r><w:t>{}</w:t></w:r></w:p>'.format(escape(line)) for line in lines)
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('[Content_Types].xml',
+            '<?xml version="1.0" encoding="UTF-8"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/></Types>')
+        zf.writestr('_rels/.rels',
+            '<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="word/document.xml"/></Relationships>')
+        zf.writestr('word/document.xml',
+            '<?xml version="1.0" encoding="UTF-8"?><w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            '<w:body>{}</w:body></w:document>'.format(document))
+
+
+def write_xlsx(path, rows):
+    sheet = ''.join(
+        '<row r="{}">{}</row>'.format(number, ''.join(
+            '<c r="{}{}" t="inlineStr"><is><t>{}</t></is></c>'.format(chr(65 + column), number, escape(value))
+            for column, value in enumerate(row)))
+        for number, row in enumerate(rows, start=1))
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('[Content_Types].xml',
+            '<?xml version="1.0" encoding="UTF-8"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/></Types>')
+        zf.writestr('_rels/.rels',
+            '<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="xl/workbook.xml"/></Relationships>')
+        zf.writestr('xl/workbook.xml',
+            '<?xml version="1.0" encoding="UTF-8"?><workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>')
+        zf.writestr('xl/_rels/workbook.xml.rels',
+            '<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+            'Target="worksheets/sheet1.xml"/></Relationships>')
+        zf.writestr('xl/worksheets/sheet1.xml',
+            '<?xml version="1.0" encoding="UTF-8"?><worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            '<sheetData>{}</sheetData></worksheet>'.format(sheet))
+
+
+def write_document(path, filetype, rng, size):
+
+    text = paragraphs(rng, size)
+    if filetype in ('txt', 'md'):
+        with open(path, 'w') as fw:
+            fw.write('\n\n'.join(('## ' + sentence(rng, 4) + '\n\n' if filetype == 'md' else '') + p for p in text))
+    elif filetype == 'csv':
+        with open(path, 'w') as fw:
+            fw.write('id,term,description\n')
+            fw.write(''.join('{},{},"{}"\n'.format(i, rng.choice(WORDS), p) for i, p in enumerate(text)))
+    elif filetype == 'json':
+        with open(path, 'w') as fw:
+            json.dump([{'id': i, 'text': p} for i, p in enumerate(text)], fw, indent=1)
+    elif filetype == 'xml':
+        with open(path, 'w') as fw:
+            fw.write('<items>{}</items>'.format(''.join('<item>{}</item>'.format(escape(p)) for p in text)))
+    elif filetype == 'pdf':
+        write_pdf(path, [line for p in text for line in (p[i:i+90] for i in range(0, len(p), 90))])
+    elif filetype == 'docx':
+        write_docx(path, text)
+    elif filetype == 'xlsx':
+        write_xlsx(path, [('id', 'text')] + [(str(i), p) for i, p in enumerate(text)])
+
+
+def build_knowledge_base(path, docs, filetypes, size, seed):
+
+    rng = random.Random(seed)
+    os.makedirs(path, exist_ok=True)
+    for number in range(docs):
+        filetype = filetypes[number % len(filetypes)]
+        write_document(os.path.join(path, 'doc{:05d}.{}'.format(number, filetype)), filetype, rng, size)
+
+
+def build_queries(count, seed):
+    '''
+        Returns `count` distinct queries, so that no query is answered from the caches of an earlier one.
+    '''
+
+    rng = random.Random(seed + 1)
+    size = len(WORDS)
+    return ['What is the {} of the {} in the {}?'.format(WORDS[number // size**2], WORDS[number // size % size],
+                                                          WORDS[number % size])
+            for number in rng.sample(range(size**3), count)]
+
+
+# Local stand-in for the Groq API
+class MockGroqHandler(BaseHTTPRequestHandler):
+
+    latency = 0.2
+    tokens = 32
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        prompt_tokens = sum(len(message.get('content', '').split()) for message in request.get('messages', []))
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': self.tokens,
+            'total_tokens': prompt_tokens + self.tokens,
+            'prompt_time': self.latency / 4,
+            'completion_time': self.latency * 3 / 4,
+            'total_time': self.latency,
+        }
+        base = {'id': 'mock', 'created': int(time.time()), 'model': request.get('model', 'mock')}
+        if not request.get('stream'):
+            time.sleep(self.latency)
+            self.__send(200, 'application/json', json.dumps(dict(base,
+                object='chat.completion',
+                choices=[{'index': 0, 'finish_reason': 'stop',
+                          'message': {'role': 'assistant', 'content': ' '.join(['token'] * self.tokens)}}],
+                usage=usage,
+            )).encode())
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        time.sleep(self.latency / 4)
+        for number in range(self.tokens):
+            time.sleep(self.latency * 3 / 4 / self.tokens)
+            chunk = dict(base, object='chat.completion.chunk',
+                         choices=[{'index': 0, 'delta': {'content': 'token '}, 'finish_reason': None}])
+            if number == self.tokens - 1:
+                chunk['choices'][0]['finish_reason'] = 'stop'
+                chunk['x_groq'] = {'id': 'mock', 'usage': usage}
+            self.wfile.write('data: {}\n\n'.format(json.dumps(chunk)).encode())
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def __send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_mock_groq(latency, tokens):
+
+    MockGroqHandler.latency = latency
+    MockGroqHandler.tokens = tokens
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockGroqHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Measurements
+def peak_rss_mb():
+
+    scale = 1 if sys.platform == 'darwin' else 1024 # ru_maxrss is in bytes on macOS, in KiB elsewhere
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2**20,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 2**20,
+    }
+
+
+def percentiles(values):
+
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'mean': sum(values) / len(values), 'n': len(values)}
+
+
+def measure_ingestion(infrang, kb_path, update=False):
+
+    start = time.perf_counter()
+    if update:
+        stats = infrang.update(kb_path=kb_path, timings=True)
+    else:
+        stats = infrang.create(kb_path=kb_path, overwrite=True, timings=True)
+    elapsed = time.perf_counter() - start
+    if update: # only the changed documents are ingested again
+        documents, chunks = stats['documents_done'], stats['chunks_embedded']
+    else:
+        documents = len(infrang.get_sources())
+        chunks = infrang.database_client.count(infrang.collection, exact=True).count
+    return {
+        'seconds': elapsed,
+        'documents': documents,
+        'chunks': chunks,
+        'docs_per_second': documents / elapsed,
+        'chunks_per_second': chunks / elapsed,
+        'timings': (stats or {}).get('timings'),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def measure_answers(infrang, queries, concurrency):
+
+    latencies, stages = [], {}
+
+    def run(query):
+        start = time.perf_counter()
+        result = infrang.answer(query, timings=True)
+        latencies.append(time.perf_counter() - start)
+        for stage, seconds in result['timings'].items():
+            stages.setdefault(stage, []).append(seconds)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, queries))
+    elapsed = time.perf_counter() - start
+    return {
+        'concurrency': concurrency,
+        'queries_per_second': len(queries) / elapsed,
+        'latency': percentiles(latencies),
+        'stages': {stage: percentiles(values) for stage, values in stages.items()},
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def flatten(data, prefix=''):
+
+    items = {}
+    for key, value in (data.items() if isinstance(data, dict) else enumerate(data)):
+        name = '{}.{}'.format(prefix, key) if prefix else str(key)
+        if isinstance(value, (dict, list)):
+            items.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            items[name] = value
+    return items
+
+
+def compare(results, baseline, tolerance):
+    '''
+        Prints the metrics that changed more than `tolerance` compared to the baseline and returns the regressions.
+        Throughputs regress when they decrease, every other metric (latencies, seconds, memory) when it increases.
+    '''
+
+    current, previous = flatten(results['benchmarks']), flatten(baseline['benchmarks'])
+    regressions = []
+    for name in sorted(set(current) & set(previous)):
+        if not previous[name] or name.endswith(('.n', '.documents', '.chunks', '.concurrency')):
+            continue
+        ratio = current[name] / previous[name]
+        higher_is_better = name.endswith('per_second')
+        regressed = ratio < 1 - tolerance if higher_is_better else ratio > 1 + tolerance
+        improved = ratio > 1 + tolerance if higher_is_better else ratio < 1 - tolerance
+        if regressed or improved:
+            print('{:<9} {:<70} {:>12.4f} -> {:>12.4f} ({:+.1%})'.format(
+                'REGRESSED' if regressed else 'improved', name, previous[name], current[name], ratio - 1))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+                    prog='Infrang benchmark',
+                    description='Benchmarks the ingestion and the query paths of Infrang on a synthetic knowledge base.')
+    parser.add_argument('-n', '--docs', type=int, default=50, help='Number of documents. Default value: 50.')
+    parser.add_argument('-s', '--doc_size', type=int, default=20, help='Paragraphs per document. Default value: 20.')
+    parser.add_argument('-t', '--filetypes', type=str, default=','.join(FILETYPES),
+                        help='Comma separated filetypes of the documents. Default value: {}.'.format(','.join(FILETYPES)))
+    parser.add_argument('-q', '--queries', type=int, default=50, help='Number of queries per concurrency level. Default value: 50.')
+    parser.add_argument('-c', '--concurrency', type=str, default='1,4,16',
+                        help='Comma separated concurrency levels of the answers. Default value: 1,4,16.')
+    parser.add_argument('-l', '--llm_latency', type=float, default=0.2,
+                        help='Latency of the mock Groq server in seconds. Default value: 0.2.')
+    parser.add_argument('-lt', '--llm_tokens', type=int, default=32,
+                        help='Tokens of every answer of the mock Groq server. Default value: 32.')
+    parser.add_argument('-dm', '--dense_model', type=str, default='BAAI/bge-small-en-v1.5', help='The dense model.')
+    parser.add_argument('-sm', '--sparse_model', type=str, default='prithivida/Splade_PP_en_v1', help='The sparse model.')
+    parser.add_argument('-pm', '--paraphrase_model', type=str, default='ramsrigouthamg/t5_paraphraser',
+                        help='The paraphrase model. Use "none" to disable paraphrasing.')
+    parser.add_argument('-pb', '--paraphrase_backend', type=str, default='torch', choices=('torch', 'int8', 'onnx'),
+                        help='The backend of the paraphrase model. Default value: torch.')
+    parser.add_argument('-pt', '--paraphrase_threads', type=int, default=None, help='Threads of the paraphrase backend.')
+    parser.add_argument('-ps', '--paraphrase_skip', type=str, default='never', choices=('never', 'short', 'auto'),
+                        help='Which queries are not paraphrased. Default value: never, so that every query measures the backend.')
+    parser.add_argument('-p', '--parallel', type=int, default=4, help='Number of processes for storing to the database.')
+    parser.add_argument('-w', '--workdir', type=str, default=None,
+                        help='Directory of the knowledge base and the database. Default value: a temporary directory.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data. Default value: 0.')
+    parser.add_argument('-o', '--output', type=str, default='bench_output.json', help='The JSON file of the results.')
+    parser.add_argument('-b', '--baseline', type=str, default=None, help='A previous JSON output to compare against.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative change reported as a regression. Default value: 0.1.')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix='infrang-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    kb_path = os.path.join(os.path.abspath(workdir), 'kb')
+    filetypes = [filetype.strip() for filetype in args.filetypes.split(',') if filetype.strip()]
+    unknown = set(filetypes) - set(FILETYPES)
+    if unknown:
+        parser.error('unsupported filetypes: {}'.format(', '.join(sorted(unknown))))
+
+    server = start_mock_groq(args.llm_latency, args.llm_tokens)
+    os.environ['GROQ_BASE_URL'] = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    os.environ['GROQ_API_KEY'] = 'mock'
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir) # the database is stored in ./data
+    from infrang_core import Infrang
+
+    print('Building the knowledge base in {}...'.format(kb_path))
+    shutil.rmtree(kb_path, ignore_errors=True)
+    build_knowledge_base(kb_path, args.docs, filetypes, args.doc_size, args.seed)
+
+    start = time.perf_counter()
+    infrang = Infrang(
+        collection='infrang_bench',
+        dense_model_name=args.dense_model,
+        sparse_model_name=args.sparse_model,
+        paraphrase_model_name=None if args.paraphrase_model.lower() == 'none' else args.paraphrase_model,
+        parallel=args.parallel,
+        paraphrase_backend=args.paraphrase_backend,
+        paraphrase_threads=args.paraphrase_threads,
+        paraphrase_skip=args.paraphrase_skip,
+    )
+    # the models are loaded on first use otherwise, which the first measured query would pay for
+    benchmarks = {'warmup': infrang.warmup()}
+    benchmarks['init_seconds'] = time.perf_counter() - start
+
+    print('Benchmarking create...')
+    benchmarks['create'] = measure_ingestion(infrang, kb_path)
+
+    print('Benchmarking update...')
+    rng = random.Random(args.seed + 2)
+    changed = sorted(os.listdir(kb_path))[::10]
+    for name in changed:
+        write_document(os.path.join(kb_path, name), name.rsplit('.', 1)[-1], rng, args.doc_size)
+    benchmarks['update'] = measure_ingestion(infrang, kb_path, update=True)
+    benchmarks['update']['changed_documents'] = len(changed)
+
+    infrang.warmup(['spell_checker']) # with the vocabulary of the ingested documents
+    levels = [int(level) for level in args.concurrency.split(',') if level.strip()]
+    # every level gets its own queries, the later levels would hit the query caches of the earlier ones
+    queries = build_queries(args.queries * len(levels), args.seed)
+    benchmarks['answer'] = []
+    for number, concurrency in enumerate(levels):
+        print('Benchmarking answer with concurrency {}...'.format(concurrency))
+        benchmarks['answer'].append(
+            measure_answers(infrang, queries[number * args.queries:(number + 1) * args.queries], concurrency))
+
+    infrang.uninit()
+    server.shutdown()
+
+    results = {
+        'format': 1,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'config': vars(args),
+        'benchmarks': benchmarks,
+    }
+    with open(output, 'w') as fw:
+        json.dump(results, fw, indent=2)
+    print('Results written to {}'.format(output))
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if baseline:
+        with open(baseline) as fr:
+            regressions = compare(results, json.load(fr), args.tolerance)
+        if regressions:
+            print('{} metrics regressed.'.format(len(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
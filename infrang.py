@@ -1,20 +1,53 @@
 
 import argparse
 import getpass
-from infrang_core import Infrang
+from infrang_core import Infrang, Paraphraser
 import dotenv
+import json
 import os
 
 
-def generate_answer(infrang, query, debug, verbose):
-    result = infrang.answer(query=query, debug=debug)
-    print(result['answer']
-    )
+def generate_answer(infrang, query, debug, verbose, options):
+    for event in infrang.answer_stream(query=query, debug=debug, timings=verbose, **options):
+        if event['event'] == 'token':
+            print(event['data'], end='', flush=True)
+        elif event['event'] == 'timings':
+            print()
+            print(event['data'], end='')
+        elif event['event'] == 'usage':
+            print()
+            if verbose:
+                print(event['data'])
+    return
+
+
+def generate_federated_answer(infrang, query, collections, debug, verbose, options):
+    result = infrang.answer_federated(query=query, collections=collections, debug=debug, timings=verbose, **options)
+    print(result['answer'])
+    for source in result['sources']:
+        print('[{}] {}'.format(source['collection'], source['source']))
     if verbose:
+        print(result['timings'])
         print(result['usage'])
     return
 
 
+def search_chunks(infrang, query, debug, verbose, options):
+    result = infrang.search(query=query, debug=debug, timings=verbose, **options)
+    print(json.dumps(result, indent=2))
+    return
+
+
+def generate_answers(infrang, query_file, concurrency, debug, verbose, options):
+    with open(query_file) as fr:
+        queries = [line.strip() for line in fr if line.strip()]
+    for query, result in zip(queries, infrang.answer_batch(queries, concurrency=concurrency, debug=debug, **options)):
+        if not verbose:
+            result = {key: value for key, value in result.items() if key != 'usage'}
+        print(json.dumps(dict(query=query, **result)))
+    return
+
+
 def main():
     
     parser = argparse.ArgumentParser(
@@ -25,19 +58,102 @@ def main():
     parser.add_argument('-c', '--create', type=str, required=False, help='Creates a new database.')
     parser.add_argument('-u', '--update', type=str, required=False, help='Updates the existing database.')
     parser.add_argument('-d', '--delete', action='store_true', help='Deletes the collection.')
+    parser.add_argument('-ex', '--export_snapshot', type=str, required=False,
+                        help='Exports the collection to a snapshot archive at the given path.')
+    parser.add_argument('-im', '--import_snapshot', type=str, required=False,
+                        help='Creates the collection from a snapshot archive without embedding the documents again.')
     parser.add_argument('-ls', '--list-sources', action='store_true', help='Returns the sources of the collection.')
     parser.add_argument('-lc', '--list-collections', action='store_true', help='Returns the collections.')
     parser.add_argument('-q', '--query', type=str, required=False, help='Answers the query based on the collection.')
+    parser.add_argument('-fc', '--federate', type=str, nargs='+', required=False,
+                        help='Answers --query from these collections together with the collection.')
+    parser.add_argument('-sr', '--search', type=str, required=False,
+                        help='Prints the chunks retrieved for the query as JSON without generating an answer.')
+    parser.add_argument('-k', '--limit', type=int, required=False, default=4,
+                        help='Number of retrieved chunks. Default value: 4.')
+    parser.add_argument('--dense_limit', type=int, required=False,
+                        help='Number of candidates of the dense search. Default value: max(limit, 10).')
+    parser.add_argument('--sparse_limit', type=int, required=False,
+                        help='Number of candidates of the sparse search. Default value: max(limit, 10).')
+    parser.add_argument('--score_threshold', type=float, required=False,
+                        help='Minimum fused score of a retrieved chunk.')
+    parser.add_argument('--sources', type=str, nargs='+', required=False,
+                        help='Only the chunks of these sources are searched.')
+    parser.add_argument('--hnsw_ef', type=int, required=False,
+                        help='Size of the candidate list of the HNSW search (server mode).')
+    parser.add_argument('--no_spell_check', action='store_true',
+                        help='Does not correct the spelling of the query. Default value: False.')
+    parser.add_argument('--no_rewrite', action='store_true',
+                        help='Does not paraphrase the query. Default value: False.')
+    parser.add_argument('-qf', '--query_file', type=str, required=False,
+                        help='Answers every line of the file as a query and prints the results as JSON lines.')
+    parser.add_argument('-qc', '--query_concurrency', type=int, required=False, default=8,
+                        help='Number of answers generated in parallel with --query_file. Default value: 8.')
     parser.add_argument('-dm', '--dense_model', type=str, required=False, help='The dense model.',
                         default='BAAI/bge-small-en-v1.5')
     parser.add_argument('-sm', '--sparse_model', type=str, required=False, help='The sparse model.',
                         default='prithivida/Splade_PP_en_v1')
     parser.add_argument('-pm', '--paraphrase_model', type=str, required=False, help='The paraphrase model.',
                         default='ramsrigouthamg/t5_paraphraser')
+    parser.add_argument('-pb', '--paraphrase_backend', type=str, required=False, default='torch',
+                        choices=Paraphraser.BACKENDS, help='The backend of the paraphrase model. Default value: torch.')
+    parser.add_argument('-pt', '--paraphrase_threads', type=int, required=False, default=None,
+                        help='Number of threads of the paraphrase backend. Default value: the backend default.')
+    parser.add_argument('-ps', '--paraphrase_skip', type=str, required=False, default='auto',
+                        choices=Paraphraser.SKIP_POLICIES,
+                        help='Which queries are not paraphrased: never, short or auto (short and well-formed). Default value: auto.')
     parser.add_argument('-gm', '--generative_model', type=str, required=False, help='The generative model.',
                         default='llama-3.3-70b-versatile')
     parser.add_argument('-p', '--parallel', type=int, required=False, default=4, 
                         help='Number of processes for storing to the database. Default value: 4.')
+    parser.add_argument('-ew', '--extract_workers', type=int, required=False, default=None,
+                        help='Number of processes extracting the documents. Default value: the number of CPUs.')
+    parser.add_argument('-fw', '--fetch_workers', type=int, required=False, default=8,
+                        help='Number of threads fetching the links. Default value: 8.')
+    parser.add_argument('-fh', '--fetch_per_host', type=int, required=False, default=4,
+                        help='Maximum number of concurrent requests to the same host. Default value: 4.')
+    parser.add_argument('-fm', '--fetch_max_mb', type=int, required=False, default=50,
+                        help='Links larger than this size in MB are skipped. Default value: 50.')
+    parser.add_argument('-et', '--embed_threads', type=int, required=False, default=None,
+                        help='Number of threads of the embedding models. Default value: the fastembed default.')
+    parser.add_argument('-eb', '--embed_batch_size', type=int, required=False, default=256,
+                        help='Number of documents embedded together. Default value: 256.')
+    parser.add_argument('-du', '--database_url', type=str, required=False, default=None,
+                        help='URL of a Qdrant server. If not provided, it uses QDRANT_URL or else the embedded database.')
+    parser.add_argument('-dk', '--database_api_key', type=str, required=False, default=None,
+                        help='API key of the Qdrant server. If not provided, it uses QDRANT_API_KEY.')
+    parser.add_argument('--hnsw_m', type=int, required=False, default=16,
+                        help='Edges per node of the HNSW index of a new collection. Default value: 16.')
+    parser.add_argument('--hnsw_ef_construct', type=int, required=False, default=100,
+                        help='Neighbours considered while building the HNSW index of a new collection. Default value: 100.')
+    parser.add_argument('--quantization', type=str, required=False, default=None, choices=('scalar', 'binary'),
+                        help='Quantization of the dense vectors of a new collection. Default value: None.')
+    parser.add_argument('--on_disk', action='store_true',
+                        help='Keeps the vectors, index and payloads of a new collection on disk. Default value: False.')
+    parser.add_argument('--shards', type=int, required=False, default=1,
+                        help='Number of shards of a new collection (server mode). Default value: 1.')
+    parser.add_argument('--replicas', type=int, required=False, default=1,
+                        help='Number of replicas of a new collection (server mode). Default value: 1.')
+    parser.add_argument('-in', '--include', type=str, nargs='+', required=False,
+                        help='Glob patterns of the files of the knowledge base that are ingested, e.g. "*.pdf". Default value: every file.')
+    parser.add_argument('-exc', '--exclude', type=str, nargs='+', required=False,
+                        help='Glob patterns of the files and directories of the knowledge base that are not ingested, e.g. "drafts/*".')
+    parser.add_argument('--max_file_mb', type=int, required=False,
+                        help='Files of the knowledge base larger than this are not ingested. Default value: no limit.')
+    parser.add_argument('--follow_symlinks', action='store_true',
+                        help='Follows the symbolic links of the knowledge base. Default value: False.')
+    parser.add_argument('--scan_workers', type=int, required=False, default=8,
+                        help='Number of threads that walk the knowledge base. Default value: 8.')
+    parser.add_argument('-cx', '--context_tokens', type=int, required=False, default=2048,
+                        help='Token budget of the context that is sent to the generative model. Default value: 2048.')
+    parser.add_argument('-cz', '--context_tokenizer', required=False,
+                        help='Hugging Face tokenizer that counts the tokens of the context. If not provided, the tokens are estimated.')
+    parser.add_argument('-bs', '--batch_size', type=int, required=False, default=256,
+                        help='Number of chunks embedded and stored together. Default value: 256.')
+    parser.add_argument('-ct', '--chunk_tokens', type=int, required=False, default=256,
+                        help='Maximum number of tokens of a chunk of a new collection. Default value: 256.')
+    parser.add_argument('-co', '--chunk_overlap', type=int, required=False, default=32,
+                        help='Maximum number of tokens shared by consecutive chunks of a new collection. Default value: 32.')
     parser.add_argument('-o', '--overwrite', action='store_true', 
                         help='Overwrites the existing database. Default value: False.')
     parser.add_argument('-v', '--verbose', action='store_true', 
@@ -48,6 +164,16 @@ def main():
                         help='Shows debugging information. Default value: False.')
 
     args = parser.parse_args()
+    options = {
+        'limit': args.limit,
+        'dense_limit': args.dense_limit,
+        'sparse_limit': args.sparse_limit,
+        'score_threshold': args.score_threshold,
+        'sources': args.sources,
+        'hnsw_ef': args.hnsw_ef,
+        'spell_check': not args.no_spell_check,
+        'rewrite': not args.no_rewrite,
+    }
     dotenv.load_dotenv()
 
     if not args.groq and not dotenv.get_key('.env', 'GROQ_API_KEY'):
@@ -62,6 +188,33 @@ def main():
                 generate_model_name=args.generative_model,
                 parallel=args.parallel,
                 groq_api_key=groq_api_key, # if None, it will be derived from the virtual environment
+                extract_workers=args.extract_workers,
+                fetch_workers=args.fetch_workers,
+                batch_size=args.batch_size,
+                paraphrase_backend=args.paraphrase_backend,
+                paraphrase_threads=args.paraphrase_threads,
+                paraphrase_skip=args.paraphrase_skip,
+                chunk_tokens=args.chunk_tokens,
+                chunk_overlap=args.chunk_overlap,
+                fetch_per_host=args.fetch_per_host,
+                fetch_max_mb=args.fetch_max_mb,
+                embed_threads=args.embed_threads,
+                embed_batch_size=args.embed_batch_size,
+                database_url=args.database_url,
+                database_api_key=args.database_api_key,
+                hnsw_m=args.hnsw_m,
+                hnsw_ef_construct=args.hnsw_ef_construct,
+                quantization=args.quantization,
+                on_disk=args.on_disk,
+                shards=args.shards,
+                replicas=args.replicas,
+                context_tokens=args.context_tokens,
+                context_tokenizer=args.context_tokenizer,
+                include=args.include,
+                exclude=args.exclude,
+                max_file_mb=args.max_file_mb,
+                follow_symlinks=args.follow_symlinks,
+                scan_workers=args.scan_workers,
             )
     
     
@@ -74,6 +227,15 @@ def main():
     elif args.delete: # -d option
         infrang.delete()
         return
+    elif args.export_snapshot: # -ex option
+        if args.collection not in infrang.get_collections():
+            print('Error: Collection does not exist.')
+            return
+        infrang.export_snapshot(path=args.export_snapshot)
+        return
+    elif args.import_snapshot: # -im option
+        infrang.import_snapshot(path=args.import_snapshot, overwrite=args.overwrite)
+        return
     elif args.list_collections:
         _, collections, _ =  next(os.walk(os.path.join('data', 'collection')))
         print(collections)
@@ -83,11 +245,28 @@ def main():
             infrang.get_sources()
         )
         return
+    elif args.query_file: # -qf option
+        if args.collection not in infrang.get_collections():
+            print('Error: Collection does not exist.')
+            return
+        generate_answers(infrang, args.query_file, args.query_concurrency, args.debug, args.verbose, options)
+    elif args.search: # -sr option
+        if args.collection not in infrang.get_collections():
+            print('Error: Collection does not exist.')
+            return
+        search_chunks(infrang, args.search, args.debug, args.verbose, options)
+    elif args.query and args.federate: # -q and -fc options
+        collections = [args.collection] + args.federate
+        missing = set(collections) - set(infrang.get_collections())
+        if missing:
+            print('Error: Collections {} do not exist.'.format(', '.join(sorted(missing))))
+            return
+        generate_federated_answer(infrang, args.query, collections, args.debug, args.verbose, options)
     elif args.query: # -q option
         if args.collection not in infrang.get_collections():
             print('Error: Collection does not exist.')
             return
-        generate_answer(infrang, args.query, args.debug, args.verbose)
+        generate_answer(infrang, args.query, args.debug, args.verbose, options)
     else:  # no option set
         if args.collection not in infrang.get_collections():
             print('Error: Collection does not exist.')
@@ -98,7 +277,7 @@ def main():
             if not query:
                 return
             
-            generate_answer(infrang, query, args.debug, args.verbose)
+            generate_answer(infrang, query, args.debug, args.verbose, options)
 
 if __name__ == '__main__':
     main()
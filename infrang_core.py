@@ -1,16 +1,1629 @@
 
 import os
-from markitdown import MarkItDown
-import markdownify as mdf
-from pdfminer.high_level import extract_text as mine_text
-from qdrant_client import models, QdrantClient
-import torch
-from spellchecker import SpellChecker
-from transformers import T5Tokenizer, T5ForConditionalGeneration
-from groq import Groq
+import bisect
 from urllib.parse import urlparse
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from queue import Empty, Queue
+import numpy as np
+import hashlib
+import io
+import json
+import re
+import shutil
+import tarfile
+import threading
 import time
-import requests
+import uuid
+import zlib
+
+
+def _is_url(src: str):
+
+    result = urlparse(src)
+    return bool(result.netloc and result.scheme)
+
+
+def _file_digest(path):
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fr:
+        for block in iter(lambda: fr.read(2**20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def resident_mb():
+    '''
+        Returns the resident memory of the process in MB, or None where `/proc` is not available.
+    '''
+
+    try:
+        with open('/proc/self/statm') as fr:
+            return int(fr.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError):
+        return None
+
+
+def _files_mb(directory, pattern='*'):
+    '''
+        Returns the size in MB of the files in `directory` that match the glob `pattern` (0 without a directory).
+    '''
+
+    import fnmatch
+    if not directory or not os.path.isdir(directory):
+        return 0.0
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+               if fnmatch.fnmatch(name, pattern) and os.path.isfile(os.path.join(directory, name))) / 2**20
+
+
+def _file_stat(kb_dir, src: str):
+
+    stat = os.stat(os.path.join(kb_dir, src))
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _walk_files(root, include=None, exclude=None, max_bytes=None, follow_symlinks=False, workers=8, errors=None):
+    '''
+        Yields the relative path (with `/` separators), size and mtime of every file below `root` that matches one of
+        the `include` globs and none of the `exclude` globs (`*` also matches `/`). The directories are listed and their
+        files are stat-ed by `workers` threads and the files are yielded while the walk goes on, so that slow (network)
+        file systems are read in parallel. Excluded directories are not entered and files larger than `max_bytes`
+        are skipped. Symbolic links are skipped unless `follow_symlinks`; every directory is entered only once.
+        The paths of the directories and entries that cannot be read are skipped and appended to `errors`.
+    '''
+
+    import fnmatch
+
+    def matches(path, patterns):
+        return any(fnmatch.fnmatchcase(path, pattern) for pattern in patterns)
+
+    def scan(relative):
+        files, directories = [], []
+        with os.scandir(os.path.join(root, relative)) as entries:
+            for entry in entries:
+                path = relative + '/' + entry.name if relative else entry.name
+                try:
+                    if entry.is_symlink() and not follow_symlinks:
+                        continue
+                    if entry.is_dir():
+                        if not (exclude and (matches(path, exclude) or matches(path + '/', exclude))):
+                            stat = entry.stat()
+                            directories.append((path, (stat.st_dev, stat.st_ino)))
+                        continue
+                    if not entry.is_file():
+                        continue
+                    if (include and not matches(path, include)) or (exclude and matches(path, exclude)):
+                        continue
+                    stat = entry.stat()
+                except OSError as e: # e.g. a broken link
+                    print('Skipping source {} : {}'.format(path, e))
+                    if errors is not None:
+                        errors.append(path)
+                    continue
+                if max_bytes and stat.st_size > max_bytes:
+                    print('Skipping source {} : larger than {} bytes'.format(path, max_bytes))
+                    continue
+                files.append((path, stat.st_size, stat.st_mtime_ns))
+        return files, directories
+
+    stat = os.stat(root)
+    visited = {(stat.st_dev, stat.st_ino)}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(scan, ''): ''} # future -> directory
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                directory = pending.pop(future)
+                try:
+                    files, directories = future.result()
+                except OSError as e:
+                    print('Skipping directory : {}'.format(e))
+                    if errors is not None:
+                        errors.append(directory)
+                    continue
+                for path, key in directories:
+                    if key not in visited:
+                        visited.add(key)
+                        pending[executor.submit(scan, path)] = path
+                yield from files
+
+
+_ROWS_PER_BLOCK = 50 # rows of a spreadsheet that are extracted together
+_TEXT_BLOCK = 2**20 # characters of a plain text file that are read together
+_MARKITDOWN = None # per process, reused for every office file
+
+
+_EXTRACTORS = ('markdownify', 'markitdown', 'openpyxl', 'pdfminer.high_level', 'requests') # extraction libraries
+
+
+def _import_extractors():
+    '''
+        Imports the extraction libraries.
+    '''
+
+    import importlib
+    for name in _EXTRACTORS:
+        importlib.import_module(name)
+
+
+def _process_context(start=False):
+    '''
+        Returns the multiprocessing context of the extraction workers. The ingestion runs next to other threads
+        (the embedding batcher, executors and the thread pools of the models), so the workers are not forked from
+        this process, whose locks may be held by those threads. They are forked from a fork server that has only
+        imported the extraction libraries, or spawned where there is no fork server. With `start`, the fork server
+        is started now instead of by the first ingestion.
+    '''
+
+    import multiprocessing
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload([__name__, *_EXTRACTORS]) # no effect once the server runs
+    if start:
+        from multiprocessing import forkserver
+        forkserver.ensure_running()
+    return context
+
+
+def _markitdown():
+
+    global _MARKITDOWN
+    if _MARKITDOWN is None:
+        from markitdown import MarkItDown
+        _MARKITDOWN = MarkItDown()
+    return _MARKITDOWN
+
+
+def _markdown_table(header, rows):
+
+    cell = lambda value: '' if value is None else str(value).replace('|', '\\|').replace('\n', ' ')
+    lines = ['| ' + ' | '.join(cell(value) for value in header) + ' |', '| ' + ' | '.join('---' for _ in header) + ' |']
+    lines.extend('| ' + ' | '.join(cell(value) for value in row) + ' |' for row in rows)
+    return '\n'.join(lines) + '\n\n'
+
+
+def _extract_rows(rows, title=None):
+    '''
+        Yields markdown tables of `_ROWS_PER_BLOCK` rows, each repeating the header (the first row).
+    '''
+
+    header = next(rows, None)
+    if header is None:
+        return
+    block = []
+    for row in rows:
+        block.append(row)
+        if len(block) >= _ROWS_PER_BLOCK:
+            yield ('## {}\n\n'.format(title) if title else '') + _markdown_table(header, block)
+            block, title = [], None
+    if block or title:
+        yield ('## {}\n\n'.format(title) if title else '') + _markdown_table(header, block)
+
+
+def _extract_pieces(path, extension=None, encoding=None):
+    '''
+        Yields the text of the file incrementally as `(text, page)` pairs: page by page for PDFs, block of rows
+        by block of rows for spreadsheets (the page is the sheet name for XLSX) and in blocks for plain text.
+        The other formats are yielded at once. The extraction libraries are imported on first use.
+        The format is given by `extension` or else by the extension of `path`.
+    '''
+
+    extension = extension or path.rsplit('.', 1)[-1].lower()
+    if extension == 'pdf':
+        from pdfminer.high_level import extract_pages
+        from pdfminer.layout import LTTextContainer
+        for number, page in enumerate(extract_pages(path), start=1):
+            yield ''.join(element.get_text() for element in page if isinstance(element, LTTextContainer)) + '\n\n', number
+    elif extension == 'xlsx':
+        from openpyxl import load_workbook
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            for sheet in workbook.worksheets:
+                for text in _extract_rows(sheet.iter_rows(values_only=True), title=sheet.title):
+                    yield text, sheet.title
+        finally:
+            workbook.close()
+    elif extension == 'csv':
+        import csv
+        with open(path, newline='', encoding=encoding) as fr:
+            for text in _extract_rows(csv.reader(fr)):
+                yield text, None
+    elif extension in ('docx', 'pptx'):
+        yield _markitdown().convert(path).text_content, None
+    elif extension == 'html': # downloaded pages
+        import markdownify as mdf
+        with open(path, encoding=encoding or 'utf-8', errors='replace') as fr:
+            yield mdf.markdownify(fr.read()), None
+    elif extension in ('json', 'md', 'txt', 'xml', 'ini'):
+        with open(path, encoding=encoding) as fr:
+            for block in iter(lambda: fr.read(_TEXT_BLOCK), ''):
+                yield block, None
+    else:
+        print('Skipping source {} : Filetype not supported. Only these filetypes are supported:' \
+        'pdf, docx, xlsx, pptx, csv, url, urls, json, md, txt, xml.\n'\
+        .format(os.path.basename(path)))
+
+
+_BOUNDARY = re.compile(r'\n\s*\n|(?<=[.!?])\s+|\n(?=[#|])') # paragraphs, sentences, headings and table rows
+_WHITESPACE = re.compile(r'\s+')
+_UNBROKEN_CHARACTERS = 16 # per token of a chunk: text without boundaries beyond this length is cut (about 4 chunks)
+_FORCED_CHARACTERS = 2 # per token of a chunk: the length of the pieces it is cut into
+_TOKENIZERS = {} # per process, the extraction workers load the tokenizer once
+
+
+def _load_tokenizer(name=None, path=None):
+    '''
+        Returns the tokenizer of the `tokenizer.json` file at `path` (a missing or invalid file raises), or else
+        the Hugging Face tokenizer `name`. If the latter is unavailable, None is returned (token counts are
+        estimated then) and a warning is printed once per process.
+    '''
+
+    key = path or name
+    if key not in _TOKENIZERS:
+        from tokenizers import Tokenizer
+        if path:
+            tokenizer = Tokenizer.from_file(path)
+        else:
+            try:
+                tokenizer = Tokenizer.from_pretrained(name)
+            except Exception as e:
+                print('Warning: Could not load the tokenizer {}, token counts are estimated: {}'.format(name, e))
+                tokenizer = None
+        if tokenizer is not None:
+            tokenizer.no_truncation()
+            tokenizer.no_padding()
+        _TOKENIZERS[key] = tokenizer
+    return _TOKENIZERS[key]
+
+
+def _fastembed_directory(model_name, pattern):
+    '''
+        Returns the directory of a fastembed model in the local fastembed cache (`FASTEMBED_CACHE_PATH`) with a
+        file that matches the glob `pattern`, or None if the model has not been downloaded there.
+    '''
+
+    import fnmatch
+    import tempfile
+    from fastembed import SparseTextEmbedding, TextEmbedding
+    cache_dir = os.getenv('FASTEMBED_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'fastembed_cache'))
+    names = {model_name.lower()}
+    for model in TextEmbedding.list_supported_models() + SparseTextEmbedding.list_supported_models():
+        if model['model'].lower() == model_name.lower() and (model.get('sources') or {}).get('hf'):
+            names.add(model['sources']['hf'].lower()) # the repository the model is downloaded from
+    # Hugging Face snapshots (models--<org>--<name>/snapshots/<revision>) and archives (fast-<name>)
+    directories = {'models--' + name.replace('/', '--') for name in names} | \
+        {'fast-' + name.split('/')[-1] for name in names}
+    for directory, _, files in os.walk(cache_dir):
+        if fnmatch.filter(files, pattern) and \
+            any(part.lower() in directories for part in os.path.relpath(directory, cache_dir).split(os.sep)):
+            return directory
+    return None
+
+
+def _fastembed_tokenizer(model_name):
+    '''
+        Returns the path of the `tokenizer.json` of a fastembed model in the local fastembed cache, or None if the
+        model has not been downloaded there.
+    '''
+
+    directory = _fastembed_directory(model_name, 'tokenizer.json')
+    return os.path.join(directory, 'tokenizer.json') if directory else None
+
+
+def _count_tokens(tokenizer, texts):
+
+    if tokenizer is None:
+        return [max(1, len(text) // 4) for text in texts]
+    return [len(encoding.ids) for encoding in tokenizer.encode_batch(texts, add_special_tokens=False)]
+
+
+def _split_tokens(tokenizer, text, tokens, overlap):
+    '''
+        Splits a text without boundaries into windows of `tokens` tokens. Returns their character offsets.
+    '''
+
+    step = max(1, tokens - overlap)
+    if tokenizer is None:
+        return [(offset, min(offset + tokens * 4, len(text))) for offset in range(0, len(text), step * 4)]
+    offsets = tokenizer.encode(text, add_special_tokens=False).offsets
+    return [(offsets[i][0], offsets[min(i + tokens, len(offsets)) - 1][1]) for i in range(0, len(offsets), step)]
+
+
+def _split_units(text, start=0):
+    '''
+        Splits the text into sentences (or table rows), each with its trailing whitespace and the strength of the
+        boundary that follows it: 1 for a sentence, 2 for a paragraph and 3 before a heading. Boundaries are only
+        searched from `start` on, as the text before it has none. The text after the last boundary may be incomplete,
+        so the end of the split text is returned too; a boundary at the very end may still continue, so it is left.
+    '''
+
+    units, begin = [], 0
+    for match in _BOUNDARY.finditer(text, start):
+        if match.end() == len(text):
+            break
+        separator = match.group()
+        strength = 3 if text.startswith('#', match.end()) else 2 if separator.count('\n') >= 2 else 1
+        units.append((begin, match.end(), strength))
+        begin = match.end()
+    return units, begin
+
+
+def _forced_end(text, start, end):
+    '''
+        Returns where text without boundaries (e.g. pretty-printed or minified JSON, logs) is cut between `start`
+        and `end`: after its last line break in the second half, or else after its last whitespace there, or at `end`.
+    '''
+
+    middle = start + (end - start) // 2
+    cut = text.rfind('\n', middle, end)
+    if cut >= 0:
+        return cut + 1
+    for match in _WHITESPACE.finditer(text, middle, end):
+        cut = match.end()
+    return cut if cut > 0 else end
+
+
+def _chunk_text(pieces, source, tokenizer_file=None, tokens=256, overlap=32):
+    '''
+        Generates chunks of at most `tokens` tokens (counted with the tokenizer of the embedding model in
+        `tokenizer_file`, or estimated from the length of the text without it) from the streamed `(text, page)`
+        pieces of a document. Chunks end at the strongest boundary (heading, paragraph or
+        sentence) that keeps them at least half full and repeat up to `overlap` tokens of the previous chunk.
+        Long text without any of these boundaries (e.g. JSON or logs) is cut at line breaks or whitespace instead.
+        Every chunk has the character offsets `start` and `end` of its text in the document and, when the
+        pieces have pages, its first and last `pages`.
+    '''
+
+    tokenizer = _load_tokenizer(path=tokenizer_file) if tokenizer_file else None
+    buffer, base = '', 0 # the text that is not chunked yet and its offset in the document
+    scanned = 0 # the buffer before this offset has no boundary
+    unbroken, forced = max(tokens, 1) * _UNBROKEN_CHARACTERS, max(tokens, 1) * _FORCED_CHARACTERS
+    page_offsets, page_labels = [], [] # where the pieces with a page start in the document and their pages
+    current, total = [], 0 # the units of the next chunk as (text, start, strength, tokens, page)
+
+    def chunk(units):
+        text = ''.join(unit[0] for unit in units)
+        start = units[0][1] + len(text) - len(text.lstrip())
+        result = {'text': text.strip(), 'source': source, 'start': start, 'end': start + len(text.strip())}
+        if units[0][4] is not None:
+            result['pages'] = [units[0][4], units[-1][4]]
+        return result
+
+    def best_cut():
+        cut, best, filled = len(current), 0, 0
+        for index, unit in enumerate(current, start=1):
+            filled += unit[3]
+            if filled >= tokens / 2 and unit[2] >= best:
+                cut, best = index, unit[2]
+        return cut
+
+    def tail(units):
+        # the last units of the emitted chunk that are repeated by the next one
+        kept, size = [], 0
+        for unit in reversed(units[1:]):
+            if size + unit[3] > overlap:
+                break
+            kept.insert(0, unit)
+            size += unit[3]
+        return kept
+
+    def add(units):
+        nonlocal current, total
+        for unit in units:
+            if unit[3] > tokens: # a sentence longer than a chunk is split by tokens
+                if current:
+                    yield chunk(current)
+                    current, total = [], 0
+                for start, end in _split_tokens(tokenizer, unit[0], tokens, overlap):
+                    yield chunk([(unit[0][start:end], unit[1] + start, unit[2], 0, unit[4])])
+                continue
+            while current and total + unit[3] > tokens:
+                cut = best_cut()
+                yield chunk(current[:cut])
+                kept = current[cut:]
+                repeated = tail(current[:cut])
+                if sum(u[3] for u in repeated + kept) + unit[3] > tokens:
+                    repeated = []
+                current = repeated + kept
+                total = sum(u[3] for u in current)
+            current.append(unit)
+            total += unit[3]
+
+    def page_at(offset):
+        index = bisect.bisect_right(page_offsets, offset) - 1
+        return page_labels[index] if index >= 0 else None
+
+    def units_of(spans):
+        texts = [buffer[start:end] for start, end, _ in spans]
+        counts = _count_tokens(tokenizer, texts) if texts else []
+        return [(texts[i], base + spans[i][0], spans[i][2], counts[i], page_at(base + spans[i][0]))
+                for i in range(len(spans))]
+
+    for piece, page in pieces:
+        if page is not None:
+            page_offsets.append(base + len(buffer))
+            page_labels.append(page)
+        buffer += piece
+        spans, consumed = _split_units(buffer, scanned)
+        while len(buffer) - consumed > unbroken:
+            end = _forced_end(buffer, consumed, consumed + forced)
+            spans.append((consumed, end, 0))
+            consumed = end
+        yield from add(units_of(spans))
+        buffer, base = buffer[consumed:], base + consumed
+        scanned = len(buffer.rstrip()) # a boundary may begin in the trailing whitespace
+        while len(page_offsets) > 1 and page_offsets[1] <= base:
+            page_offsets.pop(0)
+            page_labels.pop(0)
+    if buffer.strip():
+        yield from add(units_of([(0, len(buffer), 2)]))
+    if current:
+        yield chunk(current)
+
+
+def _count_words(text):
+
+    return Counter(re.findall(r"[a-z]+(?:'[a-z]+)?", text.lower()))
+
+
+def _timed(iterable, timings, stage):
+    '''
+        Adds the time spent producing every item of `iterable` to `timings[stage]`.
+    '''
+
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+        yield item
+
+
+def _chunk_hash(text: str):
+    '''
+        Content address of a chunk: the hash of its text with normalized whitespace.
+    '''
+
+    return hashlib.blake2b(' '.join(text.split()).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _tar_add(archive, name: str, data: bytes):
+
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    archive.addfile(info, io.BytesIO(data))
+
+
+def _extract_chunks(kb_dir, src: str, chunking: dict, queue, stop=None, fetcher=None, chunks_per_message=32):
+    '''
+        Extraction stage of the ingestion pipeline. It is a module-level function so that it can run in worker processes.
+        The source is extracted, chunked (according to the `chunking` settings of the collection) and put on the
+        bounded `queue` as `(source, chunks)` messages while it is read, so that memory does not grow with the
+        size of the document. Links are downloaded with `fetcher`. It stops early when the `stop` event is set.
+        Returns its manifest record (content hash, size and mtime), the number of chunks and the word frequencies
+        of its text, or None if it has no text. Every chunk carries its content `hash`.
+    '''
+
+    timings, vocabulary = {}, Counter()
+
+    def observe(pieces):
+        for text, page in pieces:
+            start = time.perf_counter()
+            vocabulary.update(_count_words(text))
+            timings['vocabulary'] = timings.get('vocabulary', 0.0) + time.perf_counter() - start
+            yield text, page
+
+    if _is_url(src):
+        start = time.perf_counter()
+        fetched = fetcher.fetch(src)
+        timings['fetch'] = time.perf_counter() - start
+        pieces = _extract_pieces(fetched['path'], fetched['extension'], fetched['encoding'])
+    else:
+        pieces = _extract_pieces(os.path.join(kb_dir, src))
+    pieces = _timed(pieces, timings, 'extract')
+    chunks = _chunk_text(observe(pieces), source=src,
+        tokenizer_file=chunking.get('tokenizer_file'), tokens=chunking['tokens'], overlap=chunking['overlap'])
+
+    def put(message):
+        start = time.perf_counter()
+        queue.put((src, message)) # blocks while the uploads are behind
+        timings['queue'] = timings.get('queue', 0.0) + time.perf_counter() - start
+
+    count, message = 0, []
+    for chunk in _timed(chunks, timings, 'chunk'):
+        chunk['hash'] = _chunk_hash(chunk['text'])
+        message.append(chunk)
+        if len(message) >= chunks_per_message:
+            if stop is not None and stop.is_set():
+                return None
+            put(message)
+            count, message = count + len(message), []
+    if message:
+        put(message)
+        count += len(message)
+    if not count:
+        return None
+    # the time of the chunk stage includes the stages of the pieces it consumed
+    timings['chunk'] -= sum(timings.get(stage, 0.0) for stage in ('extract', 'vocabulary'))
+
+    if _is_url(src):
+        record = {'hash': fetched['hash'], 'size': fetched['size'], 'mtime': None}
+    else:
+        start = time.perf_counter()
+        size, mtime = _file_stat(kb_dir, src)
+        record = {'hash': _file_digest(os.path.join(kb_dir, src)), 'size': size, 'mtime': mtime}
+        timings['hash'] = timings.get('hash', 0.0) + time.perf_counter() - start
+    record['chunks'] = count
+    record['vocabulary'] = vocabulary
+    record['timings'] = timings
+    return record
+
+
+class Metrics:
+    '''
+        Process-wide latency histograms of the stages of every operation (answer, ingestion, ...).
+        Hooks added with `add_hook` are called with `(operation, stage, start, end)` for every recorded stage,
+        where `start` and `end` are `time.perf_counter()` values, so that external profilers can follow the stages.
+
+        Methods:
+            add_hook
+            remove_hook
+            observe
+            render
+    '''
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self):
+        self.histograms = {}
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def observe(self, operation, stage, start, end):
+
+        seconds = end - start
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                (operation, stage), {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0})
+            for index, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+        for hook in list(self.hooks):
+            hook(operation, stage, start, end)
+
+    def render(self):
+        '''
+            Returns the histograms in the Prometheus text exposition format.
+        '''
+
+        lines = [
+            '# HELP infrang_stage_seconds Latency of the stages of Infrang operations.',
+            '# TYPE infrang_stage_seconds histogram',
+        ]
+        with self.lock:
+            for (operation, stage), histogram in sorted(self.histograms.items()):
+                labels = 'operation="{}",stage="{}"'.format(operation, stage)
+                for bound, count in zip(self.BUCKETS, histogram['buckets']):
+                    lines.append('infrang_stage_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, count))
+                lines.append('infrang_stage_seconds_bucket{{{},le="+Inf"}} {}'.format(labels, histogram['count']))
+                lines.append('infrang_stage_seconds_sum{{{}}} {}'.format(labels, histogram['sum']))
+                lines.append('infrang_stage_seconds_count{{{}}} {}'.format(labels, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class StageTimer:
+    '''
+        Records the time spent in each stage of one operation and reports it to `metrics`.
+    '''
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        '''
+            Adds a duration that was measured elsewhere (e.g. in a worker process).
+        '''
+
+        end = time.perf_counter()
+        with self.lock:
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+        metrics.observe(self.operation, stage, end - seconds, end)
+
+    @contextmanager
+    def stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.timings[stage] = self.timings.get(stage, 0.0) + end - start
+            metrics.observe(self.operation, stage, start, end)
+
+
+class AnswerCache:
+    '''
+        Two-tier cache of generated answers that can be shared between Infrang instances.
+        The exact tier is keyed on the normalized query, the optional semantic tier (with a `similarity`) compares the
+        dense embedding of the query with the cached ones. Both are scoped by collection and model configuration, expire after `ttl` seconds and
+        drop their least recently used entries beyond `max_entries`. Entries are also discarded when the collection
+        changes (its manifest or journal is written by `create`, `update` or removed by `delete`).
+
+        Methods:
+            __init__
+            has
+            get
+            get_many
+            put
+            invalidate
+            clear
+            stats
+    '''
+
+    def __init__(self, max_entries=1024, ttl=3600, similarity=0):
+        '''
+            Params:
+                **max_entries (int):** Maximum number of cached answers. Default value is 1024.
+                **ttl (float):** Seconds an answer is kept. Default value is 3600.
+                **similarity (float):** Minimum cosine similarity for semantic hits (opt-in, e.g. 0.97). Default value is 0, only exact hits.
+        '''
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.entries = OrderedDict()
+        self.counters = {'exact_hits': 0, 'semantic_hits': 0, 'misses': 0, 'evictions': 0}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(query: str):
+        return ' '.join(query.lower().split())
+
+    def __valid(self, entry, version):
+        return entry['version'] == version and time.time() - entry['time'] < self.ttl
+
+    def has(self, scope, query: str, version):
+        '''
+            Returns whether the exact tier holds the query, so that only the other queries are embedded.
+        '''
+
+        with self.lock:
+            entry = self.entries.get((scope, self.normalize(query)))
+            return entry is not None and self.__valid(entry, version)
+
+    def get(self, scope, query: str, version, vector=None):
+        '''
+            Returns the cached entry of the query or None. The semantic tier is only searched with the normalized
+            dense `vector` of the query.
+        '''
+
+        return self.get_many(scope, [query], version, [vector])[0]
+
+    def get_many(self, scope, queries: list[str], version, vectors=None):
+        '''
+            Returns the cached entries (or None) of the queries. The semantic tier is searched for the queries
+            without an exact hit that have a normalized dense vector in `vectors`, with one comparison against
+            all of the cached vectors of the scope.
+        '''
+
+        entries = []
+        with self.lock:
+            keys, matrix = None, None
+            for query, vector in zip(queries, vectors or [None] * len(queries)):
+                key = (scope, self.normalize(query))
+                entry = self.entries.get(key)
+                if entry is not None and self.__valid(entry, version):
+                    self.entries.move_to_end(key)
+                    self.counters['exact_hits'] += 1
+                    entries.append(dict(entry, cache='exact'))
+                    continue
+                if vector is not None and self.similarity:
+                    if keys is None: # the entries are not removed while the lock is held
+                        keys = [other_key for other_key, other in self.entries.items()
+                                if other_key[0] == scope and other['vector'] is not None
+                                and self.__valid(other, version)]
+                        matrix = np.array([self.entries[other_key]['vector'] for other_key in keys]) if keys else None
+                    if matrix is not None:
+                        scores = matrix @ vector
+                        best = int(np.argmax(scores))
+                        if scores[best] >= self.similarity:
+                            self.entries.move_to_end(keys[best])
+                            self.counters['semantic_hits'] += 1
+                            entries.append(dict(self.entries[keys[best]], cache='semantic'))
+                            continue
+                self.counters['misses'] += 1
+                entries.append(None)
+        return entries
+
+    def put(self, scope, query: str, version, result, retrieval=None, vector=None):
+
+        with self.lock:
+            self.entries[(scope, self.normalize(query))] = {
+                'result': result,
+                'retrieval': retrieval,
+                'vector': vector,
+                'version': version,
+                'time': time.time(),
+            }
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def invalidate(self, collection):
+        '''
+            Removes the entries of a collection.
+        '''
+
+        with self.lock:
+            for key in [key for key in self.entries if key[0][0] == collection]:
+                del self.entries[key]
+
+    def clear(self):
+
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+
+        with self.lock:
+            lookups = sum(self.counters[key] for key in ('exact_hits', 'semantic_hits', 'misses'))
+            return dict(
+                self.counters,
+                entries=len(self.entries),
+                hit_rate=(lookups - self.counters['misses']) / lookups if lookups else None,
+            )
+
+
+class Paraphraser:
+    '''
+        Rewrites queries with a T5 paraphrasing model on one of the following backends:
+            torch: fp32 eager PyTorch.
+            int8: PyTorch with the linear layers dynamically quantized to int8.
+            onnx: ONNX Runtime export with KV cache (requires `optimum[onnxruntime]`).
+        The `skip` policy avoids the model for queries that do not benefit from rewriting:
+            never: every query is rewritten.
+            short: queries with fewer than `min_words` words are kept as they are.
+            auto: like `short`, and well-formed questions (an interrogative first word and a final question mark)
+                  are kept as they are too.
+        The duration of every call is reported to `metrics` as operation `paraphrase` and the backend as stage.
+        The model is loaded once per process, backend and number of threads (see `shared`); the `skip` policy of
+        the instance can be overridden per call.
+
+        Methods:
+            shared
+            should_skip
+            paraphrase
+    '''
+
+    instances = {}
+    instances_lock = threading.Lock()
+    BACKENDS = ('torch', 'int8', 'onnx')
+    SKIP_POLICIES = ('never', 'short', 'auto')
+    INTERROGATIVES = {'what', 'which', 'who', 'whom', 'whose', 'when', 'where', 'why', 'how',
+                      'is', 'are', 'was', 'were', 'do', 'does', 'did', 'can', 'could', 'should', 'would', 'will'}
+
+    def __init__(self, model_name, backend='torch', threads=None, skip='auto', min_words=3):
+        if backend not in self.BACKENDS:
+            raise ValueError('Unknown paraphrase backend {}. Valid backends: {}.'.format(backend, ', '.join(self.BACKENDS)))
+        if skip not in self.SKIP_POLICIES:
+            raise ValueError('Unknown paraphrase skip policy {}. Valid policies: {}.'.format(skip, ', '.join(self.SKIP_POLICIES)))
+        self.model_name = model_name
+        self.backend = backend
+        self.threads = threads
+        self.skip = skip
+        self.min_words = min_words
+        import torch
+        from transformers import T5Tokenizer, T5ForConditionalGeneration
+        self.tokenizer = T5Tokenizer.from_pretrained(model_name, legacy=False)
+        if backend == 'onnx':
+            try:
+                import onnxruntime
+                from optimum.onnxruntime import ORTModelForSeq2SeqLM
+            except ImportError:
+                raise ImportError('The onnx paraphrase backend requires optimum: pip install optimum[onnxruntime]')
+            session_options = onnxruntime.SessionOptions()
+            if threads:
+                session_options.intra_op_num_threads = threads
+            self.model = ORTModelForSeq2SeqLM.from_pretrained(
+                model_name, export=True, use_cache=True, session_options=session_options)
+        else:
+            if threads:
+                torch.set_num_threads(threads) # process-wide setting of PyTorch
+            self.model = T5ForConditionalGeneration.from_pretrained(model_name)
+            self.model.eval()
+            if backend == 'int8':
+                self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.memory_mb = self.__model_mb()
+
+    def __model_mb(self):
+        '''
+            Returns the size of the weights of the model in MB: the tensors of a PyTorch model or the files of
+            an ONNX export.
+        '''
+
+        if self.backend == 'onnx':
+            return _files_mb(getattr(self.model, 'model_save_dir', None), '*.onnx*')
+
+        def size(value):
+            if isinstance(value, (tuple, list)): # the packed weights of the int8 layers
+                return sum(size(item) for item in value)
+            return value.numel() * value.element_size() if hasattr(value, 'element_size') else 0
+
+        return sum(size(value) for value in self.model.state_dict().values()) / 2**20
+
+    @classmethod
+    def shared(cls, model_name, backend='torch', threads=None):
+        '''
+            Returns the paraphraser of the process for this model, backend and number of threads, loading it on
+            first use.
+        '''
+
+        key = (model_name, backend, threads)
+        with cls.instances_lock:
+            if key not in cls.instances:
+                cls.instances[key] = cls(model_name, backend=backend, threads=threads)
+            return cls.instances[key]
+
+    def should_skip(self, query: str, skip=None):
+
+        skip = skip or self.skip
+        words = query.split()
+        if skip == 'never':
+            return False
+        if len(words) < self.min_words:
+            return True
+        return skip == 'auto' and words[0].lower() in self.INTERROGATIVES and query.rstrip().endswith('?')
+
+    def paraphrase(self, queries: list[str], num_responses=1, max_length=64, batch_size=16, skip=None):
+        '''
+            Returns `num_responses` paraphrases per query. Skipped queries (by the `skip` policy, by default the
+            one of the instance) are returned unchanged.
+        '''
+
+        import torch
+        pending = [query for query in queries if not self.should_skip(query, skip)]
+        paraphrases = {}
+        start = time.perf_counter()
+        for offset in range(0, len(pending), batch_size):
+            batch = pending[offset:offset+batch_size]
+            tokens = self.tokenizer(batch, padding=True, return_tensors="pt")
+            with torch.no_grad():
+                translated = self.model.generate(**tokens,
+                    max_length=max_length,
+                    num_beams=num_responses,
+                    num_return_sequences=num_responses)
+            decoded = self.tokenizer.batch_decode(translated, skip_special_tokens=True)
+            for number, query in enumerate(batch):
+                paraphrases[query] = decoded[number*num_responses:(number+1)*num_responses]
+        if pending:
+            metrics.observe('paraphrase', self.backend, start, time.perf_counter())
+        results = []
+        for query in queries:
+            results.extend(paraphrases.get(query, [query] * num_responses))
+        return results
+
+
+class SpellCorrector:
+    '''
+        Spell checker that is built once and memoizes the correction of every word (LRU, `max_entries` words).
+        The English frequency dictionary can be extended with the vocabulary of a collection so that its
+        domain terms are known words and are not "corrected". The correctors are shared by the Infrang instances
+        of the process (see `shared`); each one holds a full dictionary, so only the `max_instances` most recently
+        used are kept.
+
+        Methods:
+            shared
+            trim
+            load_vocabulary
+            correct
+            correct_queries
+    '''
+
+    VOCABULARY_MIN_COUNT = 2 # words seen once in the collection are more likely typos than jargon
+    instances = OrderedDict() # vocabulary paths -> (their versions, spell corrector), least recently used first
+    instances_lock = threading.Lock()
+    max_instances = 8
+
+    def __init__(self, distance=1, max_entries=4096, vocabulary=None):
+        from spellchecker import SpellChecker
+        self.spell = SpellChecker(distance=distance)
+        self.max_entries = max_entries
+        self.memo = OrderedDict()
+        self.lock = threading.Lock()
+        if vocabulary:
+            self.load_vocabulary(vocabulary)
+
+    @classmethod
+    def shared(cls, vocabulary_paths):
+        '''
+            Returns the spell corrector of the process extended by the combined vocabularies (JSON word frequencies)
+            at `vocabulary_paths`. It is built on first use and again when one of the vocabularies changes or
+            after it has been evicted.
+        '''
+
+        paths = tuple(vocabulary_paths)
+        versions = []
+        for path in paths:
+            try:
+                versions.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                versions.append(None)
+        with cls.instances_lock:
+            cached = cls.instances.get(paths)
+            if cached is None or cached[0] != versions:
+                vocabulary = Counter()
+                for path, version in zip(paths, versions):
+                    if version is not None:
+                        with open(path) as fr:
+                            vocabulary.update(json.load(fr))
+                cached = cls.instances[paths] = (versions, cls(vocabulary=vocabulary or None))
+            cls.instances.move_to_end(paths)
+            cls.__trim(cls.max_instances)
+            return cached[1]
+
+    @classmethod
+    def __trim(cls, count):
+
+        while len(cls.instances) > max(count, 0):
+            cls.instances.popitem(last=False)
+
+    @classmethod
+    def trim(cls, count):
+        '''
+            Evicts the least recently used correctors beyond `count`, e.g. to free memory.
+        '''
+
+        with cls.instances_lock:
+            cls.__trim(count)
+
+    def load_vocabulary(self, vocabulary: dict):
+        '''
+            Adds the word frequencies of `vocabulary` to the dictionary.
+        '''
+
+        words = {word: count for word, count in vocabulary.items() if count >= self.VOCABULARY_MIN_COUNT}
+        with self.lock:
+            self.spell.word_frequency.load_json(words)
+            self.memo.clear()
+
+    def correct(self, word: str):
+
+        with self.lock:
+            if word in self.memo:
+                self.memo.move_to_end(word)
+                return self.memo[word]
+        correction = self.spell.correction(word) or word
+        with self.lock:
+            self.memo[word] = correction
+            while len(self.memo) > self.max_entries:
+                self.memo.popitem(last=False)
+        return correction
+
+    def correct_queries(self, queries: list[str]):
+
+        corrected_queries = []
+        for query in queries:
+            words = query.strip().split()
+            # If a word contains at least one upper case character or is inside quotes ignore correction for this word
+            corrected_queries.append(" ".join(
+                self.correct(word) if word.islower() or word[0] == "'" or word[0] == '"' else word
+                for word in words))
+        return corrected_queries
+
+
+class ContextPacker:
+    '''
+        Assembles the retrieved chunks into the context of the prompt. Overlapping and adjacent chunks of the same
+        source are merged, near-duplicates (word trigram Jaccard similarity of at least `similarity`) are dropped and
+        the remaining blocks are packed by score into `budget` tokens, counted with the tokenizer `tokenizer_name`
+        (a Hugging Face tokenizer, estimated from the length of the text if not provided).
+
+        Methods:
+            pack
+    '''
+
+    MIN_TRUNCATED_TOKENS = 64 # a block is truncated to fill the budget only if at least this much of it fits
+
+    def __init__(self, budget=2048, tokenizer_name=None, similarity=0.9):
+        self.budget = budget
+        self.tokenizer_name = tokenizer_name
+        self.similarity = similarity
+
+    @staticmethod
+    def __shingles(text):
+
+        words = text.lower().split()
+        return {tuple(words[i:i+3]) for i in range(max(1, len(words) - 2))}
+
+    def __merge(self, results):
+
+        blocks, by_source = [], {}
+        for item in results:
+            metadata = item['metadata']
+            block = {'text': metadata['text'], 'source': metadata['source'], 'collection': item.get('collection'),
+                     'score': item['score'], 'start': metadata.get('start'), 'end': metadata.get('end'), 'pages': metadata.get('pages')}
+            if block['start'] is None: # stored before the chunks had offsets
+                blocks.append(block)
+            else:
+                by_source.setdefault((block['collection'], block['source']), []).append(block)
+        for chunks in by_source.values():
+            chunks.sort(key=lambda block: block['start'])
+            merged = chunks[0]
+            for block in chunks[1:]:
+                if block['start'] > merged['end'] + 2: # not adjacent
+                    blocks.append(merged)
+                    merged = block
+                    continue
+                if block['end'] > merged['end']:
+                    overlap = merged['end'] - block['start']
+                    merged['text'] += block['text'][overlap:] if overlap >= 0 else '\n' + block['text']
+                    merged['end'] = block['end']
+                    if merged['pages'] and block['pages']:
+                        merged['pages'] = [merged['pages'][0], block['pages'][1]]
+                merged['score'] = max(merged['score'], block['score'])
+            blocks.append(merged)
+        return blocks
+
+    def pack(self, results: list[dict]):
+        '''
+            Returns the blocks of the context in descending score order and the statistics of the packing:
+            the number of retrieved `chunks`, packed `blocks`, their `tokens` and the `tokens_saved`.
+        '''
+
+        tokenizer = _load_tokenizer(self.tokenizer_name) if self.tokenizer_name else None
+        original = sum(_count_tokens(tokenizer, [item['metadata']['text'] for item in results])) if results else 0
+        packed, shingles, used = [], [], 0
+        for block in sorted(self.__merge(results), key=lambda block: block['score'], reverse=True):
+            block_shingles = self.__shingles(block['text'])
+            if any(len(block_shingles & other) / len(block_shingles | other) >= self.similarity for other in shingles):
+                continue
+            tokens = _count_tokens(tokenizer, [block['text']])[0]
+            if used + tokens > self.budget:
+                remaining = self.budget - used
+                if remaining < self.MIN_TRUNCATED_TOKENS:
+                    continue
+                start, end = _split_tokens(tokenizer, block['text'], remaining, 0)[0]
+                block['text'], tokens = block['text'][start:end], remaining
+            packed.append(block)
+            shingles.append(block_shingles)
+            used += tokens
+        return packed, {
+            'chunks': len(results),
+            'blocks': len(packed),
+            'tokens': used,
+            'tokens_saved': original - used,
+        }
+
+
+class EmbeddingService:
+    '''
+        Owns the dense and sparse embedding models once per process and embeds documents and queries for every
+        Infrang instance that uses the same models (see `shared`).
+        Concurrent query embeddings that arrive within `window` seconds are embedded together (up to `max_batch`)
+        and the vectors of the last `max_entries` queries are cached by their normalized text.
+        `threads` and `batch_size` are passed to the fastembed models.
+
+        Methods:
+            shared
+            embed_documents
+            embed_queries
+            dense_size
+            stats
+    '''
+
+    instances = {}
+    instances_lock = threading.Lock()
+
+    def __init__(self, dense_model_name, sparse_model_name, threads=None, batch_size=256,
+                 window=0.005, max_batch=64, max_entries=4096):
+        from fastembed import SparseTextEmbedding, TextEmbedding
+        self.dense_model_name = dense_model_name
+        self.sparse_model_name = sparse_model_name
+        self.batch_size = batch_size
+        self.window = window
+        self.max_batch = max_batch
+        self.max_entries = max_entries
+        self.dense_model = TextEmbedding(dense_model_name, threads=threads)
+        self.sparse_model = SparseTextEmbedding(sparse_model_name, threads=threads)
+        # the weights of the models, which are loaded from the files in the fastembed cache
+        self.memory_mb = sum(_files_mb(_fastembed_directory(name, '*.onnx*'), '*.onnx*')
+                             for name in (dense_model_name, sparse_model_name))
+        self.cache = OrderedDict()
+        self.counters = {'hits': 0, 'misses': 0, 'batches': 0}
+        self.lock = threading.Lock()
+        self.model_lock = threading.Lock() # one batch runs on the models at a time, with all of their threads
+        self.requests = []
+        self.pending = threading.Condition(self.lock)
+        threading.Thread(target=self.__batch_queries, daemon=True).start()
+
+    @classmethod
+    def shared(cls, dense_model_name, sparse_model_name, threads=None):
+        '''
+            Returns the service of the process for these models and number of threads, creating it on first use.
+        '''
+
+        key = (dense_model_name, sparse_model_name, threads)
+        with cls.instances_lock:
+            if key not in cls.instances:
+                cls.instances[key] = cls(dense_model_name, sparse_model_name, threads=threads)
+            return cls.instances[key]
+
+    @staticmethod
+    def normalize(text: str):
+
+        return ' '.join(text.split())
+
+    @staticmethod
+    def __sparse(embedding):
+        from qdrant_client import models
+        return models.SparseVector(indices=embedding.indices.tolist(), values=embedding.values.tolist())
+
+    def embed_documents(self, texts: list[str], batch_size=None):
+        '''
+            Returns the dense and the sparse vectors of the documents as `{'dense': ..., 'sparse': ...}` dictionaries.
+            They are embedded in batches of `batch_size` documents (by default the one of the service).
+        '''
+
+        batch_size = batch_size or self.batch_size
+        with self.model_lock:
+            dense = list(self.dense_model.embed(texts, batch_size=batch_size))
+            sparse = list(self.sparse_model.embed(texts, batch_size=batch_size))
+        return [{'dense': d.tolist(), 'sparse': self.__sparse(s)} for d, s in zip(dense, sparse)]
+
+    def embed_queries(self, queries: list[str]):
+        '''
+            Returns the vectors of the queries like `embed_documents`, from the cache or micro-batched with the
+            queries of the other threads.
+        '''
+
+        keys = [self.normalize(query) for query in queries]
+        vectors, waiting = {}, {}
+        with self.lock:
+            for key in keys:
+                if key in self.cache:
+                    self.cache.move_to_end(key)
+                    vectors[key] = self.cache[key]
+                    self.counters['hits'] += 1
+                elif key not in waiting:
+                    waiting[key] = Future()
+                    self.requests.append((key, waiting[key]))
+                    self.counters['misses'] += 1
+            if waiting:
+                self.pending.notify()
+        for key, future in waiting.items():
+            vectors[key] = future.result()
+        return [vectors[key] for key in keys]
+
+    def __batch_queries(self):
+
+        while True:
+            with self.lock:
+                while not self.requests:
+                    self.pending.wait()
+            time.sleep(self.window) # let the concurrent queries join the batch
+            with self.lock:
+                batch, self.requests = self.requests[:self.max_batch], self.requests[self.max_batch:]
+            texts = [key for key, _ in batch]
+            try:
+                with self.model_lock:
+                    dense = list(self.dense_model.query_embed(texts))
+                    sparse = list(self.sparse_model.query_embed(texts))
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            with self.lock:
+                self.counters['batches'] += 1
+                for (key, future), d, s in zip(batch, dense, sparse):
+                    vector = {'dense': d.tolist(), 'sparse': self.__sparse(s)}
+                    self.cache[key] = vector
+                    future.set_result(vector)
+                while len(self.cache) > self.max_entries:
+                    self.cache.popitem(last=False)
+
+    @property
+    def dense_size(self):
+        '''
+            The dimension of the dense vectors.
+        '''
+
+        return len(self.embed_queries(['dimension'])[0]['dense'])
+
+    def stats(self):
+
+        with self.lock:
+            return dict(self.counters, entries=len(self.cache))
+
+
+def shared_memory_mb():
+    '''
+        Returns the size in MB of the weights of the models shared by the Infrang instances of the process
+        (embedding models and paraphrasers), which stay loaded for the process. The spell correctors are evicted
+        (see `SpellCorrector.trim`) and are not counted.
+    '''
+
+    shared = list(EmbeddingService.instances.values()) + list(Paraphraser.instances.values())
+    return sum(instance.memory_mb for instance in shared)
+
+
+class Fetcher:
+    '''
+        Downloads the links of `url` / `urls` sources with a pooled HTTP session shared by the fetching threads.
+        Requests time out after `timeout` seconds and are retried with backoff. Each host gets at most `per_host`
+        concurrent requests and one new request every `delay` seconds. Downloads are streamed to an on-disk cache
+        and aborted beyond `max_bytes`. Cached responses are revalidated with their ETag / Last-Modified, so an
+        unchanged page is answered with 304 and not downloaded again.
+
+        Methods:
+            fetch
+            cached
+    '''
+
+    USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+    CONTENT_TYPES = {
+        'text/html': 'html',
+        'application/xhtml+xml': 'html',
+        'application/pdf': 'pdf',
+        'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'docx',
+        'application/vnd.openxmlformats-officedocument.presentationml.presentation': 'pptx',
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': 'xlsx',
+        'text/csv': 'csv',
+        'text/plain': 'txt',
+        'text/markdown': 'md',
+        'application/json': 'json',
+        'application/xml': 'xml',
+        'text/xml': 'xml',
+    }
+
+    def __init__(self, cache_dir, workers=8, per_host=4, delay=0.1, max_bytes=50 * 2**20, timeout=30):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self.cache_dir = cache_dir
+        self.per_host = per_host
+        self.delay = delay
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        os.makedirs(cache_dir, exist_ok=True)
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers, max_retries=Retry(
+            total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), allowed_methods=('GET',)))
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = self.USER_AGENT
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.hosts = {} # host: [semaphore, lock, time of the last request]
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def __slot(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = [threading.Semaphore(self.per_host), threading.Lock(), 0.0]
+            state = self.hosts[host]
+        with state[0]:
+            with state[1]:
+                wait = state[2] + self.delay - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                state[2] = time.monotonic()
+            yield
+
+    def __extension(self, url, content_type):
+
+        media_type = content_type.split(';')[0].strip().lower()
+        if media_type in self.CONTENT_TYPES:
+            return self.CONTENT_TYPES[media_type]
+        extension = urlparse(url).path.rsplit('.', 1)[-1].lower()
+        return extension if extension in self.CONTENT_TYPES.values() else 'html'
+
+    def __entry_path(self, url):
+
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+    def cached(self, url):
+        '''
+            Returns the cache entry of the URL, or None if it is not cached.
+        '''
+
+        try:
+            with open(self.__entry_path(url)) as fr:
+                entry = json.load(fr)
+        except (FileNotFoundError, ValueError):
+            return None
+        return entry if os.path.exists(entry['path']) else None
+
+    def fetch(self, url):
+        '''
+            Downloads or revalidates the URL and returns its cache entry: the `path` of the body, its `extension`
+            (derived from the content type), `encoding`, `hash`, `size`, `etag`, `last_modified` and the `status`
+            of the request (200, or 304 when the cached body is still valid).
+        '''
+
+        entry = self.cached(url)
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        with self.__slot(url), self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 304 and entry:
+                return dict(entry, status=304)
+            response.raise_for_status()
+            if int(response.headers.get('Content-Length') or 0) > self.max_bytes:
+                raise ValueError('The response is larger than {} bytes'.format(self.max_bytes))
+            content_type = response.headers.get('Content-Type', '')
+            extension = self.__extension(url, content_type)
+            path = self.__entry_path(url)[:-len('json')] + extension
+            digest, size = hashlib.sha256(), 0
+            tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+            try:
+                with open(tmp_path, 'wb') as fw:
+                    for block in response.iter_content(chunk_size=2**16):
+                        size += len(block)
+                        if size > self.max_bytes:
+                            raise ValueError('The response is larger than {} bytes'.format(self.max_bytes))
+                        digest.update(block)
+                        fw.write(block)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            if entry and entry['path'] != path and os.path.exists(entry['path']):
+                os.remove(entry['path']) # the content type changed
+            entry = {
+                'url': url,
+                'path': path,
+                'extension': extension,
+                'encoding': response.encoding if 'charset' in content_type else None, # else detected by the extractor
+                'hash': digest.hexdigest(),
+                'size': size,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+            }
+        with open(self.__entry_path(url) + '.tmp', 'w') as fw:
+            json.dump(entry, fw)
+        os.replace(self.__entry_path(url) + '.tmp', self.__entry_path(url))
+        return dict(entry, status=200)
+
+
+class ChunkStore:
+    '''
+        Append-only store of the chunk texts of a collection, so that its points only carry chunk and source numbers.
+        The texts are zlib-compressed into segment files of up to `segment_bytes` and `index.bin` holds the segment,
+        offset and length of every chunk as fixed-size records. Both are memory-mapped, so a chunk is read by its number
+        without copying or decompressing any other. The sources are numbered in the order they are added (`sources.txt`).
+        Texts of removed chunks stay in the segments until the collection is created again. The instances of a
+        collection share one store per process (`shared`) and writes are serialized with a file lock, so that
+        processes sharing the directory (e.g. API workers) do not hand out the same numbers.
+
+        Methods:
+            shared
+            release
+            append
+            get
+            source_id
+            source_ids
+            source_name
+            close
+    '''
+
+    RECORD = np.dtype([('segment', '<u4'), ('offset', '<u8'), ('length', '<u4')])
+    instances = {} # path -> [store, number of users]
+    instances_lock = threading.Lock()
+
+    def __init__(self, path, segment_bytes=64 * 2**20, level=6):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.level = level
+        self.lock = threading.Lock()
+        self.maps = {} # file name -> (inode, mmap)
+        self.sources, self.source_numbers, self.sources_file = [], {}, (None, 0) # (inode, bytes read)
+
+    @classmethod
+    def shared(cls, path):
+        '''
+            Returns the store of the process for the path, creating it on first use. Every call is matched by a
+            `release` of the store.
+        '''
+
+        path = os.path.abspath(path)
+        with cls.instances_lock:
+            if path not in cls.instances:
+                cls.instances[path] = [cls(path), 0]
+            cls.instances[path][1] += 1
+            return cls.instances[path][0]
+
+    def release(self):
+        '''
+            Releases a store returned by `shared` and closes it when no other user is left.
+        '''
+
+        with self.instances_lock:
+            entry = self.instances.get(self.path)
+            if entry is not None and entry[0] is self:
+                entry[1] -= 1
+                if entry[1] > 0:
+                    return
+                del self.instances[self.path]
+        self.close()
+
+    def __file(self, name):
+
+        return os.path.join(self.path, name)
+
+    def __size(self, name):
+
+        return os.path.getsize(self.__file(name)) if os.path.exists(self.__file(name)) else 0
+
+    @contextmanager
+    def __locked(self):
+        '''
+            Holds the lock of the store in the process and, where file locks are available, across processes.
+        '''
+
+        try:
+            import fcntl
+        except ImportError: # Windows: the store is locked in the process only
+            fcntl = None
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.__file('index.bin'), 'ab') as fd:
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX) # released when the file is closed
+                yield
+
+    def __map(self, name, size):
+        '''
+            Returns the memory map of a file with at least `size` bytes. The file is mapped again when it has grown
+            or has been replaced (the collection was created again).
+        '''
+
+        import mmap
+        inode = os.stat(self.__file(name)).st_ino
+        cached = self.maps.get(name)
+        if cached is None or cached[0] != inode or len(cached[1]) < size:
+            with open(self.__file(name), 'rb') as fr:
+                cached = self.maps[name] = (inode, mmap.mmap(fr.fileno(), 0, access=mmap.ACCESS_READ))
+        return cached[1]
+
+    def append(self, texts: list[str]):
+        '''
+            Stores the texts and returns their chunk numbers.
+        '''
+
+        with self.__locked():
+            index_size = self.__size('index.bin')
+            first = index_size // self.RECORD.itemsize
+            segment = 0
+            if first:
+                last = np.frombuffer(self.__map('index.bin', index_size), self.RECORD, 1, (first - 1) * self.RECORD.itemsize)
+                segment = int(last[0]['segment'])
+            name = '{:06d}.seg'.format(segment)
+            offset, records = self.__size(name), []
+            fw = open(self.__file(name), 'ab')
+            try:
+                for text in texts:
+                    data = zlib.compress(text.encode('utf-8'), self.level)
+                    if offset and offset + len(data) > self.segment_bytes:
+                        fw.close()
+                        segment += 1
+                        name = '{:06d}.seg'.format(segment)
+                        offset = self.__size(name)
+                        fw = open(self.__file(name), 'ab')
+                    fw.write(data)
+                    records.append((segment, offset, len(data)))
+                    offset += len(data)
+            finally:
+                fw.close()
+            # the index is written after the texts, so that it never points past the end of a segment
+            with open(self.__file('index.bin'), 'ab') as fw:
+                fw.write(np.array(records, dtype=self.RECORD).tobytes())
+            return list(range(first, first + len(records)))
+
+    def get(self, numbers: list[int]):
+        '''
+            Returns the texts of the chunk numbers.
+        '''
+
+        if not numbers:
+            return []
+        with self.lock:
+            count = max(numbers) + 1
+            index = np.frombuffer(self.__map('index.bin', count * self.RECORD.itemsize), self.RECORD, count)
+            texts = []
+            for number in numbers:
+                segment, offset, length = index[number].item()
+                mapped = self.__map('{:06d}.seg'.format(segment), offset + length)
+                texts.append(zlib.decompress(memoryview(mapped)[offset:offset + length]).decode('utf-8'))
+            return texts
+
+    def __load_sources(self):
+        '''
+            Reads the sources that were added since the last read, e.g. by another instance of the collection.
+        '''
+
+        path = self.__file('sources.txt')
+        if not os.path.exists(path):
+            self.sources, self.source_numbers, self.sources_file = [], {}, (None, 0)
+            return
+        stat = os.stat(path)
+        inode, read = self.sources_file
+        if inode != stat.st_ino or stat.st_size < read: # the collection was created again
+            self.sources, self.source_numbers, read = [], {}, 0
+        if stat.st_size == read:
+            return
+        with open(path, 'rb') as fr:
+            fr.seek(read)
+            data = fr.read()
+        data = data[:data.rfind(b'\n') + 1] # complete lines only
+        for name in data.decode('utf-8').splitlines():
+            self.source_numbers[name] = len(self.sources)
+            self.sources.append(name)
+        self.sources_file = (stat.st_ino, read + len(data))
+
+    def source_id(self, name: str):
+        '''
+            Returns the number of the source, which is added if it is new.
+        '''
+
+        with self.lock:
+            self.__load_sources()
+            if name in self.source_numbers:
+                return self.source_numbers[name]
+        with self.__locked(): # another process may have added it meanwhile
+            self.__load_sources()
+            if name not in self.source_numbers:
+                with open(self.__file('sources.txt'), 'ab') as fw:
+                    fw.write((name + '\n').encode('utf-8'))
+                self.__load_sources()
+            return self.source_numbers[name]
+
+    def source_ids(self, names):
+        '''
+            Returns the numbers of the known sources among `names`.
+        '''
+
+        with self.lock:
+            self.__load_sources()
+            return [self.source_numbers[name] for name in names if name in self.source_numbers]
+
+    def source_name(self, number: int):
+
+        with self.lock:
+            self.__load_sources()
+            return self.sources[number]
+
+    def close(self):
+        '''
+            Unmaps the files. They are mapped again when the store is used afterwards.
+        '''
+
+        with self.lock:
+            for _, mapped in self.maps.values():
+                mapped.close()
+            self.maps.clear()
 
 
 class Infrang:
@@ -23,7 +1636,22 @@ class Infrang:
             create
             update
             delete
+            export_snapshot
+            import_snapshot
+            search
+            retrieve
+            retrieve_batch
+            retrieve_federated
             answer
+            answer_batch
+            answer_stream
+            answer_federated
+            agenerate
+            agenerate_stream
+            lookup_answer
+            lookup_answers
+            store_answer
+            warmup
     '''
 
     def __init__(self,
@@ -34,6 +1662,35 @@ class Infrang:
                 generate_model_name='llama-3.3-70b-versatile',
                 parallel=4,
                 groq_api_key=None,
+                database_client=None,
+                extract_workers=None,
+                fetch_workers=8,
+                batch_size=256,
+                answer_cache=None,
+                paraphrase_backend='torch',
+                paraphrase_threads=None,
+                paraphrase_skip='auto',
+                chunk_tokens=256,
+                chunk_overlap=32,
+                fetch_per_host=4,
+                fetch_max_mb=50,
+                embed_threads=None,
+                embed_batch_size=256,
+                database_url=None,
+                database_api_key=None,
+                hnsw_m=16,
+                hnsw_ef_construct=100,
+                quantization=None,
+                on_disk=False,
+                shards=1,
+                replicas=1,
+                context_tokens=2048,
+                context_tokenizer=None,
+                include=None,
+                exclude=None,
+                max_file_mb=None,
+                follow_symlinks=False,
+                scan_workers=8,
                 ):
         '''
         Initializes the Infrang instance with the specified document path and model configurations.
@@ -45,40 +1702,212 @@ class Infrang:
                 **generate_model_name (str):** Name of the generating model that is used by Groq.
                 **parallel (int):** Number of parallel processes for database operations. Default value is 4.
                 **groq_api_key (str):** API key for Groq service. If not provided, it uses GROQ_API_KEY stored in the virtual environment.
+                **database_client (QdrantClient):** An opened client shared between instances. If not provided, the instance opens its own.
+                **extract_workers (int):** Number of processes extracting and chunking files during ingestion. Default value is the number of CPUs.
+                **fetch_workers (int):** Number of threads fetching links during ingestion. Default value is 8.
+                **batch_size (int):** Minimum number of chunks that are embedded and uploaded together. Default value is 256.
+                **answer_cache (AnswerCache):** Cache of generated answers, shared between instances. If not provided, answers are not cached.
+                **paraphrase_backend (str):** Backend of the paraphrasing model: torch, int8 or onnx. Default value is torch.
+                **paraphrase_threads (int):** Number of threads of the paraphrasing backend. Default value is the backend default.
+                **paraphrase_skip (str):** Which queries are not paraphrased: never, short or auto (short and well-formed). Default value is auto.
+                **chunk_tokens (int):** Maximum number of tokens of a chunk, counted with the tokenizer of the dense model. Default value is 256.
+                **chunk_overlap (int):** Maximum number of tokens that consecutive chunks share. Default value is 32.
+                **fetch_per_host (int):** Maximum number of concurrent requests to the same host when fetching links. Default value is 4.
+                **fetch_max_mb (int):** Links larger than this size in MB are skipped. Default value is 50.
+                **embed_threads (int):** Number of threads of the (shared) embedding models. Default value is the fastembed default.
+                **embed_batch_size (int):** Number of documents embedded together by the embedding models. Default value is 256.
+                **database_url (str):** URL of a Qdrant server. If not provided, it uses QDRANT_URL or else the embedded database in `data`.
+                **database_api_key (str):** API key of the Qdrant server. If not provided, it uses QDRANT_API_KEY of the virtual environment.
+                **hnsw_m (int):** Edges per node of the HNSW index of a new collection. Default value is 16.
+                **hnsw_ef_construct (int):** Neighbours considered while building the HNSW index of a new collection. Default value is 100.
+                **quantization (str):** Quantization of the dense vectors of a new collection: scalar, binary or None. Default value is None.
+                **on_disk (bool):** If true, a new collection keeps its vectors, index and payloads on disk instead of RAM. Default value is False.
+                **shards (int):** Number of shards of a new collection (server mode). Default value is 1.
+                **replicas (int):** Number of replicas of every shard of a new collection (server mode). Default value is 1.
+                **context_tokens (int):** Token budget of the context that is sent to the generating model. Default value is 2048.
+                **context_tokenizer (str):** Hugging Face tokenizer of the generating model, counting the context tokens. Default is an estimate.
+                **include (list):** Glob patterns of the relative paths of the files that are ingested, e.g. `*.pdf`. Default value is all files.
+                **exclude (list):** Glob patterns of the paths of the files and directories that are not ingested, e.g. `drafts/*`.
+                **max_file_mb (int):** Files larger than this are not ingested. Default value is no limit.
+                **follow_symlinks (bool):** Whether symbolic links in the knowledge base are followed. Default value is False.
+                **scan_workers (int):** Number of threads that walk the knowledge base. Default value is 8.
         '''
         
-        self.DESTINATION_SOURCES = '__sources.list'
+        self.DESTINATION_SOURCES = '__sources.list' # legacy flat list, migrated to the manifest
+        self.DESTINATION_MANIFEST = '__manifest.json'
+        self.DESTINATION_JOURNAL = '__manifest.journal'
+        self.DESTINATION_VOCABULARY = '__vocabulary.json'
+        self.DESTINATION_CHUNKS = '__chunks'
+        self.SNAPSHOT_FORMAT = 'infrang-snapshot'
+        self.SNAPSHOT_VERSION = 2
+        self.QUANTIZATIONS = (None, 'scalar', 'binary')
+        self.WARMUP_COMPONENTS = ('database', 'extractors', 'spell_checker', 'paraphraser', 'embedders', 'llm')
+        self.SEARCH_DEFAULTS = {'limit': 4, 'dense_limit': None, 'sparse_limit': None, 'score_threshold': None,
+                                'sources': None, 'hnsw_ef': None, 'spell_check': True, 'rewrite': True}
         self.collection = collection or 'default_collection'
         self.dense_model_name = dense_model_name
         self.sparse_model_name = sparse_model_name
         self.parallel = parallel
-        self.database_client = None
-        self.__setup_init()
-        self.paraphrase_tokenizer = None
-        self.paraphrase_model = None
-        if paraphrase_model_name:
-            self.paraphrase_tokenizer = T5Tokenizer.from_pretrained(paraphrase_model_name, legacy=False)
-            self.paraphrase_model = T5ForConditionalGeneration.from_pretrained(paraphrase_model_name)
+        self.extract_workers = extract_workers or os.cpu_count()
+        self.fetch_workers = fetch_workers
+        self.batch_size = batch_size
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap = chunk_overlap
+        self.fetch_per_host = fetch_per_host
+        self.fetch_max_mb = fetch_max_mb
+        self.embed_threads = embed_threads
+        self.embed_batch_size = embed_batch_size
+        self.context_packer = ContextPacker(budget=context_tokens, tokenizer_name=context_tokenizer)
+        self.include = include
+        self.exclude = exclude
+        self.max_file_bytes = max_file_mb * 2**20 if max_file_mb else None
+        self.follow_symlinks = follow_symlinks
+        self.scan_workers = scan_workers
+        self.database_url = database_url or os.getenv('QDRANT_URL')
+        self.database_api_key = database_api_key or os.getenv('QDRANT_API_KEY')
+        if quantization not in self.QUANTIZATIONS:
+            raise ValueError('Unknown quantization {}. Valid values: scalar, binary or None.'.format(quantization))
+        self.index = {
+            'hnsw_m': hnsw_m,
+            'hnsw_ef_construct': hnsw_ef_construct,
+            'quantization': quantization,
+            'on_disk': on_disk,
+            'shards': shards,
+            'replicas': replicas,
+        }
+        self.__database_client = database_client
+        self.owns_database_client = database_client is None
         self.generate_model = generate_model_name
-        if groq_api_key:
-            self.groq = Groq(
-                    api_key=groq_api_key
-                )
-        else:
-            self.groq = Groq()
+        self.paraphrase_model_name = paraphrase_model_name
+        self.paraphrase_backend = paraphrase_backend
+        self.paraphrase_threads = paraphrase_threads
+        self.paraphrase_skip = paraphrase_skip
+        if paraphrase_model_name and paraphrase_backend not in Paraphraser.BACKENDS:
+            raise ValueError('Unknown paraphrase backend {}.'.format(paraphrase_backend))
+        if paraphrase_model_name and paraphrase_skip not in Paraphraser.SKIP_POLICIES:
+            raise ValueError('Unknown paraphrase skip policy {}.'.format(paraphrase_skip))
+        self.groq_api_key = groq_api_key
+        # the models and clients are loaded on first use (or by `warmup`)
+        self.__fetcher = None
+        self.__groq = None
+        self.__async_groq = None
+        self.lazy_lock = threading.RLock()
+        self.answer_cache = answer_cache
+        self.query_vectors = OrderedDict()
+        self.chunk_stores = {}
 
 
     def __setup_init(self):
+        from qdrant_client import QdrantClient
+        if self.database_url:
+            self.__database_client = QdrantClient(url=self.database_url, api_key=self.database_api_key)
+            return
         if not os.path.exists('data'):
             os.makedirs('data')
             time.sleep(0.05)
         try:
-            self.database_client = QdrantClient(path='data')
+            self.__database_client = QdrantClient(path='data')
         except:
             print('Closing existing database instanse...')
-            self.database_client.close()
+            if self.__database_client is not None:
+                self.__database_client.close()
             time.sleep(0.1)
-            self.database_client = QdrantClient(path='data')
+            self.__database_client = QdrantClient(path='data')
+
+
+    @property
+    def database_client(self):
+
+        with self.lazy_lock:
+            if self.__database_client is None:
+                self.__setup_init()
+            return self.__database_client
+
+
+    @property
+    def paraphraser(self):
+        '''
+            The Paraphraser of the process for the queries, or None if paraphrasing is disabled.
+        '''
+
+        if not self.paraphrase_model_name:
+            return None
+        return Paraphraser.shared(self.paraphrase_model_name,
+            backend=self.paraphrase_backend, threads=self.paraphrase_threads)
+
+
+    @property
+    def embedder(self):
+        '''
+            The EmbeddingService of the process for the dense and sparse models of the instance.
+        '''
+
+        return EmbeddingService.shared(self.dense_model_name, self.sparse_model_name, threads=self.embed_threads)
+
+
+    @property
+    def fetcher(self):
+        '''
+            The Fetcher of the links. Its response cache (`data/fetch_cache`) is shared by all collections.
+        '''
+
+        with self.lazy_lock:
+            if self.__fetcher is None:
+                self.__fetcher = Fetcher(os.path.join('data', 'fetch_cache'), workers=self.fetch_workers,
+                    per_host=self.fetch_per_host, max_bytes=self.fetch_max_mb * 2**20)
+            return self.__fetcher
+
+
+    @property
+    def groq(self):
+
+        with self.lazy_lock:
+            if self.__groq is None:
+                from groq import Groq
+                # without a key, it uses GROQ_API_KEY of the environment
+                self.__groq = Groq(api_key=self.groq_api_key) if self.groq_api_key else Groq()
+            return self.__groq
+
+
+    @property
+    def async_groq(self):
+
+        with self.lazy_lock:
+            if self.__async_groq is None:
+                from groq import AsyncGroq
+                self.__async_groq = AsyncGroq(api_key=self.groq_api_key) if self.groq_api_key else AsyncGroq()
+            return self.__async_groq
+
+
+    def warmup(self, components=None):
+        '''
+        Loads the models and clients now instead of at their first use, e.g. when a server starts.
+            Params:
+                **components (list):** Any of database, extractors, spell_checker, paraphraser, embedders and llm. Default value is all of them.
+            Returns:
+                A dictionary with the time spent loading each component in seconds.
+        '''
+
+        timer = StageTimer('warmup')
+        for component in components or self.WARMUP_COMPONENTS:
+            if component not in self.WARMUP_COMPONENTS:
+                raise ValueError('Unknown component {}. Valid components: {}.'.format(
+                    component, ', '.join(self.WARMUP_COMPONENTS)))
+            with timer.stage(component):
+                if component == 'database':
+                    self.database_client
+                elif component == 'extractors':
+                    _import_extractors() # the links are extracted in threads of this process
+                    _process_context(start=True)
+                elif component == 'spell_checker':
+                    self.__spell_corrector()
+                elif component == 'paraphraser':
+                    self.paraphraser
+                elif component == 'embedders':
+                    self.embedder.embed_queries(['warmup'])
+                elif component == 'llm':
+                    self.groq, self.async_groq
+        return timer.timings
 
 
     def get_collections(self):
@@ -87,116 +1916,533 @@ class Infrang:
         return dirs
     
 
-    def uninit(self):
+    def uninit(self):
+        '''
+            Uninitializes the Infrang instance and closes the connection to QDrant DB.
+            A shared client (passed as `database_client`) is left open for its owner to close.
+        '''
+        with self.lazy_lock:
+            stores, self.chunk_stores = self.chunk_stores, {}
+        for store in stores.values():
+            store.release()
+        if self.owns_database_client and self.__database_client is not None:
+            self.__database_client.close()
+            self.__database_client = None
+
+
+    def __upsert(self, metadata, vectors, ids):
+
+        self.database_client.upload_collection(
+            collection_name=self.collection,
+            vectors=vectors,
+            payload=metadata,
+            ids=ids,
+            batch_size=self.batch_size,
+            parallel=self.parallel,
+            wait=True, # the manifest records the source as stored
+        )
+
+
+    def __chunk_store(self, collection=None):
+        '''
+            Returns the chunk store of the collection (by default the collection of the instance).
+        '''
+
+        collection = collection or self.collection
+        with self.lazy_lock:
+            if collection not in self.chunk_stores:
+                path = self.__metadata_path(self.DESTINATION_CHUNKS, collection)
+                self.chunk_stores[collection] = ChunkStore.shared(path)
+            return self.chunk_stores[collection]
+
+
+    def __link_chunks(self, metadata, ids):
+        '''
+            Adds the sources of the chunks that are already stored (looked up by their content-addressed point IDs)
+            to their `sources` and `locations` and returns the `text`, `sources` and `locations` of the new points
+            by ID. Sources are stored by their number in the chunk store, or by name on a Qdrant server.
+        '''
+
+        from qdrant_client import models
+        store = self.__chunk_store()
+        new_points = {}
+        for entry, point in zip(metadata, ids):
+            source = entry['source'] if self.database_url else store.source_id(entry['source'])
+            location = dict({key: entry[key] for key in ('start', 'end', 'pages') if key in entry}, source=source)
+            if point in new_points:
+                payload = new_points[point]
+                payload['locations'].append(location)
+                if source not in payload['sources']:
+                    payload['sources'].append(source)
+            else:
+                new_points[point] = {'text': entry['text'], 'sources': [source], 'locations': [location]}
+        updates = []
+        for stored in self.database_client.retrieve(self.collection, ids=list(new_points),
+                                                    with_payload=['sources', 'locations'], with_vectors=False):
+            payload = new_points.pop(str(stored.id))
+            sources = stored.payload.get('sources', [])
+            locations = stored.payload.get('locations', [])
+            added = [location for location in payload['locations'] if location['source'] not in sources]
+            if not added: # the source is ingested again after a failure
+                continue
+            updates.append(models.SetPayloadOperation(set_payload=models.SetPayload(
+                payload={'sources': list(dict.fromkeys(sources + payload['sources'])),
+                         'locations': locations + added},
+                points=[stored.id],
+            )))
+        if updates:
+            self.database_client.batch_update_points(self.collection, update_operations=updates, wait=True)
+        return new_points
+
+
+    def __etl(self, kb_dir, docs, manifest, progress=None, cancel=None, timer=None):
+        '''
+            Runs the ingestion pipeline over `docs`, an iterable of `(source, stale)` pairs that is consumed in a
+            thread while the documents are ingested, so that ingestion starts before the discovery finishes.
+            Stale sources are removed before they are ingested again. Files are extracted and chunked in a process
+            pool and links are fetched in a thread pool. The workers stream their chunks through a bounded queue
+            while they read the documents and the chunks are embedded and uploaded in batches of at least
+            `batch_size` chunks, so memory depends on the batch size and not on the size of the documents. A source
+            is recorded in the manifest only after all of its chunks have been uploaded, the chunks of failed sources
+            are removed.
+            The records are appended to the journal of the manifest; the caller saves the manifest once at the end.
+            Chunks are content-addressed: a chunk whose text is already stored is linked to the new source instead
+            of being embedded and uploaded again.
+            `progress` is called with the counters of the run and `cancel` (a `threading.Event`) stops it
+            after storing the documents that are already extracted.
+        '''
+
+        timer = timer or StageTimer('ingest')
+        existing = self.database_client.count(self.collection, exact=True).count
+        root = os.path.abspath(kb_dir)
+        metadata, ids, records = [], [], {}
+        active, flushed = set(), set() # the sources in progress, the sources with uploaded chunks
+        vocabulary, removed = Counter(), Counter() # the words of the ingested and of the stale sources
+        stats = {'documents_total': 0, 'documents_done': 0, 'chunks_embedded': 0,
+                 'chunks_deduplicated': 0, 'bytes_deduplicated': 0}
+        cancelled = False
+
+        def report():
+            if progress:
+                progress(dict(stats))
+
+        def flush():
+            with timer.stage('deduplicate'):
+                new_points = self.__link_chunks(metadata, ids)
+            duplicates = [entry for entry, point in zip(metadata, ids) if point not in new_points]
+            stats['chunks_deduplicated'] += len(duplicates)
+            stats['bytes_deduplicated'] += sum(len(entry['text'].encode('utf-8')) for entry in duplicates)
+            print('Storing {} chunks of {} sources ({} already stored)...'.format(
+                len(new_points), len(records), len(duplicates)))
+            if new_points:
+                texts = [payload['text'] for payload in new_points.values()]
+                with timer.stage('embed'):
+                    vectors = self.embedder.embed_documents(texts, batch_size=self.embed_batch_size)
+                payloads = list(new_points.values())
+                if not self.database_url: # on a server the texts stay in the payloads, readable by every host
+                    with timer.stage('store'):
+                        chunks = self.__chunk_store().append(texts)
+                    payloads = [dict(payload, chunk=chunk) for payload, chunk in zip(payloads, chunks)]
+                    for payload in payloads:
+                        del payload['text']
+                with timer.stage('upsert'):
+                    self.__upsert(metadata=payloads, vectors=vectors, ids=list(new_points))
+            flushed.update(entry['source'] for entry in metadata)
+            if records:
+                with timer.stage('manifest'):
+                    manifest['sources'].update(records)
+                    self.__journal_sources(records)
+            stats['chunks_embedded'] += len(new_points)
+            metadata.clear()
+            ids.clear()
+            records.clear()
+            report()
+
+        def discard(src):
+            kept = [(entry, point) for entry, point in zip(metadata, ids) if entry['source'] != src]
+            metadata[:] = [entry for entry, _ in kept]
+            ids[:] = [point for _, point in kept]
+            if src in flushed:
+                self.__delete_sources([src])
+                flushed.discard(src)
+            active.discard(src)
+
+        def receive(src, chunks):
+            if cancelled:
+                return
+            active.add(src)
+            metadata.extend(chunks)
+            ids.extend(str(uuid.UUID(chunk['hash'])) for chunk in chunks)
+            if len(metadata) >= self.batch_size:
+                flush()
+
+        def drain():
+            while True:
+                try:
+                    receive(*queue.get_nowait())
+                except Empty:
+                    return
+
+        def finish(future):
+            src = futures[future]
+            stats['documents_done'] += 1
+            if future.cancelled():
+                return
+            try:
+                record = future.result()
+            except Exception as e:
+                print('Skipping source {} : {}'.format(src, e))
+                discard(src)
+                return
+            if cancelled or not record:
+                discard(src)
+                return
+            vocabulary.update(record.pop('vocabulary'))
+            for stage, seconds in record.pop('timings').items():
+                timer.add(stage, seconds)
+            print('Processed {} : {} chunks'.format(src, record.pop('chunks')))
+            record['root'] = root
+            active.discard(src)
+            records[src] = record
+
+        discovered, stop_discovery = Queue(), threading.Event()
+
+        def discover():
+            try:
+                for item in docs:
+                    if stop_discovery.is_set():
+                        return
+                    discovered.put(item)
+            except Exception as e:
+                print('Discovery stopped : {}'.format(e))
+            finally:
+                discovered.put(None)
+
+        chunking = dict(manifest['chunking'], tokenizer_file=self.__tokenizer_file(manifest['chunking']))
+        report()
+        context = _process_context()
+        with context.Manager() as manager, \
+            ProcessPoolExecutor(max_workers=self.extract_workers, mp_context=context) as extractors, \
+            ThreadPoolExecutor(max_workers=self.fetch_workers) as fetchers:
+            queue = manager.Queue(maxsize=2 * (self.extract_workers + self.fetch_workers))
+            stop = manager.Event()
+            futures, pending = {}, set()
+            threading.Thread(target=discover, daemon=True).start()
+            scanning = True
+            while scanning or pending:
+                while scanning and not cancelled:
+                    try:
+                        item = discovered.get_nowait()
+                    except Empty:
+                        break
+                    if item is None:
+                        scanning = False
+                        break
+                    doc, stale = item
+                    if stale:
+                        with timer.stage('delete'):
+                            self.__delete_sources([doc], removed)
+                        manifest['sources'].pop(doc, None)
+                    future = fetchers.submit(_extract_chunks, kb_dir, doc, chunking, queue, stop, self.fetcher) \
+                        if _is_url(doc) else \
+                        extractors.submit(_extract_chunks, kb_dir, doc, chunking, queue, stop)
+                    futures[future] = doc
+                    pending.add(future)
+                    stats['documents_total'] += 1
+                try:
+                    receive(*queue.get(timeout=0.05))
+                except Empty:
+                    pass
+                if not cancelled and cancel is not None and cancel.is_set():
+                    print('Cancelling...')
+                    cancelled = True
+                    scanning = False
+                    stop_discovery.set()
+                    stop.set()
+                    for future in pending:
+                        future.cancel()
+                    for src in list(active):
+                        discard(src)
+                done = [future for future in pending if future.done()]
+                for future in done:
+                    drain() # the chunks of a finished source are all in the queue already
+                    pending.discard(future)
+                    finish(future)
+                if done:
+                    report()
+        if metadata or records:
+            flush()
+        with timer.stage('vocabulary'):
+            self.__save_vocabulary(vocabulary, removed)
+        report()
+
+        total = self.database_client.count(self.collection, exact=True).count
+        print(
+        'Added {} new entries; Total entries: {}'.format(total - existing, total)
+        )
+        if stats['chunks_deduplicated']:
+            print('Linked {} duplicate chunks ({} bytes) to the stored chunks'.format(
+                stats['chunks_deduplicated'], stats['bytes_deduplicated']))
+        return stats
+
+
+    def __discover(self, kb_dir, manifest=None, scan=None, timer=None):
+        '''
+            Yields the `(source, stale)` pairs of the knowledge base that have to be ingested while it is walked.
+            Sources are keyed by their path relative to `kb_dir`; the links of `.url` and `.urls` files follow the
+            files. With the `manifest` of an existing collection, unchanged sources are skipped and changed ones are
+            stale. Every found source is added to `scan['seen']` and `scan['complete']` is set when the walk ends
+            without `scan['errors']`, the paths that could not be read.
+        '''
+
+        scan = scan if scan is not None else {}
+        scan.update(seen=set(), errors=[], complete=False)
+        root = os.path.abspath(kb_dir)
+        start = time.perf_counter()
+        links = []
+        for doc, size, mtime in _walk_files(kb_dir, include=self.include, exclude=self.exclude,
+                                            max_bytes=self.max_file_bytes, follow_symlinks=self.follow_symlinks,
+                                            workers=self.scan_workers, errors=scan['errors']):
+            if doc.endswith('.url') or doc.endswith('.urls'):
+                with open(os.path.join(kb_dir, doc)) as fr:
+                    links.extend(link for link in fr.read().splitlines() if link)
+                continue
+            scan['seen'].add(doc)
+            record = manifest['sources'].get(doc) if manifest else None
+            if record is None:
+                yield doc, False
+                continue
+            # records are replaced, not changed, while the manifest may be written by the ingestion
+            if 'mtime' not in record: # migrated from the legacy list: trust the indexed state
+                manifest['sources'][doc] = dict(record, root=root, size=size, mtime=mtime)
+                continue
+            if record['size'] == size and record['mtime'] == mtime:
+                continue
+            if record.get('hash') == _file_digest(os.path.join(kb_dir, doc)):
+                manifest['sources'][doc] = dict(record, size=size, mtime=mtime)
+                continue
+            yield doc, True
+        links = [link for link in dict.fromkeys(links) if link not in scan['seen']]
+        scan['seen'].update(links)
+        known = [link for link in links if manifest and link in manifest['sources']]
+        for link in links:
+            if link not in known:
+                yield link, False
+        if known:
+            start_revalidate = time.perf_counter()
+            changed = self.__changed_links(known, manifest)
+            if timer:
+                timer.add('revalidate', time.perf_counter() - start_revalidate)
+            for link in known:
+                if link in changed:
+                    yield link, True
+        if timer:
+            timer.add('discover', time.perf_counter() - start)
+        scan['complete'] = not scan['errors']
+
+
+    def __chunking(self):
+        '''
+            The chunking settings of a new collection. They are stored in its manifest and used by every update.
+            The `counter` of the tokens is the tokenizer of the dense model, or an estimate from the length of the
+            text if the tokenizer is not in the local fastembed cache, so that the chunks of every run are the same.
+        '''
+
+        counter = 'tokenizer'
+        if self.__tokenizer_file({'tokenizer': self.dense_model_name, 'counter': None}) is None:
+            print('Warning: The tokenizer of {} was not found in the fastembed cache. The tokens of the chunks of '
+                  'this collection are estimated from the length of the text.'.format(self.dense_model_name))
+            counter = 'estimate'
+        return {'tokenizer': self.dense_model_name, 'counter': counter,
+                'tokens': self.chunk_tokens, 'overlap': self.chunk_overlap}
+
+
+    def __tokenizer_file(self, chunking):
+        '''
+            Returns the `tokenizer.json` of the token counter of the chunking settings, None for estimated counts.
+            It is read from the local fastembed cache, where the embedding service downloads the dense model.
+            Collections that were chunked with the tokenizer cannot be updated without it.
+        '''
+
+        if chunking.get('counter') == 'estimate':
+            return None
+        if chunking['tokenizer'] == self.dense_model_name:
+            self.embedder # downloads the model into the cache
+        path = _fastembed_tokenizer(chunking['tokenizer'])
+        if path is None and chunking.get('counter') == 'tokenizer':
+            raise RuntimeError('The tokenizer of {}, which counts the tokens of the chunks of the collection, was not '
+                               'found in the fastembed cache.'.format(chunking['tokenizer']))
+        return path
+
+
+    def __metadata_path(self, name='', collection=None):
+
+        return os.path.join('data', 'collection', collection or self.collection, name)
+
+
+    def __load_manifest(self):
+        '''
+            Returns the manifest of the collection: its chunking settings and for every source its root directory,
+            content hash, size and mtime. The records of its journal, which were stored by an interrupted run,
+            are applied. A legacy `__sources.list` is migrated with empty records.
+        '''
+
+        path = self.__metadata_path(self.DESTINATION_MANIFEST)
+        if os.path.exists(path):
+            with open(path) as fr:
+                manifest = json.load(fr)
+            journal = self.__metadata_path(self.DESTINATION_JOURNAL)
+            if os.path.exists(journal):
+                with open(journal) as fr:
+                    for line in fr:
+                        try:
+                            manifest['sources'].update(json.loads(line))
+                        except ValueError: # the last line of a run that was killed while writing it
+                            break
+            for record in manifest['sources'].values():
+                record.pop('points', None) # stored by earlier versions, deletion goes through the payload
+            return manifest
+        with open(self.__metadata_path(self.DESTINATION_SOURCES), 'r') as fr:
+            return {
+                'version': 1,
+                'sources': {src: {} for src in fr.read().splitlines() if src},
+            }
+
+
+    def __save_manifest(self, manifest):
         '''
-            Uninitializes the Infrang instance and closes the connection to QDrant DB
+            Writes the manifest and compacts its journal into it.
         '''
-        self.database_client.close()
 
+        path = self.__metadata_path(self.DESTINATION_MANIFEST)
+        with open(path + '.tmp', 'w') as fw:
+            json.dump(manifest, fw)
+        os.replace(path + '.tmp', path)
+        journal = self.__metadata_path(self.DESTINATION_JOURNAL)
+        if os.path.exists(journal):
+            os.remove(journal)
 
-    def __etl(self, kb_dir, doc):
 
-        def __extract_text(src: str):
+    def __journal_sources(self, records):
+        '''
+            Appends the records of stored sources to the journal of the manifest, so that a batch does not rewrite
+            the whole manifest and the sources of an interrupted run are known to the next one.
+        '''
 
-            def extract_pypdf(src):
-                return mine_text(src)
+        with open(self.__metadata_path(self.DESTINATION_JOURNAL), 'a') as fw:
+            fw.write(json.dumps(records) + '\n')
 
-            def extract_markitdown(src):
-                extractor = MarkItDown()
-                return extractor.convert(src).text_content
 
-            def extract_plain(src):
-                with open(src) as fr:
-                    return fr.read()
+    def __save_vocabulary(self, vocabulary, removed=None):
+        '''
+            Adds the word frequencies of the ingested sources to the vocabulary of the collection and subtracts
+            those of the `removed` sources (removed or ingested again), so that their words are no longer known.
+        '''
 
-            result = urlparse(src)
-            if result.netloc and result.scheme:
-                time.sleep(0.1) # avoid getting 403
-                response = requests.get(src, headers={
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                }).content
-                return mdf.markdownify(response), src
-            if src.endswith('.pdf'):
-                return extract_pypdf(os.path.join(kb_dir, src)), src
-            elif src.endswith(('.docx','.xlsx','.pptx','.csv')):
-                return extract_markitdown(os.path.join(kb_dir, src)), src
-            elif src.endswith(('.json', '.md', '.txt', '.xml', '.ini')):
-                return extract_plain(os.path.join(kb_dir, src)), src
-            else:
-                print('Skipping source {} : Filetype not supported. Only these filetypes are supported:' \
-                'pdf, docx, xlsx, pptx, csv, url, urls, json, md, txt, xml.\n'\
-                .format(src))
-                return None, None
-        
-        def __chunk_text(text, source, length=1200, overlap=200):
+        path = self.__metadata_path(self.DESTINATION_VOCABULARY)
+        if os.path.exists(path):
+            with open(path) as fr:
+                vocabulary = vocabulary + Counter(json.load(fr))
+        if removed:
+            vocabulary = vocabulary - removed # drops the words that are no longer counted
+        with open(path + '.tmp', 'w') as fw:
+            json.dump(vocabulary, fw)
+        os.replace(path + '.tmp', path)
 
-            chunks = []
-            offset = 0
-            while True:
-                chunks.append(
-                    {
-                        'text' : text[offset:offset+length],
-                        'source' : source
-                    })
-                if offset + length >= len(text):
-                    break # if it captures the text until the end no need to iterate further
-                offset += length - overlap
-            return chunks
-        
-        def __upsert(metadata):
 
-            existing = self.database_client.count(self.collection, exact=True).count
-            self.database_client.upload_collection(
-                collection_name=self.collection,
-                vectors=[
-                    {
-                        'dense': models.Document(text=doc['text'], model=self.dense_model_name),
-                        'sparse': models.Document(text=doc['text'], model=self.sparse_model_name)
-                    } for doc in metadata],
-                payload=metadata,
-                parallel=self.parallel,
-            )
-            total = self.database_client.count(self.collection, exact=True).count
-            print(
-            'Added {} new entries; Total entries: {}'.format(total - existing, total)
-            )
+    def __spell_corrector(self, collections=None):
+        '''
+            Returns the spell corrector of the collections (by default the collection of the instance) extended by
+            their combined vocabularies. It is shared by the instances of the process.
+        '''
 
-        text, source = __extract_text(doc)
-        if not text: 
-            return False
-        print(f'Processing {source} :')
-        print('Chunking text...')
-        metadata = __chunk_text(text=text, source=source)
-        print('Storing data...')
-        __upsert(metadata=metadata)
-        return True
-
-
-    def __get_current_sources(self, kb_path, files):
-
-        src = []
-        for file in files:
-            if file.endswith('.url') or file.endswith('.urls'):
-                with open(os.path.join(kb_path, file)) as fr:
-                    for link in set(fr.read().splitlines()):
-                        if not link:
-                            continue
-                        src.append(link)
-            else:
-                src.append(file)
-        return set(src)
+        collections = collections or (self.collection,)
+        return SpellCorrector.shared(
+            [self.__metadata_path(self.DESTINATION_VOCABULARY, collection) for collection in collections])
 
 
-    def __get_existing_sources(self):
+    def __source_words(self, locations):
+        '''
+            Returns the word frequencies of the sources of `locations` (`(source, start, end, chunk)` tuples, where
+            `chunk` is the number of the text in the chunk store or the text itself), counted on the texts of their
+            chunks without the text that consecutive chunks repeat.
+        '''
+
+        store = self.__chunk_store()
+        by_source, words = {}, Counter()
+        for source, start, end, chunk in locations:
+            by_source.setdefault(source, []).append((start, end, chunk))
+        for spans in by_source.values():
+            spans.sort(key=lambda span: span[:2])
+            covered = 0
+            for offset in range(0, len(spans), self.batch_size): # a batch of texts in memory at a time
+                batch = spans[offset:offset + self.batch_size]
+                stored = iter(store.get([chunk for _, _, chunk in batch if not isinstance(chunk, str)]))
+                texts = [chunk if isinstance(chunk, str) else next(stored) for _, _, chunk in batch]
+                for (start, end, _), text in zip(batch, texts):
+                    if end > covered:
+                        words.update(_count_words(text[max(0, covered - start):]))
+                        covered = end
+        return words
 
-        with open(os.path.join('data', 'collection', self.collection, self.DESTINATION_SOURCES), 'r') as f:
-            return set(f.read().splitlines())
 
+    def __delete_sources(self, sources, words=None):
+        '''
+            Removes the sources from their chunks. Chunks without any other source are deleted, the others keep
+            their remaining locations. If a `words` Counter is given, the word frequencies of the sources in the
+            chunk store are added to it (see `__source_words`).
+        '''
 
-    def __update_existing_sources(self, src):
-        
-        with open(os.path.join('data', 'collection', self.collection, self.DESTINATION_SOURCES), 'a') as f:
-            f.write(src + '\n')
+        from qdrant_client import models
+        # the points stored before the chunk store belong to a single source and carry its name
+        self.database_client.delete(
+            collection_name=self.collection,
+            points_selector=models.FilterSelector(
+                filter=models.Filter(must=[
+                    models.FieldCondition(key='source', match=models.MatchAny(any=list(sources))),
+                ])
+            ),
+        )
+        conditions = self.__source_conditions(sources, self.__chunk_store())[1:]
+        sources = set(sources) | set(self.__chunk_store().source_ids(sources)) # names on a server, else numbers
+        deleted, updates, removed, offset = [], [], [], None
+        while True:
+            stored, offset = self.database_client.scroll(
+                collection_name=self.collection,
+                scroll_filter=models.Filter(should=conditions),
+                limit=1024,
+                offset=offset,
+                with_payload=['sources', 'locations', 'chunk', 'text'],
+                with_vectors=False,
+            )
+            for point in stored:
+                if words is not None:
+                    removed.extend((location['source'], location.get('start') or 0, location.get('end') or 0,
+                                    point.payload['chunk'] if 'chunk' in point.payload else point.payload['text'])
+                                   for location in point.payload['locations'] if location['source'] in sources)
+                locations = [location for location in point.payload['locations'] if location['source'] not in sources]
+                if not locations:
+                    deleted.append(point.id)
+                    continue
+                updates.append(models.SetPayloadOperation(set_payload=models.SetPayload(
+                    payload={
+                        'sources': [source for source in point.payload['sources'] if source not in sources],
+                        'locations': locations,
+                    },
+                    points=[point.id],
+                )))
+            if offset is None:
+                break
+        if removed:
+            words.update(self.__source_words(removed))
+        for start in range(0, len(deleted), self.batch_size):
+            self.database_client.delete(
+                collection_name=self.collection,
+                points_selector=models.PointIdsList(points=deleted[start:start + self.batch_size]),
+            )
+        for start in range(0, len(updates), self.batch_size):
+            self.database_client.batch_update_points(
+                self.collection, update_operations=updates[start:start + self.batch_size], wait=True)
 
 
     def get_sources(self):
@@ -204,24 +2450,30 @@ class Infrang:
             Returns a list with the sources of the collection.
         '''
 
-        return list(self.__get_existing_sources())
+        return list(self.__load_manifest()['sources'])
     
 
-    def create(self, kb_path, overwrite=False):
+    def create(self, kb_path, overwrite=False, progress=None, cancel=None, timings=False):
         '''
             Creates a new Qdrant collection for storing document embeddings if it does not already exist.
                 Params:
                     **kb_path**: Path to the knowledge base
                     **overwrite (bool):** If true, it replaces the sources that already exist with the new. Default value is False.
+                    **progress (callable):** Called with a dictionary of `documents_total`, `documents_done` and `chunks_embedded` while ingesting.
+                    **cancel (threading.Event):** Stops the ingestion when set. The sources stored until then are kept.
+                    **timings (bool):** If true, the result contains the `timings` of the ingestion stages in seconds (summed over the documents).
+                Returns:
+                    The counters of the ingestion (`documents_done`, `chunks_embedded`, ...), or None if the collection exists already.
         '''
 
-        kb_dir, _, files = next(os.walk(kb_path)) # the directory of the knowledge base
-        base_path = os.path.join('data', 'collection', self.collection, self.DESTINATION_SOURCES)
-        base_dir = os.path.join('data', 'collection', self.collection)
-        current_docs = self.__get_current_sources(kb_dir, files)
+        if not os.path.isdir(kb_path):
+            raise FileNotFoundError('The knowledge base {} is not a directory.'.format(kb_path))
+        kb_dir = kb_path
+        timer = StageTimer('create')
 
         if not overwrite:
-            if os.path.exists(base_path):
+            if os.path.exists(self.__metadata_path(self.DESTINATION_MANIFEST)) or \
+                os.path.exists(self.__metadata_path(self.DESTINATION_SOURCES)):
                 print('The database exists already.')
                 return
         else:
@@ -229,54 +2481,304 @@ class Infrang:
             time.sleep(0.1)
 
         print('Creating database...')
-        os.makedirs(base_dir)
-        with open(base_path, 'x'):
-            pass
-        self.database_client.create_collection(
-            collection_name=self.collection,
-            vectors_config={'dense': models.VectorParams(
-                    size=self.database_client.get_embedding_size(self.dense_model_name), 
-                    distance=models.Distance.COSINE
-                )},
-            sparse_vectors_config={'sparse': models.SparseVectorParams()},
-        )
+        os.makedirs(self.__metadata_path(), exist_ok=True)
+        manifest = {'version': 1, 'chunking': self.__chunking(), 'index': self.index, 'sources': {}}
+        self.__save_manifest(manifest)
+        if os.path.exists(self.__metadata_path(self.DESTINATION_VOCABULARY)):
+            os.remove(self.__metadata_path(self.DESTINATION_VOCABULARY))
+        shutil.rmtree(self.__metadata_path(self.DESTINATION_CHUNKS), ignore_errors=True)
+        self.__create_collection()
         
-        for doc in current_docs:
-            self.__etl(kb_dir, doc)
-            self.__update_existing_sources(doc)
+        docs = self.__discover(kb_dir, timer=timer)
+        result = self.__etl(kb_dir, docs, manifest, progress=progress, cancel=cancel, timer=timer)
+        self.__save_manifest(manifest)
+        if self.answer_cache is not None:
+            self.answer_cache.invalidate(self.collection)
 
         print('Done!')
+        if timings:
+            result['timings'] = timer.timings
+        return result
 
 
-    def update(self, kb_path):
+    def update(self, kb_path, progress=None, cancel=None, timings=False):
         '''
             Updates the database given the knowledge base.
                 Params:
                     **kb_path**: Path to the knowledge base
+                    **progress (callable):** Called with a dictionary of `documents_total`, `documents_done` and `chunks_embedded` while ingesting.
+                    **cancel (threading.Event):** Stops the ingestion when set. The sources stored until then are kept.
+                    **timings (bool):** If true, the result contains the `timings` of the ingestion stages in seconds (summed over the documents).
+                Returns:
+                    The counters of the ingestion of the new and changed sources (`documents_done`, `chunks_embedded`, ...)
+                    and the number of `documents_removed`.
         '''
 
-        kb_dir, _, files = next(os.walk(kb_path)) # the directory of the knowledge base
+        if not os.path.isdir(kb_path):
+            raise FileNotFoundError('The knowledge base {} is not a directory.'.format(kb_path))
+        kb_dir = kb_path
 
         try:
-            new_docs = self.__get_current_sources(kb_dir, files) - self.__get_existing_sources()
+            manifest = self.__load_manifest()
         except FileNotFoundError as e:
             print(e)
             print('Creating a new collection...')
-            self.create(kb_path=kb_dir, overwrite=False)
-            return
+            return self.create(kb_path=kb_dir, overwrite=False, progress=progress, cancel=cancel, timings=timings)
+        manifest.setdefault('chunking', self.__chunking()) # collections created before the chunking settings
+        if 'counter' not in manifest['chunking']: # collections created before the counter was recorded
+            manifest['chunking']['counter'] = self.__chunking()['counter']
 
-        if not new_docs:
+        timer = StageTimer('update')
+        root = os.path.abspath(kb_dir)
+        scan = {}
+        # new and changed sources are ingested while the knowledge base is walked
+        stats = self.__etl(kb_dir, self.__discover(kb_dir, manifest, scan, timer=timer), manifest,
+                           progress=progress, cancel=cancel, timer=timer)
+
+        # only the sources that were ingested from this directory can be removed, after a complete walk
+        removed_docs = set()
+        if scan.get('errors'):
+            print('Not removing deleted sources: {} paths could not be read.'.format(len(scan['errors'])))
+        elif scan.get('complete') and not (cancel is not None and cancel.is_set()):
+            removed_docs = {
+                doc for doc, record in manifest['sources'].items()
+                if doc not in scan['seen'] and record.get('root') == root
+            }
+        if removed_docs:
+            print('Removing {} deleted sources...'.format(len(removed_docs)))
+            words = Counter()
+            with timer.stage('delete'):
+                self.__delete_sources(removed_docs, words)
+            for doc in removed_docs:
+                manifest['sources'].pop(doc)
+            with timer.stage('vocabulary'):
+                self.__save_vocabulary(Counter(), words)
+        self.__save_manifest(manifest)
+        if self.answer_cache is not None:
+            self.answer_cache.invalidate(self.collection)
+
+        if stats['documents_total'] or removed_docs:
+            print('Done!')
+        else:
             print(
-                'Warning: There are no new documents to update.'
+                'Warning: There are no new or changed documents to update.'
             )
-            return
+        result = dict(stats, documents_removed=len(removed_docs))
+        if timings:
+            result['timings'] = timer.timings
+        return result
 
-        for doc in new_docs:
-            if not self.__etl(kb_dir, doc):
-                continue
-            self.__update_existing_sources(doc)
 
-        print('Done!')
+    def __changed_links(self, links, manifest):
+        '''
+            Revalidates the links with conditional requests and returns those whose content changed.
+            The new content stays in the cache of the fetcher for their ingestion.
+        '''
+
+        def changed(link):
+            try:
+                return self.fetcher.fetch(link)['hash'] != manifest['sources'][link].get('hash')
+            except Exception as e:
+                print('Could not revalidate {}, keeping it : {}'.format(link, e))
+                return False
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers) as fetchers:
+            return {link for link, result in zip(links, fetchers.map(changed, links)) if result}
+
+
+    def __create_collection(self, dense_size=None):
+        '''
+            Creates the Qdrant collection and its payload indexes with the index settings of the instance. HNSW,
+            quantization, shards and replicas take effect on a Qdrant server; the embedded database searches exhaustively.
+        '''
+
+        from qdrant_client import models
+        on_disk = self.index['on_disk']
+        quantization = None
+        if self.index['quantization'] == 'scalar':
+            quantization = models.ScalarQuantization(scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8, quantile=0.99, always_ram=True))
+        elif self.index['quantization'] == 'binary':
+            quantization = models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+        self.database_client.create_collection(
+            collection_name=self.collection,
+            vectors_config={'dense': models.VectorParams(
+                    size=dense_size or self.embedder.dense_size,
+                    distance=models.Distance.COSINE,
+                    on_disk=on_disk,
+                )},
+            sparse_vectors_config={'sparse': models.SparseVectorParams(
+                    index=models.SparseIndexParams(on_disk=on_disk),
+                )},
+            hnsw_config=models.HnswConfigDiff(
+                m=self.index['hnsw_m'], ef_construct=self.index['hnsw_ef_construct'], on_disk=on_disk),
+            quantization_config=quantization,
+            on_disk_payload=on_disk,
+            shard_number=self.index['shards'],
+            replication_factor=self.index['replicas'],
+        )
+        # `source` holds the name of the source of the points stored before the chunk store
+        # `sources` holds their names on a server and their numbers in the chunk store otherwise
+        sources_schema = models.PayloadSchemaType.KEYWORD if self.database_url else models.PayloadSchemaType.INTEGER
+        for field, schema in (('source', models.PayloadSchemaType.KEYWORD), ('sources', sources_schema)):
+            self.database_client.create_payload_index(
+                collection_name=self.collection,
+                field_name=field,
+                field_schema=schema,
+            )
+
+
+    def export_snapshot(self, path, segment_points=4096, timings=False):
+        '''
+            Writes the collection to a snapshot archive, so that it can be imported elsewhere without extracting
+            and embedding the documents again. The archive is a gzip-compressed tar stream of a `header.json`
+            (format, collection, model names, dense vector size and number of points), the manifest, the vocabulary,
+            the files of the chunk store and segments of up to `segment_points` points: the dense vectors as a
+            float32 `.npy` array and the IDs, sparse vectors and payloads as `.jsonl`. The points are read and
+            written one segment at a time.
+                Params:
+                    **path**: Path of the archive.
+                    **segment_points (int):** Number of points of a segment.
+                    **timings (bool):** If true, the result contains the `timings` of the export in seconds.
+                Returns:
+                    A dictionary with the number of exported `points` and `segments`.
+        '''
+
+        timer = StageTimer('snapshot_export')
+        manifest = self.__load_manifest()
+        info = self.database_client.get_collection(self.collection)
+        header = {
+            'format': self.SNAPSHOT_FORMAT,
+            'version': self.SNAPSHOT_VERSION,
+            'collection': self.collection,
+            'created': time.time(),
+            'dense_model': self.dense_model_name,
+            'sparse_model': self.sparse_model_name,
+            'dense_size': info.config.params.vectors['dense'].size,
+            'points': self.database_client.count(self.collection, exact=True).count,
+        }
+        vocabulary_path = self.__metadata_path(self.DESTINATION_VOCABULARY)
+        count, segment, offset = 0, 0, None
+        with open(path + '.tmp', 'wb') as fw, tarfile.open(fileobj=fw, mode='w|gz') as archive:
+            _tar_add(archive, 'header.json', json.dumps(header).encode('utf-8'))
+            _tar_add(archive, 'manifest.json', json.dumps(manifest).encode('utf-8'))
+            if os.path.exists(vocabulary_path):
+                archive.add(vocabulary_path, arcname='vocabulary.json')
+            chunks_path = self.__metadata_path(self.DESTINATION_CHUNKS)
+            if os.path.isdir(chunks_path): # before the points that refer to its chunks
+                for name in sorted(os.listdir(chunks_path)):
+                    archive.add(os.path.join(chunks_path, name), arcname='chunks/' + name)
+            while True:
+                with timer.stage('read'):
+                    points, offset = self.database_client.scroll(
+                        collection_name=self.collection,
+                        limit=segment_points,
+                        offset=offset,
+                        with_payload=True,
+                        with_vectors=True,
+                    )
+                if points:
+                    with timer.stage('write'):
+                        buffer = io.BytesIO()
+                        np.save(buffer, np.asarray([point.vector['dense'] for point in points], dtype=np.float32))
+                        _tar_add(archive, 'segments/{:06d}.npy'.format(segment), buffer.getvalue())
+                        lines = [json.dumps({
+                            'id': point.id,
+                            'sparse': {'indices': list(point.vector['sparse'].indices),
+                                       'values': list(point.vector['sparse'].values)},
+                            'payload': point.payload,
+                        }) for point in points]
+                        _tar_add(archive, 'segments/{:06d}.jsonl'.format(segment), '\n'.join(lines).encode('utf-8'))
+                    count += len(points)
+                    segment += 1
+                if offset is None:
+                    break
+        os.replace(path + '.tmp', path)
+        print('Exported {} points in {} segments to {}'.format(count, segment, path))
+        result = {'points': count, 'segments': segment}
+        if timings:
+            result['timings'] = timer.timings
+        return result
+
+
+    def import_snapshot(self, path, overwrite=False, timings=False):
+        '''
+            Creates the collection from a snapshot archive of `export_snapshot`. The vectors and payloads are
+            bulk loaded segment by segment without embedding. The snapshot must have been exported with the dense
+            and sparse models of the instance; the index settings of the instance are used for the new collection.
+                Params:
+                    **path**: Path of the archive.
+                    **overwrite (bool):** If true, it replaces the existing collection. Default value is False.
+                    **timings (bool):** If true, the result contains the `timings` of the import in seconds.
+                Returns:
+                    A dictionary with the number of imported `points`, or None if the collection exists already.
+        '''
+
+        from qdrant_client import models
+        if not overwrite and os.path.exists(self.__metadata_path(self.DESTINATION_MANIFEST)):
+            print('The database exists already.')
+            return
+        timer = StageTimer('snapshot_import')
+        count, header, manifest, dense = 0, None, None, None
+        with tarfile.open(path, mode='r|*') as archive:
+            for member in archive:
+                data = archive.extractfile(member).read()
+                if header is None and member.name != 'header.json':
+                    raise ValueError('{} is not a snapshot of version {}.'.format(path, self.SNAPSHOT_VERSION))
+                elif member.name == 'header.json':
+                    header = json.loads(data)
+                    if header.get('format') != self.SNAPSHOT_FORMAT or header.get('version') != self.SNAPSHOT_VERSION:
+                        raise ValueError('{} is not a snapshot of version {}.'.format(path, self.SNAPSHOT_VERSION))
+                    if (header['dense_model'], header['sparse_model']) != (self.dense_model_name, self.sparse_model_name):
+                        raise ValueError('The snapshot was built with the models {} and {}.'.format(
+                            header['dense_model'], header['sparse_model']))
+                    print('Importing {} points of {}...'.format(header['points'], header['collection']))
+                    if overwrite:
+                        self.database_client.delete_collection(collection_name=self.collection)
+                        time.sleep(0.1)
+                    os.makedirs(self.__metadata_path(), exist_ok=True)
+                    for name in (self.DESTINATION_MANIFEST, self.DESTINATION_JOURNAL, self.DESTINATION_SOURCES,
+                                 self.DESTINATION_VOCABULARY):
+                        if os.path.exists(self.__metadata_path(name)):
+                            os.remove(self.__metadata_path(name))
+                    shutil.rmtree(self.__metadata_path(self.DESTINATION_CHUNKS), ignore_errors=True)
+                    os.makedirs(self.__metadata_path(self.DESTINATION_CHUNKS))
+                    self.__create_collection(dense_size=header['dense_size'])
+                elif member.name == 'manifest.json':
+                    manifest = json.loads(data)
+                elif member.name == 'vocabulary.json':
+                    with open(self.__metadata_path(self.DESTINATION_VOCABULARY), 'wb') as fw:
+                        fw.write(data)
+                elif member.name.startswith('chunks/'):
+                    name = os.path.basename(member.name)
+                    with open(os.path.join(self.__metadata_path(self.DESTINATION_CHUNKS), name), 'wb') as fw:
+                        fw.write(data)
+                elif member.name.endswith('.npy'):
+                    dense = np.load(io.BytesIO(data))
+                elif member.name.endswith('.jsonl'):
+                    with timer.stage('upsert'):
+                        records = [json.loads(line) for line in data.decode('utf-8').splitlines()]
+                        payloads = [record['payload'] for record in records]
+                        if self.database_url: # the chunk store of the snapshot is local to this host
+                            payloads = self.__inline(payloads, self.__chunk_store())
+                        self.__upsert(
+                            metadata=payloads,
+                            vectors=[{'dense': vector.tolist(), 'sparse': models.SparseVector(**record['sparse'])}
+                                     for vector, record in zip(dense, records)],
+                            ids=[record['id'] for record in records],
+                        )
+                    count += len(records)
+        if manifest is None:
+            raise ValueError('{} is not a snapshot of version {}.'.format(path, self.SNAPSHOT_VERSION))
+        manifest['index'] = self.index
+        self.__save_manifest(manifest) # last, so that an interrupted import is not taken for a collection
+        if self.answer_cache is not None:
+            self.answer_cache.invalidate(self.collection)
+        print('Imported {} points from {}'.format(count, path))
+        result = {'points': count}
+        if timings:
+            result['timings'] = timer.timings
+        return result
 
 
     def delete(self):
@@ -286,110 +2788,623 @@ class Infrang:
         _, collections, _ = next(os.walk(os.path.join('data','collection')))
         if self.collection in collections:
             self.database_client.delete_collection(collection_name=self.collection)
+            # the metadata is stored outside of a Qdrant server, its files are unmapped before they are removed
+            self.__chunk_store().close()
+            shutil.rmtree(self.__metadata_path(), ignore_errors=True)
+            if self.answer_cache is not None:
+                self.answer_cache.invalidate(self.collection)
             print('Collection removed successfully.')
         else:
             print('Error: Could not find the collection to remove it.')
 
 
-    def answer(self, query: str, debug=False):
+    def __search(self, vectors: list[dict], limit=4, collection=None, dense_limit=None, sparse_limit=None,
+                 score_threshold=None, sources=None, hnsw_ef=None):
         '''
-        Performs a semantic search over the stored documents using dense and sparse models, and generates an answer based on the retrieved context.
+            Runs the hybrid searches of the embedded queries with one batch request.
+        '''
+
+        from qdrant_client import models
+        store = self.__chunk_store(collection)
+        query_filter = models.Filter(should=self.__source_conditions(sources, store)) if sources else None
+        params = models.SearchParams(hnsw_ef=hnsw_ef) if hnsw_ef else None
+        responses = self.database_client.query_batch_points(
+            collection_name=collection or self.collection,
+            requests=[
+                models.QueryRequest(
+                    query=models.FusionQuery(
+                        fusion=models.Fusion.RRF
+                    ),
+                    prefetch=[
+                        models.Prefetch(
+                            query=vector['dense'],
+                            using='dense',
+                            limit=dense_limit or max(limit, 10),
+                            filter=query_filter,
+                            params=params,
+                        ),
+                        models.Prefetch(
+                            query=vector['sparse'],
+                            using='sparse',
+                            limit=sparse_limit or max(limit, 10),
+                            filter=query_filter,
+                        ),
+                    ],
+                    filter=query_filter,
+                    limit=limit,
+                    score_threshold=score_threshold,
+                    with_payload=True,
+                ) for vector in vectors
+            ],
+        )
+        return [self.__hydrate([{
+            'metadata': result.payload,
+            'score': result.score,
+        }
+        for result in response.points], store, sources) for response in responses]
+
+
+    def __source_conditions(self, names, store):
+        '''
+            Returns the conditions that match the points of the named sources: by `source` for the points stored
+            before the chunk store, by name in `sources` on a Qdrant server and by number in the chunk store.
+        '''
+
+        from qdrant_client import models
+        names = list(names)
+        conditions = [models.FieldCondition(key='source', match=models.MatchAny(any=names)),
+                      models.FieldCondition(key='sources', match=models.MatchAny(any=names))]
+        numbers = store.source_ids(names)
+        if numbers:
+            conditions.append(models.FieldCondition(key='sources', match=models.MatchAny(any=numbers)))
+        return conditions
+
+
+    @staticmethod
+    def __inline(payloads: list[dict], store):
+        '''
+            Returns the payloads with the texts of the chunk store and the names of the sources in place of their
+            numbers, as they are stored on a Qdrant server. Other payloads are returned as they are.
+        '''
+
+        texts = iter(store.get([payload['chunk'] for payload in payloads if 'chunk' in payload]))
+        inlined = []
+        for payload in payloads:
+            if 'chunk' in payload:
+                payload = {
+                    'text': next(texts),
+                    'sources': [store.source_name(source) for source in payload['sources']],
+                    'locations': [dict(location, source=store.source_name(location['source']))
+                                  for location in payload['locations']],
+                }
+            inlined.append(payload)
+        return inlined
+
+
+    def __hydrate(self, results: list[dict], store, sources=None):
+        '''
+            Reads the texts of the retrieved chunks from the chunk store and replaces the numbers of their sources
+            with names. The `source`, `start`, `end` and `pages` of a chunk are those of its first location, or of
+            its first location in `sources` when the search was filtered by them.
+        '''
+
+        sources = set(sources or ())
+        for result, payload in zip(results, self.__inline([result['metadata'] for result in results], store)):
+            if 'locations' not in payload: # a point of a single source, stored before the chunk store
+                continue
+            locations = payload['locations']
+            location = next((location for location in locations if location['source'] in sources), locations[0])
+            result['metadata'] = dict(location, text=payload['text'], sources=payload['sources'])
+        return results
+
+
+    def retrieve_batch(self, queries: list[str], debug=False, timer=None, spell_check=True, rewrite=True, **search):
+        '''
+        Rewrites the queries and searches the collection, batching every stage.
+            Params:
+                **queries (list):** The query strings to search for in the database.
+                **timer (StageTimer):** Collects the duration of each stage.
+                **spell_check (bool), rewrite (bool), search:** The retrieval options of `search`.
+            Returns:
+                A list of tuples of the rewritten query and the retrieved results.
+        '''
+
+        timer = timer or StageTimer('retrieve')
+        if spell_check:
+            with timer.stage('spell_check'):
+                queries = self.__spell_corrector().correct_queries(queries)
+        if rewrite and self.paraphraser:
+            with timer.stage('paraphrase'):
+                queries = self.paraphraser.paraphrase(queries, skip=self.paraphrase_skip)
+            if debug:
+                for query in queries:
+                    print('<rewrite>\n{}\n</rewrite>\n'.format(query))
+        with timer.stage('embed'):
+            vectors = self.embedder.embed_queries(queries)
+        with timer.stage('search'):
+            batch_results = self.__search(vectors, **search)
+        if debug:
+            for results in batch_results:
+                for num, result in enumerate(results):
+                    print('<{} result>\n{}\n</result>\n'.format(num, result))
+        return list(zip(queries, batch_results))
+
+
+    def retrieve(self, query: str, debug=False, timer=None, **options):
+        '''
+        Rewrites the query and searches the collection. This is the blocking part of `answer` that runs locally.
             Params:
                 **query (str):** The query string to search for in the database.
+                **timer (StageTimer):** Collects the duration of each stage.
+                **options:** The retrieval options of `search`.
             Returns:
-                A dictionary containing the generated answer and usage statistics.
+                A tuple of the rewritten query and the retrieved results.
         '''
 
-        def search(query: str, limit=8):
-            assert type(query) == str
-            search_result = self.database_client.query_points(
-                collection_name=self.collection,
-                query=models.FusionQuery(
-                    fusion=models.Fusion.RRF
-                ),
-                prefetch=[
-                    models.Prefetch(
-                        query=models.Document(text=query, model=self.dense_model_name),
-                        using='dense',
-                    ),
-                    models.Prefetch(
-                        query=models.Document(text=query, model=self.sparse_model_name),
-                        using='sparse',
-                    ),
-                ],
-                query_filter=None,
-                limit=limit,
-            )
-            return [{
-                'metadata': result.payload,
-                'score': result.score,
-            }
-            for result in search_result.points]
+        return self.retrieve_batch([query], debug=debug, timer=timer, **options)[0]
 
-        def get_response(query, num_responses=1, max_length=64):
-            batch = self.paraphrase_tokenizer.encode_plus(query, padding=True, return_tensors="pt")
-            with torch.no_grad():
-                translated = self.paraphrase_model.generate(**batch,
-                    max_length=max_length,
-                    num_beams = num_responses,
-                    num_return_sequences=num_responses)
-                return self.paraphrase_tokenizer.batch_decode(translated, skip_special_tokens=True)
 
-        def check_spelling(query, distance=1):
-            spell = SpellChecker(distance=distance)
-            words = query.strip().split()
-            # If a word contains at least one upper case character or is inside quotes ignore correction for this word
-            corrected_words = [spell.correction(word) or word 
-                            if (word.islower() or word[0] == "'" or word[0] == '"') else word 
-                            for word in words]
-            return " ".join(corrected_words)
-            
-        def generate(query: str, context: list[str], model=self.generate_model):
-            assert type(context) == list
-            system_prompt = '''
+    def search(self, query: str, limit=4, dense_limit=None, sparse_limit=None, score_threshold=None, sources=None,
+               hnsw_ef=None, spell_check=True, rewrite=True, debug=False, timings=False):
+        '''
+        Retrieves the chunks that are most relevant to the query without generating an answer.
+        `answer`, `answer_batch` and `answer_stream` accept the same retrieval options.
+            Params:
+                **query (str):** The query string to search for in the database.
+                **limit (int):** Number of returned chunks. Default value is 4.
+                **dense_limit (int):** Number of candidates of the dense search that are fused. Default value is max(limit, 10).
+                **sparse_limit (int):** Number of candidates of the sparse search that are fused. Default value is max(limit, 10).
+                **score_threshold (float):** Minimum fused (RRF) score of a returned chunk.
+                **sources (list):** If provided, only the chunks of these sources are searched.
+                **hnsw_ef (int):** Size of the candidate list of the HNSW search (Qdrant server). Default value is the setting of the collection.
+                **spell_check (bool):** Whether the spelling of the query is corrected. Default value is True.
+                **rewrite (bool):** Whether the query is paraphrased. Default value is True.
+                **timings (bool):** If true, the result contains the `timings` of each stage in seconds.
+            Returns:
+                A dictionary with the rewritten `query` and the retrieved `results` (`metadata` and `score` of every chunk).
+        '''
+
+        timer = StageTimer('search')
+        rewritten, results = self.retrieve(query, debug=debug, timer=timer, limit=limit, dense_limit=dense_limit,
+                                           sparse_limit=sparse_limit, score_threshold=score_threshold, sources=sources,
+                                           hnsw_ef=hnsw_ef, spell_check=spell_check, rewrite=rewrite)
+        result = {'query': rewritten, 'results': results}
+        if timings:
+            result['timings'] = timer.timings
+        return result
+
+
+    def retrieve_federated(self, query: str, collections: list[str], limit=4, debug=False, timer=None,
+                           spell_check=True, rewrite=True, **search):
+        '''
+        Rewrites the query once and searches many collections in parallel. Every collection must have been created
+        with the dense and sparse models of the instance. The hybrid (RRF) scores only depend on the ranks of the
+        results, so the results of all collections are fused by score and each one carries its `collection`.
+            Params:
+                **query (str):** The query string to search for in the collections.
+                **collections (list):** The names of the collections.
+                **limit (int):** Number of results that are returned.
+                **timer (StageTimer):** Collects the duration of each stage.
+                **spell_check (bool), rewrite (bool), search:** The retrieval options of `search`.
+            Returns:
+                A tuple of the rewritten query and the retrieved results.
+        '''
+
+        collections = list(dict.fromkeys(collections))
+        missing = set(collections) - set(self.get_collections())
+        if missing:
+            raise ValueError('Unknown collections: {}.'.format(', '.join(sorted(missing))))
+        timer = timer or StageTimer('retrieve')
+        if spell_check:
+            with timer.stage('spell_check'):
+                query = self.__spell_corrector(collections).correct_queries([query])[0]
+        if rewrite and self.paraphraser:
+            with timer.stage('paraphrase'):
+                query = self.paraphraser.paraphrase([query], skip=self.paraphrase_skip)[0]
+            if debug:
+                print('<rewrite>\n{}\n</rewrite>\n'.format(query))
+        with timer.stage('embed'):
+            vectors = self.embedder.embed_queries([query])
+        with timer.stage('search'):
+            with ThreadPoolExecutor(max_workers=min(len(collections), 16) or 1) as executor:
+                responses = executor.map(
+                    lambda collection: self.__search(vectors, limit, collection, **search)[0], collections)
+                results = [dict(result, collection=collection)
+                           for collection, response in zip(collections, responses) for result in response]
+        results = sorted(results, key=lambda result: result['score'], reverse=True)[:limit]
+        if debug:
+            for num, result in enumerate(results):
+                print('<{} result>\n{}\n</result>\n'.format(num, result))
+        return query, results
+
+
+    def __completion(self, query: str, results: list[dict]):
+        '''
+            Returns the request of the generation and the statistics of the context packing.
+        '''
+
+        blocks, packing = self.context_packer.pack(results)
+        context = [block['text'] for block in blocks]
+        system_prompt = '''
 You are an assistant that answers questions strictly based on the CONTEXTS below.
 Do not use external knowledge or guess. If the answer is missing, say: "I don't know the answer."
 Keep responses concise (1-2 sentences unless more detail is needed).
 '''
-            system_prompt += ''.join(['\n\n<CONTEXT>\n' + item + '\n</CONTEXT>' for item in context])
-            
-            response = self.groq.chat.completions.create(
-                messages=[
-                        {
-                            "role": "system",
-                            "content": system_prompt
-                        },
-                        {
-                            "role": "user",
-                            "content": query
-                        }
-                ],
-                model=model,
-            )
-            return {
-                'answer' : response.choices[0].message.content,
-                'usage' : {
-                    'completion_time': response.usage.completion_time,
-                    'prompt_time': response.usage.prompt_time,
-                    'total_time': response.usage.total_time,
-
-                    'completion_tokens': response.usage.completion_tokens,
-                    'prompt_tokens': response.usage.prompt_tokens,
-                    'total_tokens': response.usage.total_tokens,
+        system_prompt += ''.join(['\n\n<CONTEXT>\n' + item + '\n</CONTEXT>' for item in context])
+        return {
+            'messages': [
+                {
+                    "role": "system",
+                    "content": system_prompt
+                },
+                {
+                    "role": "user",
+                    "content": query
                 }
+            ],
+            'model': self.generate_model,
+        }, packing
+
+
+    def __retrieval_event(self, query: str, results: list[dict], context=None):
+
+        return {
+            'event': 'retrieval',
+            'data': {
+                'query': query,
+                'results': [dict({'source': item['metadata']['source'], 'score': item['score']},
+                                 **({'collection': item['collection']} if 'collection' in item else {}))
+                            for item in results],
+                'context': context,
             }
-        
+        }
+
+
+    def __stream_event(self, chunk):
+        '''
+            Returns the token of a streamed chunk and the usage statistics, which Groq sends with the last chunk.
+        '''
+
+        token = chunk.choices[0].delta.content if chunk.choices else None
+        x_groq = getattr(chunk, 'x_groq', None)
+        usage = getattr(x_groq, 'usage', None)
+        return token, self.__usage(usage) if usage is not None else None
+
+
+    def __usage(self, usage):
+
+        return {
+            'completion_time': usage.completion_time,
+            'prompt_time': usage.prompt_time,
+            'total_time': usage.total_time,
+
+            'completion_tokens': usage.completion_tokens,
+            'prompt_tokens': usage.prompt_tokens,
+            'total_tokens': usage.total_tokens,
+        }
+
+
+    def __cache_scope(self, options=None):
+        '''
+            The answers of a query are shared by the instances with the same scope. The retrieval options that
+            differ from the defaults are part of it.
+        '''
+
+        options = tuple(sorted(
+            (key, tuple(value) if isinstance(value, list) else value) for key, value in (options or {}).items()
+            if value != self.SEARCH_DEFAULTS.get(key)
+        ))
+        return (self.collection, self.dense_model_name, self.sparse_model_name,
+                self.paraphrase_model_name, self.paraphrase_backend, self.paraphrase_skip, self.generate_model,
+                self.context_packer.budget, self.context_packer.tokenizer_name) + ((options,) if options else ())
+
+
+    def __collection_version(self):
+        '''
+            Changes whenever the manifest or its journal is written, which invalidates the cached answers in every process.
+        '''
+
+        versions = []
+        for name in (self.DESTINATION_MANIFEST, self.DESTINATION_JOURNAL):
+            try:
+                versions.append(os.stat(self.__metadata_path(name)).st_mtime_ns)
+            except FileNotFoundError:
+                versions.append(None)
+        return tuple(versions) if versions[0] is not None else None
+
+
+    def lookup_answer(self, query: str, timer=None, options=None):
+        '''
+        Looks the query up in the answer cache.
+            Params:
+                **query (str):** The query as given by the user.
+                **timer (StageTimer):** Collects the duration of the lookup.
+                **options (dict):** The retrieval options of the answer.
+            Returns:
+                None on a miss or a dictionary with the cached `result`, the `retrieval` event data and the `cache` tier.
+        '''
+
+        return self.lookup_answers([query], timer=timer, options=options)[0]
+
+
+    def lookup_answers(self, queries: list[str], timer=None, options=None):
+        '''
+        Looks the queries up in the answer cache. The queries without an exact hit are embedded together for
+        the semantic tier.
+            Params:
+                **queries (list):** The queries as given by the user.
+                **timer (StageTimer):** Collects the duration of the lookup.
+                **options (dict):** The retrieval options of the answers.
+            Returns:
+                A list with the result of `lookup_answer` for every query, in the same order.
+        '''
+
+        if self.answer_cache is None:
+            return [None] * len(queries)
+        scope, version = self.__cache_scope(options), self.__collection_version()
+        with (timer or StageTimer('answer')).stage('cache_lookup'):
+            vectors = [None] * len(queries)
+            if self.answer_cache.similarity:
+                missing = [index for index, query in enumerate(queries)
+                           if not self.answer_cache.has(scope, query, version)]
+                if missing:
+                    embedded = self.embedder.embed_queries([queries[index] for index in missing])
+                    for index, embedding in zip(missing, embedded):
+                        vector = np.array(embedding['dense'])
+                        vectors[index] = vector / (np.linalg.norm(vector) or 1)
+            hits = self.answer_cache.get_many(scope, queries, version, vectors)
+        for query, hit, vector in zip(queries, hits, vectors):
+            if hit is None and vector is not None: # kept for `store_answer` after the answer is generated
+                self.query_vectors[query] = vector
+        while len(self.query_vectors) > max(256, len(queries)):
+            self.query_vectors.popitem(last=False)
+        return hits
+
+
+    def store_answer(self, query: str, result: dict, retrieval=None, options=None):
+        '''
+        Stores a generated answer in the answer cache.
+            Params:
+                **query (str):** The query as given by the user.
+                **result (dict):** The result of `answer`.
+                **retrieval (dict):** The data of the `retrieval` event.
+                **options (dict):** The retrieval options of the answer.
+        '''
+
+        if self.answer_cache is None:
+            return
+        vector = self.query_vectors.pop(query, None)
+        self.answer_cache.put(self.__cache_scope(options), query, self.__collection_version(),
+                              result, retrieval=retrieval, vector=vector)
+
+
+    @staticmethod
+    def cached_events(hit: dict):
+        '''
+            Yields the events of `answer_stream` for a hit of `lookup_answer`.
+        '''
+
+        yield {'event': 'retrieval', 'data': dict(hit['retrieval'] or {}, cache=hit['cache'])}
+        yield {'event': 'token', 'data': hit['result']['answer']}
+        yield {'event': 'usage', 'data': hit['result']['usage']}
+
+
+    def answer(self, query: str, debug=False, timings=False, **options):
+        '''
+        Performs a semantic search over the stored documents using dense and sparse models, and generates an answer based on the retrieved context.
+            Params:
+                **query (str):** The query string to search for in the database.
+                **timings (bool):** If true, the result contains the `timings` of each stage in seconds.
+                **options:** The retrieval options of `search`.
+            Returns:
+                A dictionary containing the generated answer and usage statistics.
+        '''
+
         if not query:
             return
-        query = check_spelling(query)
-        if self.paraphrase_model and self.paraphrase_tokenizer:
-            query = get_response(query)[0]
-            if debug:
-                print('<rewrite>\n{}\n</rewrite>\n'.format(query))
-        results = search(query, limit=4)
-        if debug:
-            for num, result in enumerate(results):
-                print('<{} result>\n{}\n</result>\n'.format(num, result))
-        text_results = [item['metadata']['text'] for item in results]
-        return generate(query=query, context=text_results)
+        timer = StageTimer('answer')
+        hit = self.lookup_answer(query, timer=timer, options=options)
+        if hit:
+            result = dict(hit['result'], cache=hit['cache'])
+        else:
+            rewritten, results = self.retrieve(query, debug=debug, timer=timer, **options)
+            with timer.stage('prompt'):
+                completion, packing = self.__completion(rewritten, results)
+            with timer.stage('generate'):
+                response = self.groq.chat.completions.create(**completion)
+            result = {
+                'answer' : response.choices[0].message.content,
+                'usage' : self.__usage(response.usage),
+                'context' : packing,
+            }
+            self.store_answer(query, result, self.__retrieval_event(rewritten, results, packing)['data'], options)
+        if timings: # a copy, the result is held by the answer cache
+            result = dict(result, timings=timer.timings)
+        return result
+
+
+    def answer_federated(self, query: str, collections: list[str], debug=False, timings=False, **options):
+        '''
+        Answers the query from many collections with one retrieval (see `retrieve_federated`) and one generation.
+            Params:
+                **query (str):** The query string to search for in the collections.
+                **collections (list):** The names of the collections.
+                **timings (bool):** If true, the result contains the `timings` of each stage in seconds.
+                **options:** The retrieval options of `search`.
+            Returns:
+                A dictionary containing the generated answer, usage statistics and the `sources` of the context with their collection.
+        '''
+
+        if not query:
+            return
+        timer = StageTimer('answer_federated')
+        rewritten, results = self.retrieve_federated(query, collections, debug=debug, timer=timer, **options)
+        with timer.stage('prompt'):
+            completion, packing = self.__completion(rewritten, results)
+        with timer.stage('generate'):
+            response = self.groq.chat.completions.create(**completion)
+        result = {
+            'answer' : response.choices[0].message.content,
+            'usage' : self.__usage(response.usage),
+            'context' : packing,
+            'sources' : self.__retrieval_event(rewritten, results)['data']['results'],
+        }
+        if timings:
+            result['timings'] = timer.timings
+        return result
+
+
+    def answer_batch(self, queries: list[str], concurrency=8, debug=False, timings=False, **options):
+        '''
+        Answers many queries at once. Spelling correction, paraphrasing, embedding and search run in batches
+        and the answers are generated with up to `concurrency` parallel Groq requests.
+            Params:
+                **queries (list):** The query strings.
+                **concurrency (int):** Maximum number of parallel generations. Default value is 8.
+                **timings (bool):** If true, every result contains the `timings` of the whole batch.
+                **options:** The retrieval options of `search`.
+            Returns:
+                A list with the result of `answer` for every query, in the same order. If the generation of
+                an answer fails, its result contains the `error` instead.
+        '''
+
+        timer = StageTimer('answer_batch')
+        results = [None] * len(queries)
+        pending = []
+        indexes = [index for index, query in enumerate(queries) if query]
+        for index, hit in zip(indexes, self.lookup_answers([queries[index] for index in indexes], timer, options)):
+            if hit:
+                results[index] = dict(hit['result'], cache=hit['cache'])
+            else:
+                pending.append(index)
+        if pending:
+            retrieved = self.retrieve_batch([queries[index] for index in pending], debug=debug, timer=timer, **options)
+            with ThreadPoolExecutor(max_workers=concurrency) as generators:
+                for index, result in zip(pending, generators.map(
+                    lambda item: self.__generate_one(queries[item[0]], *item[1], timer, options), zip(pending, retrieved))):
+                    results[index] = result
+        if timings: # copies, the results are held by the answer cache
+            results = [dict(result, timings=timer.timings) if result is not None else None for result in results]
+        return results
+
+
+    def __generate_one(self, query, rewritten, context, timer, options=None):
+
+        with timer.stage('prompt'):
+            completion, packing = self.__completion(rewritten, context)
+        try:
+            with timer.stage('generate'):
+                response = self.groq.chat.completions.create(**completion)
+        except Exception as e:
+            return {'error': str(e)}
+        result = {
+            'answer' : response.choices[0].message.content,
+            'usage' : self.__usage(response.usage),
+            'context' : packing,
+        }
+        self.store_answer(query, result, self.__retrieval_event(rewritten, context, packing)['data'], options)
+        return result
+
+
+    def answer_stream(self, query: str, debug=False, timings=False, **options):
+        '''
+        Same as `answer`, but yields the answer while it is being generated.
+            Params:
+                **query (str):** The query string to search for in the database.
+                **timings (bool):** If true, a `timings` event with the duration of each stage is sent before the `usage` event.
+                **options:** The retrieval options of `search`.
+            Yields:
+                Dictionaries with an `event` and its `data`: first a `retrieval` event with the rewritten query
+                and the sources and scores of the retrieved context, then a `token` event for every piece of the
+                answer and finally a `usage` event with the usage statistics.
+        '''
+
+        if not query:
+            return
+        timer = StageTimer('answer_stream')
+        hit = self.lookup_answer(query, timer=timer, options=options)
+        if hit:
+            yield from self.cached_events(hit)
+            return
+        rewritten, results = self.retrieve(query, debug=debug, timer=timer, **options)
+        with timer.stage('prompt'):
+            completion, packing = self.__completion(rewritten, results)
+        retrieval = self.__retrieval_event(rewritten, results, packing)
+        yield retrieval
+        start = time.perf_counter()
+        stream = self.groq.chat.completions.create(**completion, stream=True)
+        tokens, usage = [], None
+        for chunk in stream:
+            token, chunk_usage = self.__stream_event(chunk)
+            usage = chunk_usage or usage
+            if token:
+                if not tokens:
+                    timer.add('first_token', time.perf_counter() - start)
+                tokens.append(token)
+                yield {'event': 'token', 'data': token}
+        timer.add('generate', time.perf_counter() - start)
+        self.store_answer(query, {'answer': ''.join(tokens), 'usage': usage}, retrieval['data'], options)
+        if timings:
+            yield {'event': 'timings', 'data': timer.timings}
+        yield {'event': 'usage', 'data': usage}
+
+
+    async def agenerate(self, query: str, results: list[dict], original_query=None, timer=None, options=None):
+        '''
+        Generates the answer of `retrieve`'s output with the asynchronous Groq client.
+            Params:
+                **query (str):** The rewritten query.
+                **results (list):** The retrieved results.
+                **original_query (str):** The query as given by the user. If provided, the answer is stored in the answer cache.
+                **timer (StageTimer):** Collects the duration of each stage.
+                **options (dict):** The retrieval options of `retrieve`, which are part of the cache key.
+            Returns:
+                A dictionary containing the generated answer and usage statistics.
+        '''
+
+        timer = timer or StageTimer('answer')
+        with timer.stage('prompt'):
+            completion, packing = self.__completion(query, results)
+        with timer.stage('generate'):
+            response = await self.async_groq.chat.completions.create(**completion)
+        result = {
+            'answer' : response.choices[0].message.content,
+            'usage' : self.__usage(response.usage),
+            'context' : packing,
+        }
+        if original_query:
+            self.store_answer(original_query, result, self.__retrieval_event(query, results, packing)['data'], options)
+        return result
+
+
+    async def agenerate_stream(self, query: str, results: list[dict], original_query=None, timer=None, options=None):
+        '''
+        Asynchronous counterpart of `answer_stream` for the output of `retrieve`. It yields the same events.
+            Params:
+                **query (str):** The rewritten query.
+                **results (list):** The retrieved results.
+                **original_query (str):** The query as given by the user. If provided, the answer is stored in the answer cache.
+                **timer (StageTimer):** Collects the duration of each stage.
+                **options (dict):** The retrieval options of `retrieve`, which are part of the cache key.
+        '''
 
+        timer = timer or StageTimer('answer_stream')
+        with timer.stage('prompt'):
+            completion, packing = self.__completion(query, results)
+        retrieval = self.__retrieval_event(query, results, packing)
+        yield retrieval
+        start = time.perf_counter()
+        stream = await self.async_groq.chat.completions.create(**completion, stream=True)
+        tokens, usage = [], None
+        async for chunk in stream:
+            token, chunk_usage = self.__stream_event(chunk)
+            usage = chunk_usage or usage
+            if token:
+                if not tokens:
+                    timer.add('first_token', time.perf_counter() - start)
+                tokens.append(token)
+                yield {'event': 'token', 'data': token}
+        timer.add('generate', time.perf_counter() - start)
+        if original_query:
+            self.store_answer(original_query, {'answer': ''.join(tokens), 'usage': usage}, retrieval['data'], options)
+        yield {'event': 'usage', 'data': usage}
@@ -0,0 +1,245 @@
+import json
+import multiprocessing
+import os
+import shutil
+
+import pytest
+
+from infrang_core import _UNBROKEN_CHARACTERS, ChunkStore, ContextPacker, Infrang, _chunk_text, _count_tokens
+
+
+SENTENCE = 'The quick brown fox jumps over a dog.' # 38 characters, 40 with its separator: 10 estimated tokens
+
+
+def document(sentences=60, per_paragraph=5):
+
+    paragraphs = [' '.join([SENTENCE] * per_paragraph) for _ in range(sentences // per_paragraph)]
+    return '\n\n'.join(paragraphs)
+
+
+def pieces_of(text, size=100, page=None):
+
+    return [(text[offset:offset + size], page) for offset in range(0, len(text), size)]
+
+
+# Chunking
+
+def test_chunk_offsets_match_the_text():
+    text = document()
+    chunks = list(_chunk_text(iter(pieces_of(text)), 'doc', tokens=64, overlap=16))
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert chunk['source'] == 'doc'
+        assert text[chunk['start']:chunk['end']] == chunk['text']
+    assert chunks[0]['start'] == 0
+    assert chunks[-1]['end'] == len(text)
+
+
+def test_chunks_respect_the_token_bound_and_overlap():
+    text = document()
+    chunks = list(_chunk_text(iter(pieces_of(text)), 'doc', tokens=64, overlap=16))
+    assert all(_count_tokens(None, [chunk['text']])[0] <= 64 for chunk in chunks)
+    # consecutive chunks cover the document and share at most the overlap
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk['start'] <= previous['end'] + 2
+        assert max(0, previous['end'] - chunk['start']) <= 16 * 4
+
+
+def test_chunks_end_at_paragraphs():
+    text = document(sentences=40, per_paragraph=4)
+    chunks = list(_chunk_text(iter(pieces_of(text)), 'doc', tokens=64, overlap=0))
+    assert all(text[chunk['end']:chunk['end'] + 2] in ('\n\n', '') for chunk in chunks)
+
+
+def test_chunks_carry_their_pages():
+    first, second = document(sentences=20), document(sentences=20)
+    pieces = [(first + '\n\n', 1), (second, 2)]
+    chunks = list(_chunk_text(iter(pieces), 'doc', tokens=64, overlap=0))
+    assert chunks[0]['pages'][0] == 1
+    assert chunks[-1]['pages'][-1] == 2
+    for chunk in chunks:
+        assert chunk['pages'][0] == (1 if chunk['start'] < len(first) else 2)
+        assert chunk['pages'][0] <= chunk['pages'][1]
+
+
+def test_text_without_boundaries_is_cut_while_it_is_streamed():
+    lines = ''.join('{{"id": {}, "value": "item"}},\n'.format(number) for number in range(5000))
+    consumed = []
+
+    def stream():
+        for piece in pieces_of(lines, size=1000):
+            consumed.append(piece)
+            yield piece
+
+    chunks = _chunk_text(stream(), 'data.json', tokens=64, overlap=0)
+    first = next(chunks)
+    assert len(consumed) < 10 # not buffered until the end of the document
+    chunks = [first] + list(chunks)
+    assert all(len(chunk['text']) <= 64 * 4 for chunk in chunks)
+    assert all(lines[chunk['start']:chunk['end']] == chunk['text'] for chunk in chunks)
+    # cut at line breaks, but for the rest of the document that is too short to be cut before it ends
+    cut = [chunk for chunk in chunks if chunk['end'] < len(lines) - 64 * _UNBROKEN_CHARACTERS]
+    assert len(cut) > len(chunks) / 2 and all(lines[chunk['end']] == '\n' for chunk in cut)
+    assert chunks[-1]['end'] == len(lines.rstrip())
+
+
+def test_text_without_whitespace_is_cut_by_length():
+    text = 'x' * 10000
+    chunks = list(_chunk_text(iter(pieces_of(text, size=700)), 'blob', tokens=64, overlap=0))
+    assert all(len(chunk['text']) <= 64 * 4 for chunk in chunks)
+    assert sum(len(chunk['text']) for chunk in chunks) == len(text)
+
+
+# Chunk store
+
+def test_chunk_store_round_trip(tmp_path):
+    store = ChunkStore(str(tmp_path / 'chunks'))
+    texts = ['first chunk', 'second chunk', 'ünïcödé chunk', '']
+    numbers = store.append(texts)
+    assert numbers == [0, 1, 2, 3]
+    assert store.append(['fifth']) == [4]
+    assert store.get([4, 0, 2, 3, 1]) == ['fifth', 'first chunk', 'ünïcödé chunk', '', 'second chunk']
+    assert store.get([]) == []
+    store.close()
+    assert ChunkStore(str(tmp_path / 'chunks')).get([1]) == ['second chunk'] # read by another instance
+
+
+def test_chunk_store_rolls_over_segments(tmp_path):
+    store = ChunkStore(str(tmp_path / 'chunks'), segment_bytes=256, level=0)
+    texts = ['chunk {} '.format(number) * 10 for number in range(20)]
+    numbers = store.append(texts[:10]) + store.append(texts[10:])
+    segments = [name for name in os.listdir(tmp_path / 'chunks') if name.endswith('.seg')]
+    assert len(segments) > 1
+    assert all(os.path.getsize(tmp_path / 'chunks' / name) <= 256 for name in segments)
+    assert store.get(numbers) == texts
+
+
+def test_chunk_store_sources_after_the_collection_is_created_again(tmp_path):
+    path = str(tmp_path / 'chunks')
+    store = ChunkStore(path)
+    assert [store.source_id(name) for name in ('a.txt', 'b.txt', 'a.txt')] == [0, 1, 0]
+    assert store.source_ids(['b.txt', 'missing']) == [1]
+    assert store.source_name(1) == 'b.txt'
+    store.append(['old text'])
+    shutil.rmtree(path)
+    assert store.source_ids(['a.txt']) == []
+    assert store.source_id('c.txt') == 0
+    assert store.source_name(0) == 'c.txt'
+    assert store.append(['new text']) == [0]
+    assert store.get([0]) == ['new text']
+
+
+def test_chunk_store_is_shared_per_path(tmp_path):
+    store = ChunkStore.shared(str(tmp_path / 'chunks'))
+    assert ChunkStore.shared(str(tmp_path / '.' / 'chunks')) is store
+    store.release()
+    assert ChunkStore.shared(str(tmp_path / 'chunks')) is store
+    store.release()
+    store.release()
+    assert ChunkStore.shared(str(tmp_path / 'chunks')) is not store
+    ChunkStore.shared(str(tmp_path / 'chunks')).release()
+
+
+def append_texts(path, tag, queue):
+
+    store = ChunkStore(path)
+    written = []
+    for number in range(50):
+        text = '{}-{}'.format(tag, number)
+        written.extend(zip(store.append([text]), [text]))
+        store.source_id('{}-{}'.format(tag, number % 5))
+    queue.put(written)
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='file locks')
+def test_chunk_store_writers_in_two_processes(tmp_path):
+    path = str(tmp_path / 'chunks')
+    queue = multiprocessing.Queue()
+    writers = [multiprocessing.Process(target=append_texts, args=(path, tag, queue)) for tag in 'ab']
+    for writer in writers:
+        writer.start()
+    written = queue.get(timeout=60) + queue.get(timeout=60)
+    for writer in writers:
+        writer.join()
+    numbers = [number for number, _ in written]
+    assert len(set(numbers)) == len(numbers) == 100
+    assert ChunkStore(path).get(numbers) == [text for _, text in written]
+    with open(os.path.join(path, 'sources.txt')) as fr:
+        sources = fr.read().split()
+    assert sorted(sources) == sorted(set(sources)) and len(sources) == 10
+
+
+# Context packing
+
+def result(text, source, start, score, collection=None):
+
+    return {'metadata': {'text': text, 'source': source, 'start': start, 'end': start + len(text)},
+            'score': score, 'collection': collection}
+
+
+def test_pack_merges_overlapping_and_adjacent_chunks():
+    text = ' '.join('word{}'.format(number) for number in range(100))
+    results = [
+        result(text[0:200], 'a.txt', 0, 0.5),
+        result(text[150:300], 'a.txt', 150, 0.9), # overlaps the first
+        result(text[301:400], 'a.txt', 301, 0.4), # adjacent to the second
+        result(text[0:100], 'b.txt', 0, 0.3), # another source
+    ]
+    blocks, stats = ContextPacker(budget=2048).pack(results)
+    assert [block['source'] for block in blocks] == ['a.txt', 'b.txt']
+    assert blocks[0]['text'] == text[0:300] + '\n' + text[301:400]
+    assert (blocks[0]['start'], blocks[0]['end'], blocks[0]['score']) == (0, 400, 0.9)
+    assert stats['chunks'] == 4 and stats['blocks'] == 2
+    assert stats['tokens_saved'] == sum(len(item['metadata']['text']) // 4 for item in results) - stats['tokens']
+
+
+def test_pack_drops_near_duplicates():
+    text = ' '.join('word{}'.format(number) for number in range(60))
+    blocks, stats = ContextPacker(budget=2048).pack([result(text, 'a.txt', 0, 0.9), result(text, 'b.txt', 0, 0.8)])
+    assert [block['source'] for block in blocks] == ['a.txt']
+
+
+def test_pack_fills_the_budget_by_score():
+    texts = [' '.join('{}{}'.format(name, number) for number in range(80)) for name in ('low', 'high', 'mid')]
+    results = [result(text, '{}.txt'.format(number), 0, score)
+               for number, (text, score) in enumerate(zip(texts, (0.1, 0.9, 0.5)))]
+    tokens = [len(text) // 4 for text in texts]
+    budget = tokens[1] + tokens[2] + ContextPacker.MIN_TRUNCATED_TOKENS
+    blocks, stats = ContextPacker(budget=budget).pack(results)
+    assert [block['score'] for block in blocks] == [0.9, 0.5, 0.1]
+    assert stats['tokens'] <= budget
+    assert len(blocks[2]['text']) < len(texts[0]) and texts[0].startswith(blocks[2]['text']) # truncated
+    blocks, stats = ContextPacker(budget=tokens[1] + 10).pack(results)
+    assert [block['score'] for block in blocks] == [0.9] # too little room left to truncate another block
+
+
+# Manifest
+
+@pytest.fixture
+def infrang(tmp_path, monkeypatch):
+
+    monkeypatch.chdir(tmp_path) # the metadata is stored in ./data
+    os.makedirs(os.path.join('data', 'collection', 'test'))
+    return Infrang('test', groq_api_key='test')
+
+
+def test_manifest_journal_is_replayed(infrang):
+    manifest = {'version': 1, 'chunking': {}, 'sources': {'a.txt': {'hash': 'a', 'points': ['legacy']}}}
+    infrang._Infrang__save_manifest(manifest)
+    infrang._Infrang__journal_sources({'b.txt': {'hash': 'b'}})
+    infrang._Infrang__journal_sources({'a.txt': {'hash': 'a2'}, 'c.txt': {'hash': 'c'}})
+    with open(os.path.join('data', 'collection', 'test', infrang.DESTINATION_JOURNAL), 'a') as fw:
+        fw.write('{"d.txt": {"ha') # killed while writing
+    loaded = infrang._Infrang__load_manifest()
+    assert loaded['sources'] == {'a.txt': {'hash': 'a2'}, 'b.txt': {'hash': 'b'}, 'c.txt': {'hash': 'c'}}
+
+
+def test_saving_the_manifest_compacts_the_journal(infrang):
+    infrang._Infrang__save_manifest({'version': 1, 'chunking': {}, 'sources': {}})
+    infrang._Infrang__journal_sources({'a.txt': {'hash': 'a'}})
+    journal = os.path.join('data', 'collection', 'test', infrang.DESTINATION_JOURNAL)
+    assert os.path.exists(journal)
+    infrang._Infrang__save_manifest(infrang._Infrang__load_manifest())
+    assert not os.path.exists(journal)
+    with open(os.path.join('data', 'collection', 'test', infrang.DESTINATION_MANIFEST)) as fr:
+        assert json.load(fr)['sources'] == {'a.txt': {'hash': 'a'}}